@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+
+"""
+Time and memory-profile the pipeline scripts over a synthetic corpus.
+
+A corpus is generated with corpus.py, and each stage of the pipeline is
+run on it as the workflows run it: merge-json.py, json2xml.py,
+validate.py (with --schema), teixml2collatex.py and collate.py (if Java is
+available), each on the output of the one before. Every stage is run
+--repeat times from scratch, without caches, and its wall time, CPU time
+(including worker processes) and peak resident set size are recorded.
+
+The results are written as JSON. With --compare, each stage is also
+compared with an earlier result file; use --scripts to benchmark the
+scripts of another checkout against the same corpus.
+"""
+
+import argparse
+import datetime
+import glob
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import corpus
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SCRIPTS = os.path.join(os.path.dirname(HERE), 'scripts')
+COLLATEX_JAR = os.path.join(os.path.dirname(HERE), 'tools', 'collatex.jar')
+STAGES = ['merge', 'json2xml', 'validate', 'tokenize', 'collate']
+
+# Corpus sizes for --preset
+PRESETS = {
+    'small': dict(manuscripts=4, parts=1, canvases=10, lines=20, milestones=10),
+    'medium': dict(manuscripts=12, parts=2, canvases=40, lines=25, milestones=50),
+    'large': dict(manuscripts=30, parts=3, canvases=100, lines=30, milestones=200),
+}
+
+
+def stage_command(stage, args):
+    """Returns the command line that runs a stage in the work directory,
+    or None if the stage cannot be run here"""
+    python = sys.executable
+    jobs = ['--jobs', str(args.jobs)] if args.jobs > 1 else []
+    fmt = ['--format', args.format] if args.format != 'plain' else []
+    if stage == 'merge':
+        return [python, os.path.join(args.scripts, 'merge-json.py'), 'transcription', 'merged']
+    if stage == 'json2xml':
+        return [python, os.path.join(args.scripts, 'json2xml.py'), 'merged', 'tei-xml',
+                '-c', 'transcription/config'] + jobs
+    if stage == 'validate':
+        if args.schema is None:
+            return None
+        return [python, os.path.join(args.scripts, 'validate.py'), os.path.abspath(args.schema),
+                'tei-xml/*.xml', '--jobs', str(args.jobs)]
+    if stage == 'tokenize':
+        return [python, os.path.join(args.scripts, 'teixml2collatex.py'), 'tei-xml', 'tokenfiles',
+                '-c', 'transcription/config'] + jobs + fmt
+    if stage == 'collate':
+        if shutil.which('java') is None or not os.path.exists(args.jar):
+            return None
+        return [python, os.path.join(args.scripts, 'collate.py'), 'tokenfiles', 'collations',
+                '--jar', os.path.abspath(args.jar)] + jobs + fmt
+    raise ValueError(stage)
+
+
+# The name of the run report of a stage's script, see scripts/instrument.py
+REPORTS = dict(merge='merge-json', json2xml='json2xml', tokenize='teixml2collatex')
+
+# The directory each stage writes, cleared before each run
+OUTPUTS = dict(merge='merged', json2xml='tei-xml', validate=None, tokenize='tokenfiles',
+               collate='collations')
+
+
+def prepare(stage, workdir):
+    output = OUTPUTS.get(stage)
+    if output is not None:
+        shutil.rmtree(os.path.join(workdir, output), ignore_errors=True)
+        os.makedirs(os.path.join(workdir, output))
+    if stage == 'json2xml':
+        # As in the workflows, the members list goes with the merged files
+        shutil.copy(os.path.join(workdir, 'transcription', 'members.json'),
+                    os.path.join(workdir, 'merged'))
+
+
+def measure(command, workdir):
+    """Runs a command and returns its wall time and CPU time in seconds,
+    its peak resident set size in KB, and its exit status. CPU time and
+    peak RSS include the worker processes it waited for."""
+    # Expand globs here, as a shell would
+    argv = []
+    for arg in command:
+        if '*' in arg:
+            argv.extend(sorted(os.path.relpath(p, workdir)
+                               for p in glob.glob(os.path.join(workdir, arg))))
+        else:
+            argv.append(arg)
+    start = time.perf_counter()
+    with open(os.path.join(workdir, 'benchmark.out'), 'ab') as out:
+        proc = subprocess.Popen(argv, cwd=workdir, stdout=out, stderr=subprocess.STDOUT)
+        (_, status, usage) = os.wait4(proc.pid, 0)
+    wall = time.perf_counter() - start
+    # The process is reaped, so don't let Popen wait for it again
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    return dict(
+        wall=round(wall, 4),
+        cpu=round(usage.ru_utime + usage.ru_stime, 4),
+        maxrss_kb=usage.ru_maxrss,
+        returncode=proc.returncode,
+    )
+
+
+def dir_size(path):
+    total = 0
+    for (dirpath, dirnames, filenames) in os.walk(path):
+        total += sum(os.path.getsize(os.path.join(dirpath, f)) for f in filenames)
+    return total
+
+
+def revision(path):
+    """Returns the git revision of the checkout that path is in, or None"""
+    try:
+        return subprocess.run(
+            ['git', 'describe', '--always', '--dirty'], cwd=path, check=True,
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(args, workdir):
+    """Generates the corpus in workdir and runs the stages on it. Returns
+    the results as a dictionary."""
+    options = corpus.corpus_options(args)
+    files = corpus.generate(os.path.join(workdir, 'transcription'), **options)
+    results = dict(
+        created=datetime.datetime.now().isoformat(timespec='seconds'),
+        revision=revision(args.scripts),
+        scripts=args.scripts,
+        python=platform.python_version(),
+        platform=platform.platform(),
+        cpus=os.cpu_count(),
+        jobs=args.jobs,
+        format=args.format,
+        repeat=args.repeat,
+        corpus=dict(options, files=len(files), bytes=dir_size(os.path.join(workdir, 'transcription'))),
+        stages=dict(),
+    )
+
+    for stage in [s for s in STAGES if s in args.stage]:
+        command = stage_command(stage, args)
+        if command is None:
+            print('%s: skipped' % stage)
+            results['stages'][stage] = dict(skipped=True)
+            continue
+        # The script's own report, with its totals per file or milestone
+        report = '%s.report.json' % REPORTS.get(stage)
+        if stage in REPORTS:
+            command = command + ['--report', report]
+        runs = []
+        for _ in range(args.repeat):
+            prepare(stage, workdir)
+            runs.append(measure(command, workdir))
+        walls = [r['wall'] for r in runs]
+        summary = dict(
+            command=[os.path.basename(command[1])] + command[2:],
+            runs=runs,
+            wall=statistics.median(walls),
+            wall_min=min(walls),
+            cpu=statistics.median([r['cpu'] for r in runs]),
+            maxrss_kb=max(r['maxrss_kb'] for r in runs),
+            failed=sum(1 for r in runs if r['returncode'] != 0),
+        )
+        if OUTPUTS.get(stage) is not None:
+            summary['output_bytes'] = dir_size(os.path.join(workdir, OUTPUTS.get(stage)))
+        # From the last run
+        if stage in REPORTS and os.path.exists(os.path.join(workdir, report)):
+            with open(os.path.join(workdir, report), encoding='utf-8') as fh:
+                summary['totals'] = json.load(fh).get('totals')
+        results['stages'][stage] = summary
+        print('%s: %.2fs wall, %.2fs CPU, %d MB peak RSS%s' % (
+            stage, summary['wall'], summary['cpu'], summary['maxrss_kb'] // 1024,
+            ', %d failed runs' % summary['failed'] if summary['failed'] else ''))
+    return results
+
+
+def compare(baseline, results, threshold):
+    """Prints each stage of results against baseline. Returns the stages
+    that got slower by more than the threshold (a fraction)."""
+    if baseline.get('corpus') != results.get('corpus'):
+        print('warning: the baseline was measured on a different corpus', file=sys.stderr)
+    if baseline.get('format', 'plain') != results.get('format'):
+        print('warning: the baseline was measured with --format %s' % baseline.get('format', 'plain'),
+              file=sys.stderr)
+    if baseline.get('jobs') != results.get('jobs'):
+        print('warning: the baseline was measured with --jobs %s' % baseline.get('jobs'),
+              file=sys.stderr)
+    print('%-10s %10s %10s %8s %12s %12s' % ('stage', 'before', 'after', 'ratio', 'RSS before', 'RSS after'))
+    slower = []
+    for stage in STAGES:
+        before = baseline.get('stages', {}).get(stage)
+        after = results.get('stages', {}).get(stage)
+        if not before or not after or before.get('skipped') or after.get('skipped'):
+            continue
+        ratio = after['wall'] / before['wall'] if before['wall'] else float('inf')
+        print('%-10s %9.2fs %9.2fs %8.2f %9d MB %9d MB' % (
+            stage, before['wall'], after['wall'], ratio,
+            before['maxrss_kb'] // 1024, after['maxrss_kb'] // 1024))
+        if ratio > 1 + threshold:
+            slower.append(stage)
+    return slower
+
+
+def main(args):
+    args.scripts = os.path.abspath(args.scripts)
+    workdir = args.workdir or tempfile.mkdtemp(prefix='benchmark-')
+    os.makedirs(workdir, exist_ok=True)
+    try:
+        results = run_benchmark(args, workdir)
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    output = args.output or 'benchmark-%s-%s.json' % (
+        results.get('revision') or 'unknown', datetime.datetime.now().strftime('%Y%m%d-%H%M%S'))
+    with open(output, 'w', encoding='utf-8') as fh:
+        json.dump(results, fh, indent=2, sort_keys=True)
+    print('results written to %s' % output)
+
+    if args.compare is not None:
+        with open(args.compare, encoding='utf-8') as fh:
+            baseline = json.load(fh)
+        slower = compare(baseline, results, args.threshold)
+        if slower:
+            print('slower by more than %d%%: %s' % (args.threshold * 100, ' '.join(slower)),
+                  file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n\n')[0])
+    parser.add_argument(
+        "--preset",
+        choices=sorted(PRESETS),
+        help="corpus size to start from; the corpus options below override it",
+    )
+    corpus.add_arguments(parser)
+    parser.add_argument(
+        "-s",
+        "--stage",
+        action="append",
+        choices=STAGES,
+        help="stage to run; may be given more than once (default: all). A stage "
+             "needs the output of the ones before it.",
+    )
+    parser.add_argument(
+        "-r",
+        "--repeat",
+        type=int,
+        default=3,
+        help="number of times to run each stage (default 3)",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="number of worker processes for the scripts that can use them (default 1)",
+    )
+    parser.add_argument(
+        "--format",
+        choices=['plain', 'compact', 'gzip'],
+        default='plain',
+        help="format of the token and collation files, see scripts/artifacts.py (default plain)",
+    )
+    parser.add_argument(
+        "--schema",
+        help="RelaxNG schema for the validate stage, which is skipped without it",
+    )
+    parser.add_argument(
+        "--jar",
+        default=COLLATEX_JAR,
+        help="location of the CollateX JAR file (default %s)" % COLLATEX_JAR,
+    )
+    parser.add_argument(
+        "--scripts",
+        default=SCRIPTS,
+        help="directory of the scripts to benchmark (default %s)" % SCRIPTS,
+    )
+    parser.add_argument(
+        "-w",
+        "--workdir",
+        help="directory to generate the corpus and run the stages in, which is kept "
+             "(default: a temporary directory)",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        help="file to write the results to (default benchmark-REVISION-TIMESTAMP.json)",
+    )
+    parser.add_argument(
+        "--compare",
+        help="earlier result file to compare with; exits with 1 if a stage got slower",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="how much slower a stage may get before --compare fails, as a fraction "
+             "(default 0.2)",
+    )
+
+    (known, _) = parser.parse_known_args()
+    if known.preset is not None:
+        parser.set_defaults(**PRESETS[known.preset])
+    args = parser.parse_args()
+    if args.stage is None:
+        args.stage = STAGES
+    sys.exit(main(args))
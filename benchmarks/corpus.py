@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+
+"""
+Generate a synthetic edition corpus in the form that backup.py leaves in
+transcription/: one T-PEN SC-JSON file per project, where a manuscript
+may be split over several numbered projects, plus members.json and a
+config.py that lists the milestones for teixml2collatex.py.
+
+All manuscripts are copies of one base text with random variants, so that
+they can be collated meaningfully. The text is divided into milestones,
+marked with <milestone n="..."/> at the start of each, and some words
+carry a correction in <del>/<add> markup, which gives an a.c. layer.
+"""
+
+import argparse
+import json
+import os
+import random
+
+CREATORS = {
+    '18': {'fname': 'Tara', 'lname': 'Andrews', 'uname': 'tla@example.org'},
+    '22': {'fname': 'Anahit', 'lname': 'Safaryan', 'uname': 'as@example.org'},
+    '31': {'fname': 'Gor', 'lname': 'Petrosyan', 'uname': 'gp@example.org'},
+}
+SYLLABLES = ['a', 'an', 'ar', 'ba', 'da', 'e', 'ga', 'i', 'ka', 'ler', 'ma', 'na',
+             'o', 'ra', 'sa', 'su', 'ta', 'tu', 'va', 'vor', 'yan', 'z']
+VOCABULARY = 3000
+PAGE_WIDTH = 1000
+PAGE_HEIGHT = 1500
+CONFIG = '''"""Configuration of a synthetic corpus"""
+
+
+def milestones():
+    return %r
+
+
+def punctuation():
+    return [".", ",", ":"]
+'''
+
+
+def vocabulary(rng, size=VOCABULARY):
+    """Returns a list of size distinct made-up words"""
+    words = set()
+    while len(words) < size:
+        words.add(''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(1, 4))))
+    return sorted(words)
+
+
+def base_text(rng, words, count):
+    """Returns count words drawn from the vocabulary with a Zipf-like
+    distribution, as in natural language"""
+    weights = [1.0 / (rank + 1) for rank in range(len(words))]
+    return rng.choices(words, weights=weights, k=count)
+
+
+def witness_text(rng, words, base, milestones, variation):
+    """Returns the text of one manuscript as a list of tokens: the base
+    text with a share of variation of its words substituted, omitted or
+    doubled, and a ('milestone', n) token before the first word of each
+    milestone"""
+    tokens = []
+    per_milestone = max(1, len(base) // milestones)
+    for (i, word) in enumerate(base):
+        if i % per_milestone == 0 and i // per_milestone < milestones:
+            tokens.append(('milestone', str(i // per_milestone + 1)))
+        r = rng.random()
+        if r < variation / 2:
+            tokens.append(rng.choice(words))
+        elif r < variation * 3 / 4:
+            continue
+        elif r < variation:
+            tokens.extend([word, rng.choice(words)])
+        else:
+            tokens.append(word)
+    return tokens
+
+
+def lines_of(rng, tokens, nlines, layers):
+    """Divides the tokens into nlines lines of transcription. A share of
+    layers of the words are written as a correction of another word."""
+    markup = []
+    for token in tokens:
+        if isinstance(token, tuple):
+            markup.append('<milestone n="%s"/>' % token[1])
+        elif rng.random() < layers:
+            markup.append('<del>%s</del><add>%s</add>' % (token[::-1], token))
+        else:
+            markup.append(token)
+
+    lines = []
+    per_line = len(markup) / float(nlines)
+    for n in range(nlines):
+        line = markup[int(n * per_line):int((n + 1) * per_line)]
+        lines.append(' '.join(line).replace('/> ', '/>'))
+    return lines
+
+
+def project(name, sigil, part, lines, first_page, first_canvas, first_line, rng):
+    """Returns the SC-JSON of a T-PEN project with the given lines of
+    transcription, lines per canvas. Pages are numbered from first_page
+    within the manuscript, and canvases and lines from first_canvas and
+    first_line across the corpus, as in T-PEN."""
+    projid = 1000 + first_canvas
+    manifest = 'http://t-pen.org/TPEN/manifest/%d' % projid
+    pages = []
+    lineid = first_line
+    for c in range(len(part) // lines):
+        canvas = 'http://t-pen.org/TPEN/canvas/%d' % (first_canvas + c)
+        page = first_page + c
+        resources = []
+        for (n, text) in enumerate(part[c * lines:(c + 1) * lines]):
+            lineid += 1
+            # A paragraph per page
+            if n == 0:
+                text = '<p>' + text
+            if n == lines - 1:
+                text = text + '</p>'
+            height = (PAGE_HEIGHT - 100) // lines
+            resources.append({
+                '@type': 'oa:Annotation',
+                'motivation': 'oad:transcribing',
+                'resource': {'@type': 'cnt:ContentAsText', 'cnt:chars': text},
+                'on': '%s#xywh=50,%d,900,%d' % (canvas, 50 + n * height, height),
+                '_tpen_line_id': 'line/%d' % lineid,
+                '_tpen_note': 'illegible' if rng.random() < 0.01 else '',
+                '_tpen_creator': int(rng.choice(sorted(CREATORS))),
+                'modified': '2020-01-01 12:00:00.0',
+            })
+        pages.append({
+            '@id': canvas,
+            '@type': 'sc:Canvas',
+            'label': '%03d%s' % (page // 2 + 1, 'rv'[page % 2]),
+            'width': PAGE_WIDTH,
+            'height': PAGE_HEIGHT,
+            'otherContent': [{
+                '@type': 'sc:AnnotationList',
+                'label': '%s List' % canvas,
+                'proj': projid,
+                'on': canvas,
+                'resources': resources,
+            }],
+            'images': [{
+                '@type': 'oa:Annotation',
+                'motivation': 'sc:painting',
+                'resource': {
+                    '@id': 'http://t-pen.org/TPEN/imageResize?folioNum=%d' % (first_canvas + c),
+                    '@type': 'dctypes:Image',
+                    'format': 'image/jpeg',
+                    'height': PAGE_HEIGHT,
+                    'width': PAGE_WIDTH,
+                },
+                'on': canvas,
+            }],
+        })
+    return {
+        '@context': 'http://www.shared-canvas.org/ns/context.json',
+        '@id': '%s/manifest.json' % manifest,
+        '@type': 'sc:Manifest',
+        'label': name,
+        'metadata': [
+            {'label': 'title', 'value': 'Synthetic text'},
+            {'label': 'msIdentifier', 'value': sigil},
+            {'label': 'msSettlement', 'value': 'Vienna'},
+            {'label': 'msRepository', 'value': 'Synthetic library'},
+            {'label': 'msIdNumber', 'value': name},
+        ],
+        'sequences': [{
+            '@id': '%s/sequence/normal' % manifest,
+            '@type': 'sc:Sequence',
+            'label': 'Current Page Order',
+            'canvases': pages,
+        }],
+    }
+
+
+def generate(outdir, manuscripts=4, parts=1, canvases=10, lines=20, words=8,
+             milestones=10, layers=0.02, variation=0.1, seed=1):
+    """Writes a corpus to outdir: manuscripts manuscripts, each split into
+    parts projects of canvases pages of lines lines of about words words,
+    with the text divided into milestones milestones. Returns the list of
+    files written."""
+    rng = random.Random(seed)
+    vocab = vocabulary(rng)
+    base = base_text(rng, vocab, parts * canvases * lines * words)
+    os.makedirs(outdir, exist_ok=True)
+
+    written = []
+    canvas_id = 0
+    line_id = 0
+    for m in range(manuscripts):
+        name = 'Ms%03d' % (m + 1)
+        sigil = 'W%03d' % (m + 1)
+        tokens = witness_text(rng, vocab, base, milestones, variation)
+        text = lines_of(rng, tokens, parts * canvases * lines, layers)
+        for p in range(parts):
+            part = text[p * canvases * lines:(p + 1) * canvases * lines]
+            data = project(name, sigil, part, lines, p * canvases, canvas_id, line_id, rng)
+            canvas_id += canvases
+            line_id += canvases * lines
+            # Projects of one manuscript are numbered, as merge-json.py expects
+            filename = '%s.json' % name if parts == 1 else '%s %d.json' % (name, p + 1)
+            with open(os.path.join(outdir, filename), 'w', encoding='utf-8') as fh:
+                json.dump(data, fh, ensure_ascii=False, indent=2)
+            written.append(filename)
+
+    with open(os.path.join(outdir, 'members.json'), 'w', encoding='utf-8') as fh:
+        json.dump(CREATORS, fh, ensure_ascii=False, indent=2, sort_keys=True)
+    written.append('members.json')
+    with open(os.path.join(outdir, 'config.py'), 'w', encoding='utf-8') as fh:
+        fh.write(CONFIG % [str(n + 1) for n in range(milestones)])
+    written.append('config.py')
+    return written
+
+
+def add_arguments(parser):
+    """Adds the corpus size options to an argument parser"""
+    parser.add_argument(
+        "--manuscripts",
+        type=int,
+        default=4,
+        help="number of manuscripts (default 4)",
+    )
+    parser.add_argument(
+        "--parts",
+        type=int,
+        default=1,
+        choices=range(1, 10),
+        help="number of T-PEN projects per manuscript, at most 9 (default 1)",
+    )
+    parser.add_argument(
+        "--canvases",
+        type=int,
+        default=10,
+        help="number of pages per project (default 10)",
+    )
+    parser.add_argument(
+        "--lines",
+        type=int,
+        default=20,
+        help="number of lines per page (default 20)",
+    )
+    parser.add_argument(
+        "--words",
+        type=int,
+        default=8,
+        help="average number of words per line (default 8)",
+    )
+    parser.add_argument(
+        "--milestones",
+        type=int,
+        default=10,
+        help="number of milestones the text is divided into (default 10)",
+    )
+    parser.add_argument(
+        "--layers",
+        type=float,
+        default=0.02,
+        help="share of words with a correction in <del>/<add> markup (default 0.02)",
+    )
+    parser.add_argument(
+        "--variation",
+        type=float,
+        default=0.1,
+        help="share of words that differ between a manuscript and the base text (default 0.1)",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=1,
+        help="random seed; the same options and seed give the same corpus (default 1)",
+    )
+
+
+def corpus_options(args):
+    """Returns the corpus size options of parsed arguments as a dictionary"""
+    return dict((k, getattr(args, k)) for k in (
+        'manuscripts', 'parts', 'canvases', 'lines', 'words', 'milestones', 'layers',
+        'variation', 'seed'))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n\n')[0])
+    parser.add_argument(
+        "outdir",
+        help="directory to write the corpus to",
+    )
+    add_arguments(parser)
+
+    args = parser.parse_args()
+    files = generate(args.outdir, **corpus_options(args))
+    print('wrote %d files to %s' % (len(files), args.outdir))
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+
+"""
+Compare the formats in which the token and collation files can be written
+(see scripts/artifacts.py): for each format, the total size of the files,
+and how fast they are written and read back, in MB of plain JSON per
+second. The files as they are given, in whatever format, are measured
+too, as "as-is".
+
+The files compared are those in the given directories, e.g. tokenfiles/
+and collations/ of a workflow run. Without any, a synthetic corpus is
+generated with corpus.py and tokenized, and also collated if Java and
+CollateX are available.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import benchmark
+import corpus
+
+sys.path.insert(0, benchmark.SCRIPTS)
+import artifacts  # noqa: E402
+
+
+def artifact_files(path):
+    return [os.path.join(path, f) for f in sorted(os.listdir(path))
+            if f.endswith('.json') or f.endswith('.json.gz')]
+
+
+def load_dir(path):
+    """Returns a dictionary of file name -> data of the JSON artifacts in
+    path, whatever their format"""
+    return dict((artifacts.base_name(os.path.basename(f)), artifacts.load_json(f))
+                for f in artifact_files(path))
+
+
+def measure_as_is(path, repeat):
+    """Returns the total size of the artifacts in path as they are, and the
+    best time to read them"""
+    files = artifact_files(path)
+    reads = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for f in files:
+            artifacts.load_json(f)
+        reads.append(time.perf_counter() - start)
+    return dict(bytes=sum(os.path.getsize(f) for f in files), write=None, read=min(reads))
+
+
+def measure_format(data, fmt, workdir, repeat):
+    """Writes and reads back the artifacts in data in the given format
+    repeat times. Returns their total size and the best write and read
+    times."""
+    outdir = os.path.join(workdir, fmt)
+    os.makedirs(outdir, exist_ok=True)
+    writes = []
+    reads = []
+    files = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        files = [artifacts.write_json(os.path.join(outdir, name), content, fmt)
+                 for (name, content) in data.items()]
+        writes.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        for f in files:
+            artifacts.load_json(f)
+        reads.append(time.perf_counter() - start)
+    size = sum(os.path.getsize(f) for f in files)
+    shutil.rmtree(outdir)
+    return dict(bytes=size, write=min(writes), read=min(reads))
+
+
+def compare_dir(path, workdir, repeat):
+    """Returns the measurements of each format for the artifacts in path"""
+    data = load_dir(path)
+    # The throughput is relative to the plain JSON, whatever the format
+    payload = sum(len(artifacts.encode(content, 'plain')) for content in data.values())
+    results = dict(files=len(data), plain_bytes=payload, formats=dict())
+    # What is there now, e.g. collations as CollateX writes them
+    for fmt in ['as-is'] + artifacts.FORMATS:
+        if fmt == 'as-is':
+            m = measure_as_is(path, repeat)
+        else:
+            m = measure_format(data, fmt, workdir, repeat)
+        m['ratio'] = round(m['bytes'] / payload, 4) if payload else None
+        m['write_mb_s'] = round(payload / m['write'] / 1e6, 2) if m['write'] else None
+        m['read_mb_s'] = round(payload / m['read'] / 1e6, 2) if m['read'] else None
+        results['formats'][fmt] = m
+    return results
+
+
+def generate(args, workdir):
+    """Generates a corpus in workdir and runs the pipeline on it up to the
+    collations, if it can. Returns the directories of artifacts made."""
+    corpus.generate(os.path.join(workdir, 'transcription'), **corpus.corpus_options(args))
+    made = []
+    for stage in ['merge', 'json2xml', 'tokenize', 'collate']:
+        command = benchmark.stage_command(stage, args)
+        if command is None:
+            print('%s: skipped' % stage)
+            continue
+        benchmark.prepare(stage, workdir)
+        if benchmark.measure(command, workdir)['returncode'] != 0:
+            print('%s failed, see %s' % (stage, os.path.join(workdir, 'benchmark.out')),
+                  file=sys.stderr)
+            break
+        if stage in ('tokenize', 'collate'):
+            made.append(os.path.join(workdir, benchmark.OUTPUTS.get(stage)))
+    return made
+
+
+def main(args):
+    workdir = tempfile.mkdtemp(prefix='formats-')
+    try:
+        dirs = args.dirs or generate(args, workdir)
+        results = dict()
+        print('%-12s %-8s %12s %7s %12s %12s' % ('files', 'format', 'size', 'ratio', 'write MB/s', 'read MB/s'))
+        for path in dirs:
+            name = os.path.basename(os.path.normpath(path))
+            results[name] = compare_dir(path, os.path.join(workdir, 'measure'), args.repeat)
+            for fmt in ['as-is'] + artifacts.FORMATS:
+                m = results[name]['formats'][fmt]
+                print('%-12s %-8s %9.1f KB %7.3f %12s %12s' % (
+                    name, fmt, m['bytes'] / 1024.0, m['ratio'] or 0, m['write_mb_s'], m['read_mb_s']))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as fh:
+            json.dump(results, fh, indent=2, sort_keys=True)
+        print('results written to %s' % args.output)
+    return 0
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n\n')[0])
+    parser.add_argument(
+        "dirs",
+        nargs="*",
+        help="directories of token or collation files to compare the formats on "
+             "(default: those of a synthetic corpus)",
+    )
+    parser.add_argument(
+        "--preset",
+        choices=sorted(benchmark.PRESETS),
+        help="size of the synthetic corpus to start from; the corpus options below override it",
+    )
+    corpus.add_arguments(parser)
+    parser.add_argument(
+        "-r",
+        "--repeat",
+        type=int,
+        default=3,
+        help="number of times to write and read each format; the fastest counts (default 3)",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="number of worker processes for generating the artifacts (default 1)",
+    )
+    parser.add_argument(
+        "--jar",
+        default=benchmark.COLLATEX_JAR,
+        help="location of the CollateX JAR file (default %s)" % benchmark.COLLATEX_JAR,
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        help="file to write the results to as JSON",
+    )
+
+    (known, _) = parser.parse_known_args()
+    if known.preset is not None:
+        parser.set_defaults(**benchmark.PRESETS[known.preset])
+    args = parser.parse_args()
+    # What benchmark.stage_command() needs to know
+    args.scripts = benchmark.SCRIPTS
+    args.schema = None
+    args.format = 'plain'
+    sys.exit(main(args))
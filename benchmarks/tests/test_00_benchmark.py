@@ -0,0 +1,55 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import benchmark
+import corpus
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def args(self, *argv):
+        parser = argparse.ArgumentParser()
+        corpus.add_arguments(parser)
+        args = parser.parse_args(['--manuscripts', '2', '--parts', '2', '--canvases', '1', '--lines', '3',
+                                  '--words', '3', '--milestones', '3', '--layers', '0'] + list(argv))
+        return argparse.Namespace(
+            stage=['merge', 'json2xml'], repeat=1, jobs=1, format='plain', schema=None,
+            jar=benchmark.COLLATEX_JAR, scripts=benchmark.SCRIPTS, workdir=os.path.join(self.tmpdir, 'work'),
+            output=os.path.join(self.tmpdir, 'results.json'), compare=None, threshold=0.2,
+            **corpus.corpus_options(args))
+
+    def test_generate(self):
+        outdir = os.path.join(self.tmpdir, 'transcription')
+        files = corpus.generate(outdir, **corpus.corpus_options(self.args()))
+        self.assertEqual(sorted(os.listdir(outdir)), sorted(files))
+        self.assertEqual(sorted(files), ['Ms001 1.json', 'Ms001 2.json', 'Ms002 1.json', 'Ms002 2.json',
+                                         'config.py', 'members.json'])
+
+    def test_stages(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertEqual(benchmark.main(self.args()), 0)
+        with open(os.path.join(self.tmpdir, 'results.json'), encoding='utf-8') as fh:
+            results = json.load(fh)
+
+        self.assertEqual(results['corpus']['files'], 6)
+        self.assertEqual(sorted(results['stages']), ['json2xml', 'merge'])
+        for stage in results['stages'].values():
+            self.assertEqual(stage['failed'], 0)
+            self.assertGreater(stage['output_bytes'], 0)
+        # The scripts' own reports
+        self.assertEqual(results['stages']['merge']['totals']['manuscript']['count'], 2)
+        self.assertEqual(results['stages']['json2xml']['totals']['file']['count'], 2)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.tmpdir, 'work', 'tei-xml'))),
+                         ['.json2xml-build.json', 'Ms001-merged.json.tei.xml', 'Ms002-merged.json.tei.xml'])
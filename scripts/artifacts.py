@@ -0,0 +1,106 @@
+"""
+Reading and writing the JSON artifacts that the pipeline scripts pass on to
+each other: the tokenized milestone files and their collations. They can
+be written in one of three formats:
+
+    plain    indented JSON, as the scripts have always written it
+    compact  minified JSON, without any whitespace between tokens
+    gzip     minified JSON, gzip-compressed, in a file ending in .gz
+
+Readers accept every format, whatever the name of the file, so that a
+stage works on the output of the one before it however that was written.
+"""
+
+import gzip
+import json
+import os
+
+FORMATS = ['plain', 'compact', 'gzip']
+GZIP_SUFFIX = '.gz'
+GZIP_MAGIC = b'\x1f\x8b'
+# Fast, and most of what level 9 gets out of such repetitive JSON
+GZIP_LEVEL = 6
+
+
+def add_arguments(parser, default='plain'):
+    """Adds the --format option to an argument parser"""
+    parser.add_argument(
+        "--format",
+        choices=FORMATS,
+        default=default,
+        help="format of the JSON files written: plain (indented), compact (minified) or "
+             "gzip (minified and compressed, with a .gz suffix) (default %s)" % default,
+    )
+
+
+def artifact_path(path, fmt):
+    """Returns the name of the file that holds the artifact path (which
+    ends in .json) in the given format"""
+    if fmt == 'gzip':
+        return path + GZIP_SUFFIX
+    return path
+
+
+def base_name(path):
+    """Returns path without the suffix of the format it is written in"""
+    if path.endswith(GZIP_SUFFIX):
+        return path[:-len(GZIP_SUFFIX)]
+    return path
+
+
+def encode(data, fmt):
+    """Returns the bytes of the JSON-serialisable data in the given format"""
+    if fmt == 'plain':
+        return json.dumps(data, ensure_ascii=False, indent=4).encode('utf-8')
+    body = json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    if fmt == 'gzip':
+        # Without a timestamp, the same content always gives the same file
+        return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+    return body
+
+
+def recode(body, fmt):
+    """Returns JSON text (bytes) written by another program in the given
+    format. Plain leaves it as it is."""
+    if fmt == 'plain':
+        return body
+    return encode(json.loads(body.decode('utf-8')), fmt)
+
+
+def write_bytes(path, body, fmt):
+    """Writes body, already encoded in the given format, as the artifact
+    path. Copies of the artifact in the other formats are removed, so that
+    readers never find two. Returns the name of the file written."""
+    outfile = artifact_path(base_name(path), fmt)
+    with open(outfile, 'wb') as fh:
+        fh.write(body)
+    remove(path, keep=outfile)
+    return outfile
+
+
+def write_json(path, data, fmt='plain'):
+    """Writes data as the artifact path in the given format. Returns the
+    name of the file written."""
+    return write_bytes(path, encode(data, fmt), fmt)
+
+
+def remove(path, keep=None):
+    """Removes the artifact path in every format, except the file keep"""
+    base = base_name(path)
+    for f in (base, base + GZIP_SUFFIX):
+        if f != keep and os.path.exists(f):
+            os.unlink(f)
+
+
+def read_bytes(path):
+    """Returns the JSON text (bytes) of an artifact in any format"""
+    with open(path, 'rb') as fh:
+        body = fh.read()
+    if body[:2] == GZIP_MAGIC:
+        return gzip.decompress(body)
+    return body
+
+
+def load_json(path):
+    """Returns the data of an artifact in any format"""
+    return json.loads(read_bytes(path).decode('utf-8'))
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+
+"""
+Index the milestones of a directory of TEI-XML witness files in a single
+pass: for each file, the milestones it contains, where each one starts (line
+and word offset) and roughly how many words it has. The index is kept in a
+JSON file and refreshed by file hash, so that only new and changed files
+are parsed again.
+
+teixml2collatex.py and pipeline.py use it to tokenize a milestone only in
+the files that contain it, and to find the milestones to collate when the
+config module lists none. The order of the milestones is the order in
+which they appear in the witnesses.
+"""
+
+import argparse
+import fnmatch
+import heapq
+import json
+import logging
+import os
+import sys
+import tempfile
+
+from lxml import etree
+
+from filecache import file_hash
+
+TEI_NS = {'t': 'http://www.tei-c.org/ns/1.0'}
+BODY_XPATH = '//t:text/t:body'
+ID_XPATH = '//t:msDesc/@xml:id'
+MILESTONE_TAG = '{%s}milestone' % TEI_NS['t']
+# Text that is not part of the main witness
+SKIP_TAGS = set(['{%s}del' % TEI_NS['t']])
+VERSION = 1
+
+
+def index_file(path):
+    """Returns the sigil of a witness file and the list of its milestones in
+    the order they appear, each a dictionary of its name n, the line it is
+    on, the number of words before it, and the number of words up to the
+    next milestone. Deleted text is not counted. Raises
+    etree.XMLSyntaxError or OSError if the file cannot be read."""
+    xmldoc = etree.parse(path)
+    sigil = xmldoc.xpath(ID_XPATH, namespaces=TEI_NS)
+    found = []
+    byname = dict()
+    current = None
+    words = 0
+    skip = 0
+
+    def count(text):
+        nonlocal words
+        if not text or skip:
+            return
+        n = len(text.split())
+        words += n
+        if current is not None:
+            current['words'] += n
+
+    for body in xmldoc.xpath(BODY_XPATH, namespaces=TEI_NS):
+        for (event, el) in etree.iterwalk(body, events=('start', 'end')):
+            if event == 'start':
+                if el.tag == MILESTONE_TAG and el.get('n') is not None:
+                    # A milestone that is there twice goes on where it was
+                    current = byname.get(el.get('n'))
+                    if current is None:
+                        current = dict(n=el.get('n'), line=el.sourceline, start=words, words=0)
+                        byname[current['n']] = current
+                        found.append(current)
+                if el.tag in SKIP_TAGS:
+                    skip += 1
+                # Comments and processing instructions have no text of ours
+                if isinstance(el.tag, str):
+                    count(el.text)
+            else:
+                if el.tag in SKIP_TAGS:
+                    skip -= 1
+                if el is not body:
+                    count(el.tail)
+    return (sigil[0] if sigil else None, found)
+
+
+def merge_orders(sequences):
+    """Returns the items of all sequences in one order that keeps the order
+    of each, as far as they agree; ties, and items the sequences disagree
+    on, go by where they were first seen"""
+    rank = dict()
+    follows = dict()
+    preceded = dict()
+    for seq in sequences:
+        for (i, item) in enumerate(seq):
+            if item not in rank:
+                rank[item] = len(rank)
+                follows[item] = set()
+                preceded[item] = 0
+            if i > 0 and item not in follows[seq[i - 1]] and item != seq[i - 1]:
+                follows[seq[i - 1]].add(item)
+                preceded[item] += 1
+
+    order = []
+    ready = [(rank[item], item) for item in rank if preceded[item] == 0]
+    heapq.heapify(ready)
+    while len(order) < len(rank):
+        if not ready:
+            # The sequences contradict each other; break the cycle at the
+            # item seen first
+            item = min((i for i in rank if preceded[i] > 0), key=lambda i: rank[i])
+            preceded[item] = 0
+            heapq.heappush(ready, (rank[item], item))
+        (_, item) = heapq.heappop(ready)
+        order.append(item)
+        for after in follows[item]:
+            if preceded[after] > 0:
+                preceded[after] -= 1
+                if preceded[after] == 0:
+                    heapq.heappush(ready, (rank[after], after))
+        preceded[item] = -1
+    return order
+
+
+class Catalog(object):
+    """The milestone index of the files in a directory. If path is given,
+    the index is read from there and save() writes it back."""
+
+    def __init__(self, path=None):
+        self.path = path
+        self.files = dict()
+        if path is not None and os.path.exists(path):
+            with open(path, encoding='utf-8') as fh:
+                data = json.load(fh)
+            if data.get('version') == VERSION:
+                self.files = data.get('files', dict())
+
+    def refresh(self, indir, files=None, hasher=None):
+        """Brings the index up to date with the given files in indir (default:
+        all XML files there); entries of other files are dropped. A file is
+        parsed again only if its hash changed, and hashed again only if its
+        size or modification time changed, unless hasher (a function of the
+        path) is given to do the hashing. Returns the number of files
+        parsed."""
+        if files is None:
+            files = sorted(fnmatch.filter(os.listdir(indir), '*.xml'))
+        parsed = 0
+        entries = dict()
+        for infile in files:
+            path = os.path.join(indir, infile)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entry = self.files.get(infile)
+            stat = [st.st_mtime_ns, st.st_size]
+            if entry is not None and hasher is None and entry.get('stat') == stat:
+                entries[infile] = entry
+                continue
+            digest = hasher(path) if hasher is not None else file_hash(path)
+            if entry is None or entry.get('hash') != digest:
+                entry = dict(hash=digest)
+                try:
+                    (entry['sigil'], entry['milestones']) = index_file(path)
+                except (etree.XMLSyntaxError, OSError) as e:
+                    logging.error('cannot index <%s>: %s' % (path, e))
+                    (entry['sigil'], entry['milestones']) = (None, [])
+                    entry['error'] = str(e)
+                parsed += 1
+            entry['stat'] = stat
+            entries[infile] = entry
+        self.files = entries
+        return parsed
+
+    def save(self):
+        if self.path is None:
+            return
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        (fd, tmppath) = tempfile.mkstemp(dir=directory)
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as fh:
+                json.dump(dict(version=VERSION, files=self.files), fh,
+                          ensure_ascii=False, indent=1, sort_keys=True)
+            os.replace(tmppath, self.path)
+        except BaseException:
+            os.unlink(tmppath)
+            raise
+
+    def milestones(self, files=None):
+        """Returns the names of the milestones in the given files (default:
+        all of them), in the order they appear in the witnesses"""
+        return merge_orders([[m['n'] for m in self.files[f]['milestones']]
+                             for f in self._files(files)])
+
+    def contains(self, infile, milestone):
+        """Whether the file contains the milestone; files that are not in
+        the index may"""
+        entry = self.files.get(infile)
+        if entry is None:
+            return True
+        return any(m['n'] == milestone for m in entry['milestones'])
+
+    def files_with(self, milestone, files=None):
+        """Returns those of the given files (default: all of them) that
+        contain the milestone"""
+        return [f for f in self._files(files) if self.contains(f, milestone)]
+
+    def summary(self, files=None):
+        """Returns a list of (milestone, number of witnesses, total number of
+        words) in the order of milestones()"""
+        witnesses = dict()
+        words = dict()
+        for f in self._files(files):
+            for m in self.files[f]['milestones']:
+                witnesses[m['n']] = witnesses.get(m['n'], 0) + 1
+                words[m['n']] = words.get(m['n'], 0) + m['words']
+        return [(n, witnesses[n], words[n]) for n in self.milestones(files)]
+
+    def _files(self, files):
+        if files is None:
+            return sorted(self.files)
+        return [f for f in files if f in self.files]
+
+
+def main(args):
+    catalog = Catalog(args.catalog or os.path.join(args.indir, '.milestone-catalog.json'))
+    parsed = catalog.refresh(args.indir)
+    catalog.save()
+    print('%d files, %d indexed again, %d milestones' % (
+        len(catalog.files), parsed, len(catalog.milestones())))
+    if args.list:
+        for (milestone, witnesses, words) in catalog.summary():
+            print('%s\t%d witnesses\t~%d words' % (milestone, witnesses, words))
+    failed = sorted(f for (f, entry) in catalog.files.items() if entry.get('error'))
+    if failed:
+        print('could not index: %s' % ' '.join(failed), file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n\n')[0])
+    parser.add_argument(
+        "indir",
+        help="directory of TEI-XML files, i.e. transcription/tei-xml/",
+    )
+    parser.add_argument(
+        "--catalog",
+        help="file to keep the index in (default INDIR/.milestone-catalog.json)",
+    )
+    parser.add_argument(
+        "-l",
+        "--list",
+        action="store_true",
+        help="list the milestones with their number of witnesses and words",
+    )
+
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format='%(asctime)s %(message)s',
+        filename='%s.log' % os.path.basename(sys.argv[0]),
+        level=logging.WARNING,
+    )
+    sys.exit(main(args))
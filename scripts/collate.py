@@ -0,0 +1,450 @@
+#!/usr/bin/env python3
+
+"""
+Collate tokenized milestone files with CollateX, several at a time and each
+with a time limit, reusing the stored result for every milestone whose
+token input has not changed. In batch mode a single CollateX JVM serves
+all the milestones over HTTP.
+
+The milestone files may be plain, compact or gzip-compressed JSON (see
+artifacts.py), and the collations are written in the format asked for.
+"""
+
+import argparse
+import concurrent.futures
+import contextlib
+import datetime
+import fnmatch
+import http.client
+import json
+import logging
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import zipfile
+
+import artifacts
+from filecache import FileCache, file_hash, make_key
+
+COLLATEX_JAR = '/root/collatex.jar'
+COLLATEX_ARGS = ['--tokenized', '--format', 'json']
+TIMEOUT = 1000
+STARTUP_TIMEOUT = 120
+
+
+def milestone_files(indir):
+    """Returns the sorted list of tokenized milestone files in indir, in
+    whatever format they are written"""
+    files = dict()
+    for f in sorted(os.listdir(indir), reverse=True):
+        if fnmatch.fnmatch(f, 'milestone-*.json') or fnmatch.fnmatch(f, 'milestone-*.json.gz'):
+            # Should a milestone be there twice, the plain file wins
+            files[artifacts.base_name(f)] = f
+    return sorted(files.values())
+
+
+def output_file(outdir, infile, fmt='plain'):
+    """Returns the file in outdir that the collation of the milestone file
+    infile is written to in the given format"""
+    return artifacts.artifact_path(os.path.join(outdir, artifacts.base_name(infile)), fmt)
+
+
+def collatex_version(jar):
+    """Returns a string that identifies the given CollateX build: its
+    declared version, plus the hash of the JAR since snapshot builds share
+    a version number"""
+    version = None
+    try:
+        with zipfile.ZipFile(jar) as zf:
+            props = zf.read('META-INF/maven/eu.interedition/collatex-tools/pom.properties')
+        for line in props.decode('utf-8').splitlines():
+            if line.startswith('version='):
+                version = line[len('version='):]
+    except (KeyError, zipfile.BadZipFile):
+        pass
+    return '%s:%s' % (version, file_hash(jar))
+
+
+def token_hash(infile):
+    """Returns a hash of the token JSON in infile that does not depend on
+    how the file is formatted"""
+    return make_key(artifacts.load_json(infile))
+
+
+def collatex_command(jar, infile, outfile):
+    return ['java', '-jar', jar] + COLLATEX_ARGS + [infile, '--output', outfile]
+
+
+@contextlib.contextmanager
+def plain_input(infile):
+    """Yields the name of a file with the JSON of the milestone file infile
+    that CollateX can read: infile itself, or a decompressed copy of it"""
+    with open(infile, 'rb') as fh:
+        compressed = fh.read(2) == artifacts.GZIP_MAGIC
+    if not compressed:
+        yield infile
+        return
+    (fd, tmppath) = tempfile.mkstemp(suffix='.json')
+    try:
+        with os.fdopen(fd, 'wb') as fh:
+            fh.write(artifacts.read_bytes(infile))
+        yield tmppath
+    finally:
+        os.unlink(tmppath)
+
+
+class CollationServer(object):
+    """A long-lived CollateX JVM running the CollateX HTTP service. The JVM
+    is restarted if it crashes, or if a collation on it times out.
+
+    CollateX binds its service to all interfaces; we only ever talk to it
+    over localhost, on a free port picked at startup."""
+
+    def __init__(self, jar, parallel=1, startup_timeout=STARTUP_TIMEOUT):
+        self.jar = jar
+        self.parallel = parallel
+        self.startup_timeout = startup_timeout
+        self.proc = None
+        self.port = None
+        self.generation = 0
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            self._start()
+
+    def stop(self):
+        with self._lock:
+            self._stop()
+
+    def restart(self, generation):
+        """Restarts the JVM, unless another thread already restarted it since
+        the given generation was current"""
+        with self._lock:
+            if generation == self.generation:
+                self._stop()
+                self._start()
+
+    def endpoint(self):
+        """Returns the generation of the running JVM and the port it serves
+        on. While the JVM is being restarted, this waits until the new one
+        accepts connections."""
+        with self._lock:
+            return (self.generation, self.port)
+
+    def collate(self, infile, outfile, timeout=None):
+        """Collates a single milestone file into outfile. Returns 'collated',
+        'timeout' or 'failed'."""
+        collation = artifacts.load_json(infile)
+        # This is what --tokenized does on the command line
+        collation['joined'] = False
+        body = json.dumps(collation, ensure_ascii=False).encode('utf-8')
+
+        # If the JVM went away, try once more on a fresh one. A collation
+        # that was cut off because another thread restarted the JVM is not
+        # the fault of this milestone, and doesn't count as a try.
+        tries = 0
+        while tries < 2:
+            (generation, port) = self.endpoint()
+            request = urllib.request.Request(
+                'http://127.0.0.1:%s/collate' % port,
+                data=body,
+                headers={
+                    'Content-Type': 'application/json; charset=utf-8',
+                    'Accept': 'application/json',
+                })
+            try:
+                with urllib.request.urlopen(request, timeout=timeout) as res:
+                    data = res.read()
+            except urllib.error.HTTPError as e:
+                logging.error('CollateX failed on <%s> with HTTP status %s' % (infile, e.code))
+                return 'failed'
+            except (urllib.error.URLError, http.client.HTTPException, OSError) as e:
+                if self.endpoint()[0] != generation:
+                    logging.info('CollateX was restarted while collating <%s>; trying again' % infile)
+                    continue
+                if isinstance(e, TimeoutError) or isinstance(getattr(e, 'reason', None), TimeoutError):
+                    logging.error('CollateX took longer than %s seconds on <%s>; restarting it' % (
+                        timeout, infile))
+                    self.restart(generation)
+                    return 'timeout'
+                logging.error('lost the CollateX server while collating <%s> (%s); restarting it' % (
+                    infile, e))
+                self.restart(generation)
+                tries += 1
+                continue
+
+            with open(outfile, 'wb') as fh:
+                fh.write(data)
+            return 'collated'
+        return 'failed'
+
+    def _start(self):
+        port = free_port()
+        cmd = ['java', '-jar', self.jar,
+               '--http',
+               '--port', str(port),
+               '--max-parallel-collations', str(self.parallel)]
+        logging.info('starting %s' % ' '.join(cmd))
+        # The service logs every request on stdout, which we don't need
+        self.proc = subprocess.Popen(cmd, start_new_session=True, stdout=subprocess.DEVNULL)
+
+        # Wait until the service accepts connections; only then is it the
+        # one that collate() sends milestones to
+        deadline = time.monotonic() + self.startup_timeout
+        while True:
+            if self.proc.poll() is not None:
+                raise RuntimeError('CollateX server exited with return code %s' % self.proc.returncode)
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    self._stop()
+                    raise RuntimeError('CollateX server did not start within %s seconds' % (
+                        self.startup_timeout))
+                time.sleep(0.2)
+        self.port = port
+        self.generation += 1
+
+    def _stop(self):
+        if self.proc is None:
+            return
+        if self.proc.poll() is None:
+            os.killpg(self.proc.pid, signal.SIGKILL)
+        self.proc.wait()
+        self.proc = None
+
+
+def free_port():
+    """Returns a TCP port on localhost that is free right now"""
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def collate(infile, outfile, jar=COLLATEX_JAR, cache=None, version=None, timeout=None,
+            server=None, fmt='plain'):
+    """Collates a single milestone file into outfile (see output_file()) in
+    the format fmt, on the given CollationServer or else with a CollateX
+    process of its own. If cache is given, a stored result for the same
+    tokens and CollateX version is used instead of running CollateX. If
+    CollateX runs longer than timeout seconds, it is killed. Returns
+    'cached', 'collated', 'timeout' or 'failed'."""
+    key = None
+    if cache is not None:
+        # The cache holds the output of CollateX as it is
+        key = make_key(token_hash(infile), version, COLLATEX_ARGS)
+        data = cache.get(key)
+        if data is not None:
+            artifacts.write_bytes(outfile, artifacts.recode(data, fmt), fmt)
+            return 'cached'
+
+    # Make sure we don't mistake an old result for a new one
+    artifacts.remove(outfile)
+
+    # CollateX writes plain JSON, which is converted afterwards
+    rawfile = artifacts.base_name(outfile)
+    if server is not None:
+        outcome = server.collate(infile, rawfile, timeout)
+    else:
+        with plain_input(infile) as plainfile:
+            outcome = run_collatex(jar, plainfile, rawfile, timeout)
+
+    if outcome == 'collated' and (cache is not None or fmt != 'plain'):
+        with open(rawfile, 'rb') as fh:
+            data = fh.read()
+        if cache is not None:
+            cache.put(key, data)
+        if fmt != 'plain':
+            artifacts.write_bytes(outfile, artifacts.recode(data, fmt), fmt)
+    return outcome
+
+
+def run_collatex(jar, infile, outfile, timeout=None):
+    """Runs a CollateX process on a single milestone file. Returns
+    'collated', 'timeout' or 'failed'."""
+    cmd = collatex_command(jar, infile, outfile)
+    logging.info('running %s' % ' '.join(cmd))
+
+    # Run the JVM in its own process group, so that all of it can be killed
+    proc = subprocess.Popen(cmd, start_new_session=True)
+    try:
+        returncode = proc.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        logging.error('CollateX took longer than %s seconds on <%s>; killing it' % (timeout, infile))
+        os.killpg(proc.pid, signal.SIGKILL)
+        proc.wait()
+        if os.path.exists(outfile):
+            os.unlink(outfile)
+        return 'timeout'
+
+    if returncode or not os.path.exists(outfile):
+        logging.error('CollateX failed on <%s> with return code %s' % (infile, returncode))
+        return 'failed'
+    return 'collated'
+
+
+def timed_collate(*args, **kwa):
+    """Runs collate() and returns a tuple of its outcome and the wall time
+    it took"""
+    start = time.monotonic()
+    outcome = collate(*args, **kwa)
+    return (outcome, time.monotonic() - start)
+
+
+def main(args):
+    jar = os.path.expanduser(args.jar)
+    cache = None
+    version = None
+    if args.cache is not None:
+        cache = FileCache(args.cache, args.cache_size * 1024 * 1024)
+        version = collatex_version(jar)
+
+    if not os.path.exists(args.outdir):
+        os.makedirs(args.outdir)
+
+    server = None
+    if args.batch:
+        server = CollationServer(jar, args.jobs)
+        server.start()
+    try:
+        outcomes = collate_all(args, jar, cache, version, server)
+    finally:
+        if server is not None:
+            server.stop()
+
+    if cache is not None:
+        print(cache.report('collation cache'))
+        logging.info(cache.report('collation cache'))
+
+    # A milestone that timed out is left out of the result, but only a
+    # CollateX error counts as a failure of the run
+    timedout = sorted([f for f, o in outcomes.items() if o == 'timeout'])
+    failed = sorted([f for f, o in outcomes.items() if o == 'failed'])
+    if timedout:
+        print('timed out: %s' % ' '.join(timedout), file=sys.stderr)
+    if failed:
+        print('failed: %s' % ' '.join(failed), file=sys.stderr)
+        return 1
+    return 0
+
+
+def collate_all(args, jar, cache, version, server):
+    """Collates every milestone file in args.indir on a pool of args.jobs
+    threads, printing a line for each as it finishes. Returns a dictionary
+    of milestone file -> outcome."""
+
+    # Start the biggest milestones first, so that a long one doesn't end up
+    # running on its own at the end
+    infiles = sorted(
+        milestone_files(args.indir),
+        key=lambda f: os.path.getsize(os.path.join(args.indir, f)),
+        reverse=True,
+    )
+
+    # Each worker thread only waits for CollateX, so threads are enough to
+    # keep up to args.jobs collations going
+    outcomes = dict()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        futures = dict()
+        for infile in infiles:
+            future = executor.submit(
+                timed_collate,
+                os.path.join(args.indir, infile),
+                output_file(args.outdir, infile, args.format),
+                jar=jar,
+                cache=cache,
+                version=version,
+                timeout=args.timeout or None,
+                server=server,
+                fmt=args.format,
+            )
+            futures[future] = infile
+
+        for future in concurrent.futures.as_completed(futures):
+            infile = futures.get(future)
+            try:
+                (outcome, walltime) = future.result()
+            except Exception:
+                logging.exception('error collating <%s>' % infile)
+                (outcome, walltime) = ('failed', 0)
+            outcomes[infile] = outcome
+            print("{}: {} {} in {:.1f}s".format(
+                datetime.datetime.now().strftime("%a, %d %b %Y %H:%M:%S %z"),
+                infile,
+                outcome,
+                walltime,
+            ))
+    return outcomes
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "indir",
+        help="input directory of tokenized milestone files",
+    )
+    parser.add_argument(
+        "outdir",
+        help="output directory for the collations",
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="store_true",
+        help="log every CollateX command line",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="number of CollateX processes to run at once (default 1)",
+    )
+    parser.add_argument(
+        "-t",
+        "--timeout",
+        type=int,
+        default=TIMEOUT,
+        help="seconds after which a CollateX process is killed, or 0 for no limit (default %s)" % TIMEOUT,
+    )
+    parser.add_argument(
+        "-b",
+        "--batch",
+        action="store_true",
+        help="start CollateX only once, as an HTTP service, and send it every milestone",
+    )
+    parser.add_argument(
+        "--jar",
+        default=COLLATEX_JAR,
+        help="location of the CollateX JAR file (default %s)" % COLLATEX_JAR,
+    )
+    parser.add_argument(
+        "--cache",
+        help="directory in which to keep collation results between runs",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=1024,
+        help="size limit of the collation cache in MB (default 1024)",
+    )
+    artifacts.add_arguments(parser)
+
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format='%(asctime)s %(message)s',
+        filename='%s.log' % os.path.basename(sys.argv[0]),
+        level=logging.INFO if args.verbose else logging.WARNING,
+    )
+    sys.exit(main(args))
@@ -0,0 +1,141 @@
+"""
+A content-addressed store of files on disk, bounded in size, which the
+pipeline scripts use to reuse the results of expensive steps whose inputs
+have not changed.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+
+def file_hash(path):
+    """Returns the SHA-256 hex digest of the content of a file"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def make_key(*parts):
+    """Returns a cache key for the given JSON-serialisable parts"""
+    return hashlib.sha256(
+        json.dumps(parts, ensure_ascii=False, sort_keys=True).encode('utf-8')
+    ).hexdigest()
+
+
+class FileCache(object):
+    """A directory of cache entries, each stored in a file named for its key.
+    If max_size (in bytes) is given, the least recently used entries are
+    evicted whenever the total size of the cache grows beyond it. A cache
+    may be shared between threads."""
+
+    def __init__(self, cachedir, max_size=None):
+        self.cachedir = cachedir
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # path -> (last use, size); only kept if we have a size bound
+        self._index = None
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the content stored under key, or None"""
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as fh:
+                data = fh.read()
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        # Mark the entry as recently used
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        with self._lock:
+            self.hits += 1
+            if self._index is not None and path in self._index:
+                self._index[path] = (time.time(), self._index[path][1])
+        return data
+
+    def put(self, key, data):
+        """Stores data (bytes) under key, replacing any existing entry"""
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Write to a temporary file first, so that readers never see a
+        # partial entry
+        (fd, tmppath) = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as fh:
+                fh.write(data)
+            os.replace(tmppath, path)
+        except BaseException:
+            os.unlink(tmppath)
+            raise
+
+        if self.max_size is not None:
+            with self._lock:
+                self._load_index()
+                if path in self._index:
+                    self._size -= self._index[path][1]
+                self._index[path] = (time.time(), len(data))
+                self._size += len(data)
+                self._evict()
+
+    def get_json(self, key):
+        """Returns the JSON value stored under key, or None"""
+        data = self.get(key)
+        if data is None:
+            return None
+        return json.loads(data.decode('utf-8'))
+
+    def put_json(self, key, value):
+        """Stores a JSON-serialisable value under key"""
+        self.put(key, json.dumps(value, ensure_ascii=False).encode('utf-8'))
+
+    def report(self, name='cache'):
+        """Returns a one-line summary of this run's cache usage"""
+        return '%s: %d hits, %d misses, %d evicted' % (
+            name, self.hits, self.misses, self.evictions)
+
+    def _path(self, key):
+        return os.path.join(self.cachedir, key[:2], key)
+
+    def _load_index(self):
+        if self._index is not None:
+            return
+        self._index = dict()
+        self._size = 0
+        for (dirpath, dirnames, filenames) in os.walk(self.cachedir):
+            for f in filenames:
+                path = os.path.join(dirpath, f)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                self._index[path] = (st.st_mtime, st.st_size)
+                self._size += st.st_size
+
+    def _evict(self):
+        if self._size <= self.max_size:
+            return
+        for path in sorted(self._index, key=lambda p: self._index[p][0]):
+            if self._size <= self.max_size:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            self._size -= self._index.pop(path)[1]
+            self.evictions += 1
@@ -0,0 +1,191 @@
+"""
+Resource instrumentation for the pipeline scripts and backup.py: wall
+time, CPU time and peak memory of the whole run and of each file,
+manuscript, project or milestone it works on, summed up at the end of the
+run and optionally written as a JSON report, and optionally a cProfile
+dump of the run.
+
+A script adds the options with add_arguments() and wraps its work in
+
+    with instrument.run('json2xml', args) as recorder:
+        ...
+        with recorder.measure('file', infile):
+            ...
+
+Work done in a worker process is measured there with measure_call() and
+handed to recorder.add().
+"""
+
+import contextlib
+import cProfile
+import datetime
+import json
+import logging
+import os
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+
+
+def add_arguments(parser):
+    """Adds the --report, --profile and --trace-memory options to an
+    argument parser"""
+    parser.add_argument(
+        "--report",
+        help="file to write the JSON run report to",
+    )
+    parser.add_argument(
+        "--profile",
+        help="file to write cProfile statistics of the main process to",
+    )
+    parser.add_argument(
+        "--trace-memory",
+        action="store_true",
+        help="record the peak Python heap of each item with tracemalloc; slows the run down",
+    )
+
+
+def _snapshot():
+    return (time.perf_counter(), time.thread_time())
+
+
+def _measurement(start):
+    """Returns the measurement of the work since start, a _snapshot()"""
+    (wall, cpu) = _snapshot()
+    result = dict(
+        wall=round(wall - start[0], 6),
+        cpu=round(cpu - start[1], 6),
+        # The high-water mark of the process so far, in KB
+        maxrss_kb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    )
+    if tracemalloc.is_tracing():
+        result['traced_peak_kb'] = tracemalloc.get_traced_memory()[1] // 1024
+    return result
+
+
+def measure_call(fn, *args, **kwa):
+    """Calls fn and returns a tuple of its result and the measurement of the
+    call, to be handed to Recorder.add() in the process that owns the
+    recorder. Meant for worker processes, which handle one call at a
+    time."""
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+    start = _snapshot()
+    result = fn(*args, **kwa)
+    return (result, _measurement(start))
+
+
+class Recorder(object):
+    """The measurements of one run of a script. Items are grouped by kind
+    ('file', 'milestone', ...) and named; for each one the wall time, the
+    CPU time of the thread that did the work, and the peak RSS of the
+    process so far are recorded. With tracemalloc running, the peak of the
+    traced Python heap during the item is recorded as well; if items
+    overlap in threads, that peak covers all of them. A recorder may be
+    shared between threads."""
+
+    def __init__(self, name=None):
+        self.name = name
+        self.items = dict()
+        self.started = datetime.datetime.now()
+        self._start = time.perf_counter()
+        self._cpu = time.process_time()
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def measure(self, kind, item):
+        """Measures the work done in the with block as the given item"""
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+        start = _snapshot()
+        try:
+            yield
+        finally:
+            self.add(kind, item, _measurement(start))
+
+    def add(self, kind, item, measurement):
+        """Records a measurement taken elsewhere, e.g. by measure_call()"""
+        with self._lock:
+            self.items.setdefault(kind, dict())[item] = measurement
+
+    def report(self):
+        """Returns the report of the run so far as a dictionary"""
+        own = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        report = dict(
+            script=self.name,
+            argv=sys.argv,
+            started=self.started.isoformat(timespec='seconds'),
+            wall=round(time.perf_counter() - self._start, 6),
+            cpu=round(time.process_time() - self._cpu, 6),
+            # Worker processes, once they have exited
+            cpu_children=round(children.ru_utime + children.ru_stime, 6),
+            maxrss_kb=own.ru_maxrss,
+            maxrss_children_kb=children.ru_maxrss,
+            items=self.items,
+            totals=dict(),
+        )
+        if tracemalloc.is_tracing():
+            report['traced_peak_kb'] = tracemalloc.get_traced_memory()[1] // 1024
+        for (kind, items) in self.items.items():
+            slowest = max(items, key=lambda i: items[i]['wall'])
+            report['totals'][kind] = dict(
+                count=len(items),
+                wall=round(sum(m['wall'] for m in items.values()), 6),
+                cpu=round(sum(m['cpu'] for m in items.values()), 6),
+                slowest=slowest,
+                slowest_wall=items[slowest]['wall'],
+            )
+        return report
+
+    def summary(self):
+        """Returns a one-line summary of the run so far"""
+        report = self.report()
+        parts = ['%s: %.1fs wall, %.1fs CPU (%.1fs in workers), %d MB peak RSS' % (
+            self.name, report['wall'], report['cpu'], report['cpu_children'],
+            max(report['maxrss_kb'], report['maxrss_children_kb']) // 1024)]
+        for (kind, totals) in sorted(report['totals'].items()):
+            parts.append('%d %ss, slowest %s in %.1fs' % (
+                totals['count'], kind, totals['slowest'], totals['slowest_wall']))
+        return '; '.join(parts)
+
+    def write(self, path):
+        with open(path, 'w', encoding='utf-8') as fh:
+            json.dump(self.report(), fh, ensure_ascii=False, indent=2, sort_keys=True)
+
+
+@contextlib.contextmanager
+def run(name, args):
+    """Yields a Recorder for the run of a script, set up from the options
+    that add_arguments() added. When the block exits, even by sys.exit(),
+    the run summary is logged and printed to stderr, with --report the
+    report is written, and with --profile the cProfile statistics are
+    dumped."""
+    # Resolved now, in case the script changes directory
+    report = getattr(args, 'report', None)
+    report = report and os.path.abspath(report)
+    profile = getattr(args, 'profile', None)
+    profile = profile and os.path.abspath(profile)
+
+    if getattr(args, 'trace_memory', False):
+        tracemalloc.start()
+    profiler = None
+    if profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    recorder = Recorder(name)
+    try:
+        yield recorder
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(profile)
+        if report:
+            recorder.write(report)
+        summary = recorder.summary()
+        logging.info(summary)
+        print(summary, file=sys.stderr)
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
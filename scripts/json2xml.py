@@ -5,16 +5,26 @@ Wrapper for tpen2tei.json2xml
 """
 
 import argparse
+import concurrent.futures
 import copy
 import fnmatch
 import importlib
+import importlib.metadata
+import importlib.util
 import json
 import logging
 import os
 import sys
+import tempfile
 import traceback
 from tpen2tei.parse import from_sc
 
+from filecache import file_hash
+import instrument
+
+# Hashes of the inputs of each TEI-XML file, kept in the output directory
+BUILD_MANIFEST = '.json2xml-build.json'
+
 
 def metadata(configmod):
     """Return a dictionary suitable for the 'metadata' parameter to from_sc."""
@@ -60,14 +70,37 @@ def postprocess(configmod):
     return None
 
 
+def load_hooks(configmod):
+    """Return the keyword arguments for from_sc that the config module defines"""
+    return dict(
+        metadata=metadata(configmod),                 # wants a dict or None
+        special_chars=special_chars(configmod),       # wants a dict or None
+        numeric_parser=numeric_parser(configmod),     # wants a function or None
+        text_filter=transcription_filter(configmod),  # wants a function or None
+        postprocess=postprocess(configmod),           # wants a function or None
+    )
+
+
 def json2xml(indir, outdir,
              metadata=None,
              special_chars=None,
              numeric_parser=None,
              text_filter=None,
-             postprocess=None):
+             postprocess=None,
+             jobs=None,
+             configmod=None,
+             force=False,
+             recorder=None):
     """ json2xml assumes all files in indir to be T-PEN output
-        and tries to convert them to TEI-XML in outdir"""
+        and tries to convert them to TEI-XML in outdir
+
+        If jobs is given, the files are converted on a pool of that many
+        worker processes, which are given the hooks once each.
+
+        Files whose input, members.json and config module (configmod) are
+        unchanged since their TEI-XML was last built are skipped, unless
+        force is set. The conversion of each file is measured in recorder,
+        an instrument.Recorder, if one is given."""
 
     # Find the members file, if it exists in indir
     transcriptions = []
@@ -79,43 +112,166 @@ def json2xml(indir, outdir,
         else:
             transcriptions.append(infile)
 
+    # Work out which files need converting
+    manifest = dict() if force else load_manifest(outdir)
+    shared = shared_inputs(indir, configmod)
+    inputs = dict()
+    todo = []
+    for infile in transcriptions:
+        inputs[infile] = dict(shared, input=file_hash(os.path.join(indir, infile)))
+        if (manifest.get(infile + '.tei.xml') != inputs.get(infile)
+                or not os.path.exists(os.path.join(outdir, infile + '.tei.xml'))):
+            todo.append(infile)
+    logging.info('%d of %d files unchanged, skipping them' % (
+        len(transcriptions) - len(todo), len(transcriptions)))
+
     # Now go through the transcription files
+    hooks = dict(
+        metadata=metadata,
+        special_chars=special_chars,
+        numeric_parser=numeric_parser,
+        text_filter=text_filter,
+        postprocess=postprocess,
+    )
+    results = convert_files(indir, outdir, todo, members, hooks, jobs, recorder)
+
+    # Remember what the files were built from; failed ones are tried again next time
+    built = dict()
     for infile in transcriptions:
         outfile = infile + '.tei.xml'
-        
-        with open(indir + '/' + infile, 'r') as fh:
-            data = json.load(fh)
+        if results.get(infile) or (infile not in todo and outfile in manifest):
+            built[outfile] = inputs.get(infile)
+    save_manifest(outdir, built)
 
-            try:
-                logging.info('starting on file <%s>' % infile)
-
-                tei = from_sc(
-                    data,
-                    # from_sc will modify the supplied param metadata
-                    # which would stick without deepcopy'ing every turn
-                    metadata=copy.deepcopy(metadata),
-                    members=members,
-                    special_chars=special_chars,
-                    numeric_parser=numeric_parser,
-                    text_filter=text_filter,
-                    postprocess=postprocess
-                )
-
-                # just ignore tei==None
-                if tei:
-                    tei.write(
-                        outdir + '/' + outfile,
-                        encoding='utf8',
-                        pretty_print=True,
-                        xml_declaration=True
-                    )
-
-                    logging.info('file <%s> looks good' % infile)
-                else:
-                    logging.error('error with file <%s>: tpen2tei.parse.from_sc did not return anything' % infile)
 
+def convert_files(indir, outdir, infiles, members, hooks, jobs=None, recorder=None):
+    """Convert the given files in indir with convert(), here or on a pool of
+    jobs worker processes, measuring each file in recorder. Returns a dict of
+    file -> whether it was converted."""
+    recorder = recorder or instrument.Recorder()
+    if not jobs:
+        results = dict()
+        for infile in infiles:
+            with recorder.measure('file', infile):
+                results[infile] = convert(indir, outdir, infile, members, hooks)
+        return results
+
+    results = dict()
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=jobs,
+            initializer=_init_worker,
+            initargs=(list(sys.path), hooks, members)) as executor:
+        futures = [(infile, executor.submit(_convert_worker, indir, outdir, infile))
+                   for infile in infiles]
+        for infile, future in futures:
+            try:
+                (results[infile], measurement) = future.result()
+                recorder.add('file', infile, measurement)
             except Exception:
                 logging.error('error with file <%s>: %s\n' % (infile, traceback.format_exc()))
+                results[infile] = False
+    return results
+
+
+def shared_inputs(indir, configmod):
+    """Return the hashes of what all the TEI-XML output depends on besides
+    its own input file"""
+    members = os.path.join(indir, 'members.json')
+    config = None
+    if configmod is not None:
+        spec = importlib.util.find_spec(configmod)
+        if spec is not None and spec.origin and os.path.exists(spec.origin):
+            config = file_hash(spec.origin)
+    try:
+        version = importlib.metadata.version('tpen2tei')
+    except importlib.metadata.PackageNotFoundError:
+        version = None
+    return dict(
+        members=file_hash(members) if os.path.exists(members) else None,
+        config=config,
+        tpen2tei=version,
+    )
+
+
+def load_manifest(outdir):
+    """Return the build manifest in outdir: TEI-XML file -> hashes of its inputs"""
+    try:
+        with open(os.path.join(outdir, BUILD_MANIFEST), encoding='utf-8') as fh:
+            return json.load(fh)
+    except (FileNotFoundError, ValueError):
+        return dict()
+
+
+def save_manifest(outdir, manifest):
+    path = os.path.join(outdir, BUILD_MANIFEST)
+    (fd, tmppath) = tempfile.mkstemp(dir=outdir)
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as fh:
+            json.dump(manifest, fh, ensure_ascii=False, indent=2, sort_keys=True)
+        os.chmod(tmppath, 0o644)
+        os.replace(tmppath, path)
+    except BaseException:
+        os.unlink(tmppath)
+        raise
+
+
+_worker_members = None
+_worker_hooks = None
+
+
+def _init_worker(path, hooks, members):
+    global _worker_members, _worker_hooks
+    sys.path[:] = path
+    _worker_members = members
+    _worker_hooks = hooks
+
+
+def _convert_worker(indir, outdir, infile):
+    return instrument.measure_call(
+        convert, indir, outdir, infile, _worker_members, _worker_hooks)
+
+
+def convert(indir, outdir, infile, members, hooks):
+    """ convert a single T-PEN file in indir to TEI-XML in outdir,
+        calling from_sc with the given members and hooks; returns whether
+        a TEI-XML file was written"""
+    outfile = infile + '.tei.xml'
+
+    try:
+        logging.info('starting on file <%s>' % infile)
+
+        with open(indir + '/' + infile, 'r') as fh:
+            data = json.load(fh)
+
+        tei = from_sc(
+            data,
+            # from_sc will modify the supplied param metadata
+            # which would stick without deepcopy'ing every turn
+            metadata=copy.deepcopy(hooks.get('metadata')),
+            members=members,
+            special_chars=hooks.get('special_chars'),
+            numeric_parser=hooks.get('numeric_parser'),
+            text_filter=hooks.get('text_filter'),
+            postprocess=hooks.get('postprocess')
+        )
+
+        # just ignore tei==None
+        if tei:
+            tei.write(
+                outdir + '/' + outfile,
+                encoding='utf8',
+                pretty_print=True,
+                xml_declaration=True
+            )
+
+            logging.info('file <%s> looks good' % infile)
+            return True
+        else:
+            logging.error('error with file <%s>: tpen2tei.parse.from_sc did not return anything' % infile)
+
+    except Exception:
+        logging.error('error with file <%s>: %s\n' % (infile, traceback.format_exc()))
+    return False
 
 
 if __name__ == '__main__':
@@ -140,6 +296,19 @@ if __name__ == '__main__':
         "--config",
         help="a Python module with any necessary custom definitions",
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        help="number of worker processes to convert files with (default: convert in this process)",
+    )
+    parser.add_argument(
+        "-f",
+        "--force",
+        action="store_true",
+        help="convert all files, even those that have not changed since the last run",
+    )
+    instrument.add_arguments(parser)
 
     args = parser.parse_args()
     if args.verbose:
@@ -151,10 +320,6 @@ if __name__ == '__main__':
         sys.path.append(os.path.dirname(configpath))
         configmod = os.path.basename(configpath)
 
-    json2xml(args.indir, args.outdir,
-             metadata=metadata(configmod),                 # wants a dict or None
-             special_chars=special_chars(configmod),       # wants a dict or None
-             numeric_parser=numeric_parser(configmod),     # wants a function or None
-             text_filter=transcription_filter(configmod),  # wants a function or None
-             postprocess=postprocess(configmod)            # wants a function or None
-             )
+    with instrument.run('json2xml', args) as recorder:
+        json2xml(args.indir, args.outdir, jobs=args.jobs, configmod=configmod, force=args.force,
+                 recorder=recorder, **load_hooks(configmod))
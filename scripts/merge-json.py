@@ -12,12 +12,14 @@ import os
 import json
 import itertools
 
+import instrument
+
 
 def manuscripts(indir):
     """Figure out from the list of filenames in 'indir' which MSS we have and what 
        their short IDs should be."""
     allfound = []
-    special = ['members.json']
+    special = ['members.json', 'manifest.json']
     jsonfiles = sorted([x for x in os.listdir(indir) if x.endswith('.json')])
     lastms = ""
     currdict = None
@@ -42,7 +44,8 @@ def manuscripts(indir):
     return allfound
 
 
-def main (args):
+def main (args, recorder = None):
+    recorder = recorder or instrument.Recorder()
     msset = [(m['name'], m['files']) for m in manuscripts(args.indir)]
     if args.msid is not None:
         msset = [m for m in msset if m[0] in args.msid]
@@ -50,26 +53,47 @@ def main (args):
         if args.verbose:
             print ("merging {}".format (name))
 
-        files = list (files)
+        with recorder.measure ('manuscript', name):
+            merge (args.indir, files, '%s/%s-merged.json' % (args.outdir, name))
+
+
+def merge (indir, files, outfile):
+    """ merge the given part files into outfile, taking the metadata from the first
+        and the canvases from all of them in order
+
+        the parts are read one at a time and their canvases written out as we go;
+        the result is the same as json.dump (..., sort_keys = True, indent = 4) of
+        the whole merged project
+    """
+
+    with open (outfile, 'w') as out:
+        first = True
+        for (n, part) in enumerate (files):
+            with open ('%s/%s' % (indir, part)) as fh:
+                data = json.load (fh)
+
+            if n == 0:
+                out.write ('{\n    "metadata": %s,\n    "sequences": [\n        {\n            "canvases": [' %
+                    dump_nested (data.get ('metadata'), 1)
+                )
+
+            for canvas in data.get ('sequences')[0].get ('canvases'):
+                out.write ('\n' if first else ',\n')
+                out.write (' ' * 16 + dump_nested (canvas, 4))
+                first = False
+
+            # let go of this part before reading the next one
+            data = None
 
-        head_file = list (files).pop(0)
-        metadata = json.load (open ('%s/%s' % (args.indir, head_file))).get ('metadata')
+        out.write (('' if first else '\n' + ' ' * 12) + ']\n        }\n    ]\n}')
 
-        # becomes a list of ( list of objects/canvases)
-        canvases = [
-            json.load (open ('%s/%s' % (args.indir, part))).get ('sequences')[0].get ('canvases')
-            for part in files
-        ]
 
-        out = dict (
-            metadata = metadata,
-            sequences = [ dict (
-                # flatten out canvases
-                canvases = [c for perfile in canvases for c in perfile]
-            ) ],
-        )
+def dump_nested (value, level):
+    """ value as json.dump (..., sort_keys = True, indent = 4) writes it at the given
+        nesting level; JSON strings never contain a raw newline
+    """
 
-        json.dump (out, open ('%s/%s-merged.json' % (args.outdir, name), 'w'), sort_keys = True, indent = 4)
+    return json.dumps (value, sort_keys = True, indent = 4).replace ('\n', '\n' + ' ' * 4 * level)
 
 
 if __name__ == "__main__":
@@ -105,7 +129,9 @@ if __name__ == "__main__":
         action = "store_true",
         help = "make output more verbose",
     )
+    instrument.add_arguments (parser)
 
     args = parser.parse_args()
 
-    main (args)
+    with instrument.run ('merge-json', args) as recorder:
+        main (args, recorder)
@@ -0,0 +1,589 @@
+#!/usr/bin/env python3
+
+"""
+Run the edition pipeline from the T-PEN transcriptions to the collated
+milestones as a graph of stages: merge the T-PEN projects of each
+manuscript, convert them to TEI-XML, validate the TEI, tokenize each
+milestone and collate it. Every stage is split into tasks, each of which
+builds some artifacts from declared inputs; the inputs and outputs of each
+task are fingerprinted, and a task only runs again if its inputs changed
+since it was last built. A single changed T-PEN project thus rebuilds only
+its manuscript's TEI-XML and the milestones that manuscript contains.
+"""
+
+import argparse
+import concurrent.futures
+import importlib.metadata
+import importlib.util
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+from lxml import etree
+
+from filecache import FileCache, file_hash, make_key
+import artifacts
+import catalog
+import collate
+import json2xml
+import teixml2collatex
+import validate
+
+SCRIPTS = os.path.dirname(os.path.abspath(__file__))
+STATE = 'state.json'
+CATALOG = 'catalog.json'
+
+
+def tool_version(package):
+    try:
+        return importlib.metadata.version(package)
+    except importlib.metadata.PackageNotFoundError:
+        return None
+
+
+def load_script(name):
+    """Imports one of the scripts here whose name is not a module name"""
+    spec = importlib.util.spec_from_file_location(
+        name.replace('-', '_'), os.path.join(SCRIPTS, '%s.py' % name))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+merge_json = load_script('merge-json')
+
+
+class Task(object):
+    """A unit of work that builds the output files from the input files.
+    params are any further JSON-serialisable settings the result depends
+    on. An output that a task may legitimately not produce is recorded as
+    missing."""
+
+    def __init__(self, name, inputs, outputs, params=None, data=None):
+        self.name = name
+        self.inputs = sorted(inputs)
+        self.outputs = sorted(outputs)
+        self.params = params
+        # whatever the stage needs to run the task
+        self.data = data
+
+
+class State(object):
+    """What the last runs built: for each task the key of its inputs and
+    the hashes of its outputs, plus a stat cache so that unchanged files
+    need not be hashed again"""
+
+    def __init__(self, path):
+        self.path = path
+        self.tasks = dict()
+        self.files = dict()
+        self.extra = dict()
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as fh:
+                state = json.load(fh)
+            self.tasks = state.get('tasks', dict())
+            self.files = state.get('files', dict())
+            self.extra = state.get('extra', dict())
+
+    def hash(self, path):
+        """Returns the hash of a file, or None if it does not exist"""
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            self.files.pop(path, None)
+            return None
+        known = self.files.get(path)
+        if known is not None and known[:2] == [st.st_mtime_ns, st.st_size]:
+            return known[2]
+        digest = file_hash(path)
+        self.files[path] = [st.st_mtime_ns, st.st_size, digest]
+        return digest
+
+    def key(self, stage, task):
+        return make_key(stage, task.name, task.params,
+                        [(path, self.hash(path)) for path in task.inputs])
+
+    def fresh(self, stage, task):
+        """Whether the task was built from the same inputs as now, and its
+        outputs are still what it built"""
+        built = self.tasks.get(task.name)
+        if built is None or built.get('key') != self.key(stage, task):
+            return False
+        return all(self.hash(path) == built.get('outputs').get(path) for path in task.outputs)
+
+    def record(self, stage, task):
+        self.tasks[task.name] = dict(
+            stage=stage,
+            key=self.key(stage, task),
+            outputs=dict((path, self.hash(path)) for path in task.outputs),
+        )
+
+    def forget(self, name):
+        self.tasks.pop(name, None)
+
+    def names(self, stage):
+        return set(n for n, t in self.tasks.items() if t.get('stage') == stage)
+
+    def save(self):
+        (fd, tmppath) = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)))
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as fh:
+                json.dump(dict(tasks=self.tasks, files=self.files, extra=self.extra),
+                          fh, ensure_ascii=False, indent=1, sort_keys=True)
+            os.replace(tmppath, self.path)
+        except BaseException:
+            os.unlink(tmppath)
+            raise
+
+
+class Stage(object):
+    """A step of the pipeline. tasks() lists everything the stage should
+    build, given what the stages before it built; run() builds the tasks
+    that are not fresh and returns the names of those that failed."""
+
+    name = None
+    after = []
+
+    def tasks(self, ctx):
+        raise NotImplementedError
+
+    def run(self, tasks, ctx):
+        raise NotImplementedError
+
+
+class MergeStage(Stage):
+    """One task per manuscript: merge its T-PEN projects into one file"""
+
+    name = 'merge'
+
+    def tasks(self, ctx):
+        tasks = []
+        for ms in merge_json.manuscripts(ctx.indir):
+            if ms is None:
+                continue
+            outfile = os.path.join(ctx.merged, '%s-merged.json' % ms.get('name'))
+            tasks.append(Task(
+                'merge:%s' % ms.get('name'),
+                [os.path.join(ctx.indir, f) for f in ms.get('files')],
+                [outfile],
+                data=ms.get('files'),
+            ))
+        return tasks
+
+    def run(self, tasks, ctx):
+        failed = set()
+        for task in tasks:
+            try:
+                merge_json.merge(ctx.indir, task.data, task.outputs[0])
+            except Exception:
+                logging.exception('error merging <%s>' % task.name)
+                failed.add(task.name)
+        return failed
+
+
+class TeiStage(Stage):
+    """One task per manuscript: convert its merged file to TEI-XML"""
+
+    name = 'tei'
+    after = ['merge']
+
+    def tasks(self, ctx):
+        shared = [p for p in (ctx.members, ctx.config_source) if p is not None]
+        tasks = []
+        for infile in sorted(os.listdir(ctx.merged)):
+            if not infile.endswith('-merged.json'):
+                continue
+            tasks.append(Task(
+                'tei:%s' % infile,
+                [os.path.join(ctx.merged, infile)] + shared,
+                [os.path.join(ctx.teidir, infile + '.tei.xml')],
+                params=tool_version('tpen2tei'),
+                data=infile,
+            ))
+        return tasks
+
+    def run(self, tasks, ctx):
+        if not tasks:
+            return set()
+        members = None
+        if os.path.exists(ctx.members):
+            with open(ctx.members, encoding='utf-8') as fh:
+                members = json.load(fh)
+        hooks = json2xml.load_hooks(ctx.configname)
+        results = json2xml.convert_files(
+            ctx.merged, ctx.teidir, [t.data for t in tasks], members, hooks, ctx.jobs)
+        return set(t.name for t in tasks if not results.get(t.data))
+
+
+class ValidateStage(Stage):
+    """One task per TEI-XML file: validate it against the schema. These
+    tasks build nothing, so a file is only validated again once it or the
+    schema changed, or if it failed; with a cache, the errors of a file
+    that failed before are reported from there."""
+
+    name = 'validate'
+    after = ['tei']
+
+    def tasks(self, ctx):
+        if ctx.schema is None:
+            return []
+        return [Task('validate:%s' % f, [os.path.join(ctx.teidir, f), ctx.schema], [], data=f)
+                for f in sorted(os.listdir(ctx.teidir)) if f.endswith('.xml')]
+
+    def run(self, tasks, ctx):
+        if not tasks:
+            return set()
+        try:
+            cache = None
+            if ctx.cache is not None:
+                cache = validate.ValidationCache(
+                    os.path.join(ctx.cache, 'validation'), ctx.schema, ctx.cache_size)
+            results = validate.validate_files(
+                ctx.schema, [os.path.join(ctx.teidir, t.data) for t in tasks], ctx.jobs, cache)
+        except (etree.RelaxNGParseError, etree.XMLSyntaxError, OSError) as e:
+            print('Relax-NG schema %s failed to compile: %s' % (ctx.schema, e), file=sys.stderr)
+            return set(t.name for t in tasks)
+
+        failed = set()
+        for (task, (path, returncode, report)) in zip(tasks, results):
+            print('=== %s ===' % path)
+            for line in report:
+                print(line)
+            if returncode:
+                failed.add(task.name)
+        if cache is not None:
+            logging.info(cache.report())
+        return failed
+
+
+class TokenizeStage(Stage):
+    """One task per milestone: tokenize it in every witness. A milestone
+    depends only on the TEI-XML files that contain it, which the milestone
+    catalog knows. Without a list of milestones in the config module, the
+    milestones of the catalog are tokenized."""
+
+    name = 'tokenize'
+    after = ['tei']
+
+    def tasks(self, ctx):
+        shared = [ctx.config_source] if ctx.config_source is not None else []
+        skipwit = teixml2collatex.unfinished(ctx.configmod)
+        infiles = [f for f in teixml2collatex.get_filelist(ctx.teidir, ctx.configmod)
+                   if teixml2collatex.get_witness_name(f) not in skipwit]
+
+        # The milestones in each file, indexed again only if it changed
+        parsed = ctx.catalog.refresh(
+            ctx.teidir, teixml2collatex.get_filelist(ctx.teidir, ctx.configmod), ctx.state.hash)
+        ctx.catalog.save()
+        logging.info('indexed %d of %d TEI-XML files' % (parsed, len(ctx.catalog.files)))
+        # Kept here before there was a catalog
+        ctx.state.extra.pop('milestones', None)
+
+        milestones = ctx.milestones or ctx.catalog.milestones(infiles)
+        # The order of the files decides which witness is used for a sigil
+        contains = dict((milestone, [os.path.join(ctx.teidir, f)
+                                     for f in ctx.catalog.files_with(milestone, infiles)])
+                        for milestone in milestones)
+        return [Task(
+            'tokenize:%s' % milestone,
+            contains.get(milestone) + shared,
+            [artifacts.artifact_path(os.path.join(ctx.tokens, 'milestone-%s.json' % milestone), ctx.format)],
+            params=[tool_version('tpen2tei'), contains.get(milestone), ctx.format],
+            data=milestone,
+        ) for milestone in milestones]
+
+    def run(self, tasks, ctx):
+        if not tasks:
+            return set()
+        mslist = [t.data for t in tasks]
+        cache = None
+        if ctx.cache is not None:
+            cache = teixml2collatex.TokenCache(
+                os.path.join(ctx.cache, 'tokens'), ctx.configmod, ctx.cache_size)
+        tokenized = teixml2collatex.tokenize_all(
+            ctx.teidir, mslist, ctx.config, ctx.jobs, cache, mscatalog=ctx.catalog,
+            configmod=ctx.configmod)
+        if cache is not None:
+            logging.info(cache.report())
+
+        failed = set()
+        for task in tasks:
+            try:
+                c = teixml2collatex.teixml2collatex(
+                    task.data, ctx.teidir, False, ctx.configmod, tokenized, ctx.catalog)
+            except Exception:
+                logging.exception('error tokenizing milestone %s' % task.data)
+                failed.add(task.name)
+                continue
+            outfile = task.outputs[0]
+            if c.get('witnesses'):
+                artifacts.write_json(outfile, c, ctx.format)
+            else:
+                artifacts.remove(outfile)
+        return failed
+
+
+class CollateStage(Stage):
+    """One task per tokenized milestone: collate it"""
+
+    name = 'collate'
+    after = ['tokenize']
+
+    def tasks(self, ctx):
+        return [Task(
+            'collate:%s' % artifacts.base_name(f),
+            [os.path.join(ctx.tokens, f)],
+            [collate.output_file(ctx.collations, f, ctx.format)],
+            params=[ctx.collatex_version(), collate.COLLATEX_ARGS, ctx.format],
+            data=f,
+        ) for f in collate.milestone_files(ctx.tokens)]
+
+    def run(self, tasks, ctx):
+        if ctx.collatex_version() is None:
+            print('cannot read the CollateX JAR %s' % ctx.jar, file=sys.stderr)
+            return set(t.name for t in tasks)
+        cache = None
+        if ctx.cache is not None:
+            cache = FileCache(os.path.join(ctx.cache, 'collations'), ctx.cache_size)
+
+        def collate_task(task):
+            try:
+                return (task, collate.timed_collate(
+                    task.inputs[0], task.outputs[0],
+                    jar=ctx.jar, cache=cache, version=ctx.collatex_version(),
+                    timeout=ctx.timeout or None, fmt=ctx.format))
+            except Exception:
+                logging.exception('error collating <%s>' % task.data)
+                return (task, ('failed', 0))
+
+        failed = set()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=ctx.jobs or 1) as executor:
+            for (task, (outcome, walltime)) in executor.map(collate_task, tasks):
+                print('%s %s in %.1fs' % (task.data, outcome, walltime))
+                if outcome not in ('collated', 'cached'):
+                    failed.add(task.name)
+        return failed
+
+
+STAGES = [MergeStage(), TeiStage(), ValidateStage(), TokenizeStage(), CollateStage()]
+
+
+def stage_order(stages, selected=None):
+    """Returns the stages in an order in which each comes after those it
+    depends on. If selected names some stages, only those and the stages
+    they depend on are returned."""
+    byname = dict((s.name, s) for s in stages)
+    wanted = set()
+
+    def want(name):
+        if name not in wanted:
+            wanted.add(name)
+            for dep in byname.get(name).after:
+                want(dep)
+
+    for name in selected or byname:
+        want(name)
+
+    order = []
+    done = set()
+
+    def visit(stage, path):
+        if stage.name in done:
+            return
+        if stage.name in path:
+            raise ValueError('stages depend on each other: %s' % ' -> '.join(path + [stage.name]))
+        for dep in stage.after:
+            visit(byname.get(dep), path + [stage.name])
+        done.add(stage.name)
+        order.append(stage)
+
+    for stage in stages:
+        if stage.name in wanted:
+            visit(stage, [])
+    return order
+
+
+def run_pipeline(ctx, stages=STAGES, selected=None, force=False):
+    """Runs the stages in order, each only for its tasks that are not
+    fresh. Artifacts of tasks that no longer exist are removed. Returns the
+    names of the failed tasks."""
+    state = ctx.state
+    failed = []
+    for stage in stage_order(stages, selected):
+        start = time.monotonic()
+        tasks = stage.tasks(ctx)
+        dirty = [t for t in tasks if force or not state.fresh(stage.name, t)]
+
+        # Whatever we built for tasks that are gone is obsolete
+        current = set(t.name for t in tasks)
+        for name in sorted(state.names(stage.name) - current):
+            for path in state.tasks.get(name).get('outputs'):
+                if os.path.exists(path):
+                    logging.info('removing obsolete <%s>' % path)
+                    os.unlink(path)
+            state.forget(name)
+
+        stage_failed = stage.run(dirty, ctx) if dirty else set()
+        for task in dirty:
+            if task.name in stage_failed:
+                state.forget(task.name)
+                failed.append(task.name)
+            else:
+                state.record(stage.name, task)
+
+        # Keep what we have so far, in case a later stage is interrupted
+        state.save()
+        report = '%s: %d tasks, %d built, %d failed in %.1fs' % (
+            stage.name, len(tasks), len(dirty) - len(stage_failed), len(stage_failed),
+            time.monotonic() - start)
+        print(report)
+        logging.info(report)
+    return failed
+
+
+class Context(object):
+    """The settings of a pipeline run"""
+
+    def __init__(self, args):
+        self.indir = args.indir
+        self.teidir = args.tei_dir or os.path.join(args.indir, 'tei-xml')
+        self.members = os.path.join(args.indir, 'members.json')
+        self.workdir = args.workdir
+        self.merged = os.path.join(args.workdir, 'merged')
+        self.tokens = os.path.join(args.workdir, 'tokens')
+        self.collations = os.path.join(args.workdir, 'collations')
+        for d in (self.teidir, self.merged, self.tokens, self.collations):
+            os.makedirs(d, exist_ok=True)
+
+        self.schema = args.schema
+        self.jobs = args.jobs
+        self.jar = os.path.expanduser(args.jar)
+        self.timeout = args.timeout
+        self.format = args.format
+        self.cache = args.cache
+        self.cache_size = args.cache_size * 1024 * 1024
+        self._collatex_version = False
+
+        # json2xml wants the config module by name, teixml2collatex by path
+        self.config = args.config
+        self.configmod = teixml2collatex.load_config(args.config)
+        self.configname = None
+        self.config_source = None
+        if self.configmod is not None:
+            self.configname = self.configmod.__name__
+            self.config_source = self.configmod.__file__
+
+        self.milestones = args.milestone or teixml2collatex.milestones(self.configmod)
+        self.state = State(os.path.join(args.workdir, STATE))
+        self.catalog = catalog.Catalog(os.path.join(args.workdir, CATALOG))
+
+    def collatex_version(self):
+        """Returns the version of the CollateX JAR, or None if it cannot be
+        read"""
+        if self._collatex_version is False:
+            try:
+                self._collatex_version = collate.collatex_version(self.jar)
+            except OSError as e:
+                logging.error('cannot read the CollateX JAR <%s>: %s' % (self.jar, e))
+                self._collatex_version = None
+        return self._collatex_version
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "indir",
+        help="directory of the T-PEN transcriptions, i.e. transcription/",
+    )
+    parser.add_argument(
+        "-w",
+        "--workdir",
+        default=".pipeline",
+        help="directory for the merged, tokenized and collated files and the "
+             "state of the pipeline (default .pipeline)",
+    )
+    parser.add_argument(
+        "--tei-dir",
+        help="output directory for the TEI-XML files (default INDIR/tei-xml)",
+    )
+    parser.add_argument(
+        "-c",
+        "--config",
+        help="a Python module with any necessary custom definitions",
+    )
+    parser.add_argument(
+        "-m",
+        "--milestone",
+        action="append",
+        help="milestone(s) to process, if not those from the config module, or else "
+             "those found in the TEI-XML files",
+    )
+    parser.add_argument(
+        "--schema",
+        help="RelaxNG schema to validate the TEI-XML files against; no validation without it",
+    )
+    parser.add_argument(
+        "-s",
+        "--stage",
+        action="append",
+        choices=[s.name for s in STAGES],
+        help="run only this stage and those it depends on (default: all)",
+    )
+    parser.add_argument(
+        "-f",
+        "--force",
+        action="store_true",
+        help="build everything, whether it changed or not",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        help="number of files to convert, tokenize or collate at once",
+    )
+    parser.add_argument(
+        "--jar",
+        default=collate.COLLATEX_JAR,
+        help="location of the CollateX JAR file (default %s)" % collate.COLLATEX_JAR,
+    )
+    parser.add_argument(
+        "-t",
+        "--timeout",
+        type=int,
+        default=collate.TIMEOUT,
+        help="seconds after which CollateX is killed, or 0 for no limit (default %s)" % collate.TIMEOUT,
+    )
+    parser.add_argument(
+        "--cache",
+        help="directory in which to cache validation, tokenizer and CollateX results between runs",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=1024,
+        help="size limit of each cache in MB (default 1024)",
+    )
+    artifacts.add_arguments(parser)
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="store_true",
+        help="log what every stage does",
+    )
+
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format='%(asctime)s %(message)s',
+        filename='%s.log' % os.path.basename(sys.argv[0]),
+        level=logging.INFO if args.verbose else logging.WARNING,
+    )
+
+    failed = run_pipeline(Context(args), selected=args.stage, force=args.force)
+    if failed:
+        print('failed: %s' % ' '.join(failed), file=sys.stderr)
+    sys.exit(1 if failed else 0)
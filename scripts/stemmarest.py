@@ -0,0 +1,489 @@
+#!/usr/bin/env python3
+
+"""
+Collate tokenized milestone files and upload the results to a Stemmarest
+server as the sections of a new tradition. Milestones are collated a few at
+a time ahead of the upload, so that CollateX keeps working while a finished
+milestone is sent to the server; the sections are still uploaded one after
+the other, in milestone file order.
+
+With --checkpoint, every uploaded section is recorded in a file, and a run
+that finds the checkpoint of an unfinished upload adds the remaining
+sections to the same tradition instead of starting a new one.
+"""
+
+import argparse
+import concurrent.futures
+import datetime
+import hashlib
+import logging
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import artifacts
+import collate
+from filecache import FileCache
+
+# Give up after this many gateway errors in a row
+ATTEMPTS = 5
+TIMEOUT = 600
+# Seconds to wait after the first failed attempt; the wait doubles after
+# each further one, up to BACKOFF_MAX
+BACKOFF = 2
+BACKOFF_MAX = 60
+
+
+class GatewayError(Exception):
+    pass
+
+
+class Stemmarest(object):
+    """The parts of the Stemmarest API that the pipeline uses, on a single
+    keep-alive connection"""
+
+    def __init__(self, base, auth=None, attempts=ATTEMPTS, timeout=TIMEOUT, backoff=BACKOFF):
+        self.base = base.rstrip('/')
+        self.attempts = attempts
+        self.timeout = timeout
+        self.backoff = backoff
+        self.session = requests.Session()
+        self.session.auth = auth
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=1)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def close(self):
+        self.session.close()
+
+    def put_user(self, userid, passphrase):
+        """Creates the user, or updates it if it exists"""
+        return self._request('PUT', '/user/%s' % userid, json={
+            'role': 'user',
+            'id': userid,
+            'email': userid,
+            'passphrase': passphrase,
+        })
+
+    def create_tradition(self, name, language, userid):
+        """Creates an empty tradition and returns its ID"""
+        res = self._request('POST', '/tradition', files=form_fields(
+            name=name,
+            language=language,
+            public='no',
+            userId=userid,
+            empty='no',
+        ))
+        return res.json().get('tradId')
+
+    def tradition_exists(self, tradid):
+        """Whether the tradition is still on the server"""
+        res = self._send('GET', '/tradition/%s' % tradid)
+        if res.status_code == 404:
+            return False
+        self._check(res, 'GET', '/tradition/%s' % tradid)
+        return True
+
+    def add_section(self, tradid, name, path):
+        """Uploads a CollateX JSON file, in any of the formats of
+        artifacts.py, as the next section of the tradition and returns the
+        ID of the new section"""
+        data = artifacts.read_bytes(path)
+        files = form_fields(name=name, filetype='cxjson')
+        files['file'] = (os.path.basename(artifacts.base_name(path)), data)
+        res = self._request('POST', '/tradition/%s/section' % tradid, files=files)
+        return res.json().get('parentId')
+
+    def delete_section(self, tradid, sectionid):
+        """Removes a section from the tradition"""
+        self._request('DELETE', '/tradition/%s/section/%s' % (tradid, sectionid))
+
+    def _request(self, method, path, **kwa):
+        """Sends a request, repeating it on gateway errors. Raises
+        GatewayError if every attempt met one, and requests.HTTPError for
+        any other error status."""
+        res = self._send(method, path, **kwa)
+        self._check(res, method, path)
+        return res
+
+    def _send(self, method, path, **kwa):
+        """Sends a request and returns the response, waiting longer and
+        longer between attempts while the server answers with a gateway
+        error or cannot be reached"""
+        for attempt in range(1, self.attempts + 1):
+            try:
+                res = self.session.request(method, self.base + path, timeout=self.timeout, **kwa)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt == self.attempts:
+                    raise
+                logging.error('%s %s: %s (attempt %s/%s)' % (method, path, e, attempt, self.attempts))
+                res = None
+            else:
+                if not is_gateway_error(res):
+                    return res
+                logging.error('%s %s: gateway error %s/%s' % (method, path, attempt, self.attempts))
+            if attempt < self.attempts:
+                time.sleep(self.delay(attempt, res))
+        raise GatewayError('too many gateway errors in a row on %s %s' % (method, path))
+
+    def delay(self, attempt, res=None):
+        """Returns the number of seconds to wait after the given failed
+        attempt. A Retry-After header from the server takes precedence."""
+        retry_after = res is not None and res.headers.get('Retry-After')
+        if retry_after and retry_after.isdigit():
+            return min(int(retry_after), BACKOFF_MAX)
+        delay = min(self.backoff * 2 ** (attempt - 1), BACKOFF_MAX)
+        # Jitter, so that clients that failed together don't retry together
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    @staticmethod
+    def _check(res, method, path):
+        if not res.ok:
+            logging.error('%s %s returned status %s: %s' % (method, path, res.status_code, res.text))
+        res.raise_for_status()
+
+
+class Checkpoint(object):
+    """The tradition that an upload is going into, and the sections uploaded
+    to it so far, in order. Every change is written to the checkpoint file
+    at once; without a file, the checkpoint is kept in memory only."""
+
+    def __init__(self, path=None):
+        self.path = path
+        self.tradition = None
+        self.sections = []
+        if path is None:
+            return
+        try:
+            with open(path, encoding='utf-8') as fh:
+                data = json.load(fh)
+        except FileNotFoundError:
+            return
+        except ValueError:
+            logging.warning('ignoring unreadable checkpoint %s' % path)
+            return
+        self.tradition = data.get('tradition')
+        self.sections = data.get('sections', [])
+
+    def resumes(self, api, user, name):
+        """Whether the checkpoint is for an upload of the same tradition"""
+        return self.tradition is not None and all(
+            self.tradition.get(k) == v for (k, v) in dict(api=api, user=user, name=name).items())
+
+    def start(self, api, user, name, tradid):
+        self.tradition = dict(api=api, user=user, name=name, id=tradid)
+        self.sections = []
+        self.save()
+
+    def add(self, milestone, digest, section):
+        self.sections.append(dict(milestone=milestone, hash=digest, section=section))
+        self.save()
+
+    def truncate(self, count):
+        del self.sections[count:]
+        self.save()
+
+    def remove(self):
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
+
+    def save(self):
+        if self.path is None:
+            return
+        (fd, tmppath) = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)))
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as fh:
+                json.dump(dict(tradition=self.tradition, sections=self.sections),
+                          fh, ensure_ascii=False, indent=1)
+            os.replace(tmppath, self.path)
+        except BaseException:
+            os.unlink(tmppath)
+            raise
+
+
+def form_fields(**fields):
+    """Returns the given fields in the form requests sends as
+    multipart/form-data, like curl --form"""
+    return dict((k, (None, v)) for (k, v) in fields.items())
+
+
+def is_gateway_error(res):
+    # A proxy in front of Stemmarest may also answer 200 with an error page
+    return res.status_code in (502, 503, 504) or re.search('50.*Gateway', res.text) is not None
+
+
+def upload_all(client, checkpoint, args, jar, cache, version, server):
+    """Collates the milestone files in args.indir on a pool of args.jobs
+    threads, in upload order, and uploads each finished collation as the
+    next section of the checkpoint's tradition. Milestones that could not be
+    collated are left out. Returns a dictionary of milestone file ->
+    outcome."""
+    outcomes = dict()
+    # Number of sections of the tradition that are known to be current
+    position = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        # The pool collates the milestones after the one being uploaded
+        futures = [(infile, executor.submit(
+            collate.timed_collate,
+            os.path.join(args.indir, infile),
+            collate.output_file(args.outdir, infile, args.format),
+            jar=jar,
+            cache=cache,
+            version=version,
+            timeout=args.timeout or None,
+            server=server,
+            fmt=args.format,
+        )) for infile in collate.milestone_files(args.indir)]
+
+        try:
+            for (infile, future) in futures:
+                outcomes[infile] = upload_one(client, checkpoint, position, infile, future, args)
+                if outcomes[infile] in ('uploaded', 'unchanged'):
+                    position += 1
+        except BaseException:
+            # Don't keep collating milestones that will not be uploaded
+            for (infile, future) in futures:
+                future.cancel()
+            raise
+    # Sections of milestones that are gone
+    remove_sections(client, checkpoint, position)
+    return outcomes
+
+
+def upload_one(client, checkpoint, position, infile, future, args):
+    """Waits for the collation of a milestone and uploads it as section
+    number position of the tradition, unless the checkpoint shows that the
+    same collation is there already. Returns the outcome for the
+    milestone."""
+    try:
+        (outcome, walltime) = future.result()
+    except Exception:
+        logging.exception('error collating <%s>' % infile)
+        (outcome, walltime) = ('failed', 0)
+    print("{}: {} {} in {:.1f}s".format(
+        datetime.datetime.now().strftime("%a, %d %b %Y %H:%M:%S %z"),
+        infile,
+        outcome,
+        walltime,
+    ))
+    if outcome not in ('collated', 'cached'):
+        return outcome
+
+    name = os.path.splitext(artifacts.base_name(infile))[0]
+    outfile = collate.output_file(args.outdir, infile, args.format)
+    # The hash of the JSON text, so compressing the collations does not
+    # make them new sections
+    digest = hashlib.sha256(artifacts.read_bytes(outfile)).hexdigest()
+    tradid = checkpoint.tradition['id']
+    if position < len(checkpoint.sections):
+        done = checkpoint.sections[position]
+        if done['milestone'] == name and done['hash'] == digest:
+            print('%s is already uploaded as section %s' % (name, done['section']))
+            return 'unchanged'
+        # The sections from here on are out of date or out of order, and new
+        # ones can only be added at the end
+        remove_sections(client, checkpoint, position)
+
+    try:
+        section = client.add_section(tradid, name, outfile)
+    except requests.HTTPError:
+        return 'rejected'
+    checkpoint.add(name, digest, section)
+    print('uploaded %s as section %s' % (name, section))
+    return 'uploaded'
+
+
+def remove_sections(client, checkpoint, position):
+    """Removes the sections of the checkpoint's tradition from section
+    number position on, last first"""
+    while len(checkpoint.sections) > position:
+        stale = checkpoint.sections[-1]
+        print('removing section %s (%s)' % (stale['section'], stale['milestone']))
+        client.delete_section(checkpoint.tradition['id'], stale['section'])
+        checkpoint.truncate(len(checkpoint.sections) - 1)
+
+
+def open_tradition(client, checkpoint, args):
+    """Returns the ID of the tradition to upload to: the one in the
+    checkpoint, if it belongs to an unfinished upload of the same tradition
+    that is still on the server, or else a new one"""
+    if checkpoint.resumes(args.api, args.user, args.name):
+        tradid = checkpoint.tradition['id']
+        if client.tradition_exists(tradid):
+            print('resuming the upload to tradition %s after %d sections' % (
+                tradid, len(checkpoint.sections)))
+            return tradid
+        logging.warning('tradition %s of the checkpoint is gone; starting over' % tradid)
+
+    tradid = client.create_tradition(
+        '%s %s' % (args.name, datetime.date.today().strftime('%Y-%m-%d')),
+        args.language,
+        args.user,
+    )
+    if tradid:
+        print('created tradition %s' % tradid)
+        checkpoint.start(args.api, args.user, args.name, tradid)
+    return tradid
+
+
+def main(args):
+    jar = os.path.expanduser(args.jar)
+    cache = None
+    version = None
+    if args.cache is not None:
+        cache = FileCache(args.cache, args.cache_size * 1024 * 1024)
+        version = collate.collatex_version(jar)
+
+    if not os.path.exists(args.outdir):
+        os.makedirs(args.outdir)
+
+    auth = None
+    if os.environ.get('API_HTUSER'):
+        auth = (os.environ.get('API_HTUSER'), os.environ.get('API_HTPASS', ''))
+    client = Stemmarest(args.api, auth, backoff=args.backoff)
+    checkpoint = Checkpoint(args.checkpoint)
+
+    server = None
+    try:
+        client.put_user(args.user, os.environ.get('SW_PASS'))
+        if not open_tradition(client, checkpoint, args):
+            print('could not create the tradition', file=sys.stderr)
+            return 1
+
+        if args.batch:
+            server = collate.CollationServer(jar, args.jobs)
+            server.start()
+        outcomes = upload_all(client, checkpoint, args, jar, cache, version, server)
+    except (GatewayError, requests.RequestException) as e:
+        print('giving up: %s' % e, file=sys.stderr)
+        if args.checkpoint:
+            print('the next run will resume from %s' % args.checkpoint, file=sys.stderr)
+        return 1
+    finally:
+        if server is not None:
+            server.stop()
+        client.close()
+
+    if cache is not None:
+        print(cache.report('collation cache'))
+        logging.info(cache.report('collation cache'))
+
+    # As with collate.py, a milestone that timed out is left out, but is
+    # not a failure of the run
+    timedout = sorted([f for f, o in outcomes.items() if o == 'timeout'])
+    failed = sorted([f for f, o in outcomes.items() if o in ('failed', 'rejected')])
+    if timedout:
+        print('timed out: %s' % ' '.join(timedout), file=sys.stderr)
+    if failed:
+        print('failed: %s' % ' '.join(failed), file=sys.stderr)
+        return 1
+    # The upload is complete, so the next run starts a new tradition
+    checkpoint.remove()
+    return 0
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description="The Stemmaweb passphrase is read from SW_PASS, and HTTP basic auth "
+                    "credentials for the server, if any, from API_HTUSER and API_HTPASS.",
+    )
+    parser.add_argument(
+        "indir",
+        help="input directory of tokenized milestone files",
+    )
+    parser.add_argument(
+        "outdir",
+        help="output directory for the collations",
+    )
+    parser.add_argument(
+        "--api",
+        required=True,
+        help="base URL of the Stemmarest API",
+    )
+    parser.add_argument(
+        "--user",
+        required=True,
+        help="Stemmaweb user to own the tradition",
+    )
+    parser.add_argument(
+        "--name",
+        required=True,
+        help="name of the tradition; today's date is appended to it",
+    )
+    parser.add_argument(
+        "--language",
+        required=True,
+        help="language of the tradition",
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="store_true",
+        help="log every CollateX command line",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="number of milestones to collate at once (default 1)",
+    )
+    parser.add_argument(
+        "-t",
+        "--timeout",
+        type=int,
+        default=collate.TIMEOUT,
+        help="seconds after which a CollateX process is killed, or 0 for no limit (default %s)" % (
+            collate.TIMEOUT),
+    )
+    parser.add_argument(
+        "-b",
+        "--batch",
+        action="store_true",
+        help="start CollateX only once, as an HTTP service, and send it every milestone",
+    )
+    parser.add_argument(
+        "--jar",
+        default=collate.COLLATEX_JAR,
+        help="location of the CollateX JAR file (default %s)" % collate.COLLATEX_JAR,
+    )
+    parser.add_argument(
+        "--cache",
+        help="directory in which to keep collation results between runs",
+    )
+    parser.add_argument(
+        "--checkpoint",
+        help="file in which to record the uploaded sections, so that an interrupted "
+             "upload can be resumed",
+    )
+    parser.add_argument(
+        "--backoff",
+        type=float,
+        default=BACKOFF,
+        help="seconds to wait after a failed request; doubled after each further "
+             "failure (default %s)" % BACKOFF,
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=1024,
+        help="size limit of the collation cache in MB (default 1024)",
+    )
+    artifacts.add_arguments(parser)
+
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format='%(asctime)s %(message)s',
+        filename='%s.log' % os.path.basename(sys.argv[0]),
+        level=logging.INFO if args.verbose else logging.WARNING,
+    )
+    sys.exit(main(args))
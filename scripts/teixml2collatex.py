@@ -3,15 +3,38 @@ import os
 import fnmatch
 import sys
 import argparse
-import json
+import concurrent.futures
 import re
 import importlib
+import importlib.metadata
+import inspect
 import statistics
 import datetime
 import traceback
 
+from lxml import etree
 from tpen2tei.wordtokenize import Tokenizer
 
+from filecache import FileCache, file_hash, make_key
+import artifacts
+import catalog
+import instrument
+
+TEI_NS = {'t': 'http://www.tei-c.org/ns/1.0'}
+BLOCK_XPATH = '//t:text/t:body/t:p | //t:text/t:body/t:ab'
+ID_XPATH = '//t:msDesc/@xml:id'
+
+
+def load_config(config):
+    """Imports the module for custom collation logic at the given path, or
+    returns None if no path is given"""
+    if config is None:
+        return None
+    configpath = os.path.expanduser(config)
+    if os.path.dirname(configpath) not in sys.path:
+        sys.path.append(os.path.dirname(configpath))
+    return importlib.import_module(os.path.basename(configpath))
+
 
 def milestones(configmod):
     """Returns a list of milestones that should be individually collated"""
@@ -59,7 +82,11 @@ def txn_priority(configmod):
     return ['json.tei', 'txt.tei']
 
 
-def teixml2collatex(milestone, indir, verbose, configmod):
+def teixml2collatex(milestone, indir, verbose, configmod, tokenized=None, mscatalog=None):
+    # If tokenized is given, it is the result of tokenize_all() and no
+    # tokenizing is done here at all. If mscatalog is given, files that
+    # it says do not contain the milestone are not read.
+    #
     # Set up a dictionary of witness sigil -> witness data. There needs to be
     # only one dataset per sigil.
     witnesses = dict()
@@ -77,17 +104,19 @@ def teixml2collatex(milestone, indir, verbose, configmod):
             ))
 
         # get a witness name for display by removing file extensions
-        witness_name = re.sub('-merged', '', infile[:infile.find('.')])
+        witness_name = get_witness_name(infile)
         if witness_name in skipwit:
             if verbose:
                 print('skipping unfinished witness %s' % witness_name)
             continue
 
-        witness = extract_witness(
-            indir + '/' + infile,
-            milestone,
-            normalise(configmod),
-            punctuation(configmod))
+        if mscatalog is not None and not mscatalog.contains(infile, milestone):
+            (witness, layerwit) = (None, None)
+        elif tokenized is not None:
+            (witness, layerwit) = tokenized.get(infile, {}).get(milestone, (None, None))
+        else:
+            (witness, layerwit) = tokenize_milestone(
+                indir + '/' + infile, milestone, configmod)
 
         if witness is not None and witness.get('tokens'):
             witnesses[witness.get('id')] = witness
@@ -95,13 +124,8 @@ def teixml2collatex(milestone, indir, verbose, configmod):
                 milestone,
                 infile,
             ))
-            # Get the layer witness too
-            layerwit = extract_witness(indir + '/' + infile,
-                                       milestone,
-                                       normalise(configmod),
-                                       punctuation(configmod),
-                                       True)
-            if layerwit.get('tokens'):
+            # Add the layer witness too
+            if layerwit is not None and layerwit.get('tokens'):
                 layerwit['id'] += " (a.c.)"
                 witnesses[layerwit.get('id')] = layerwit
             # Note the length of the (main) witness
@@ -146,25 +170,255 @@ def get_filelist(indir, configmod):
     return ordered_list
 
 
-def extract_witness(xmlfile, milestone, normalisation, punctuation=None, first_layer=False):
-    """ Return a JSON-tokenized witness milestone"""
+def get_witness_name(infile):
+    """Returns the witness name of a file, i.e. its name without extensions"""
+    return re.sub('-merged', '', infile[:infile.find('.')])
+
+
+def tokenize_milestone(xmlfile, milestone, configmod, xmldoc=None):
+    """Returns a tuple of the main and the a.c. layer witness for the given
+    milestone. The layer witness is only extracted if the main witness has
+    any tokens."""
+    witness = extract_witness(
+        xmlfile,
+        milestone,
+        normalise(configmod),
+        punctuation(configmod),
+        xmldoc=xmldoc)
+    layerwit = None
+    if witness is not None and witness.get('tokens'):
+        layerwit = extract_witness(
+            xmlfile,
+            milestone,
+            normalise(configmod),
+            punctuation(configmod),
+            True,
+            xmldoc=xmldoc)
+    return (witness, layerwit)
+
+
+class TokenCache(object):
+    """An on-disk cache of tokenizer output, keyed by the content hash of the
+    witness file, the milestone, the layer, and a fingerprint of the
+    tokenizer settings and config hooks."""
+
+    def __init__(self, cachedir, configmod, max_size=None):
+        self.store = FileCache(cachedir, max_size)
+        self.fingerprint = hooks_fingerprint(configmod)
+        self._hashes = dict()
+
+    def lookup(self, xmlfile, mslist):
+        """Returns a tuple of a dictionary of milestone -> (witness, layer
+        witness) for the milestones that were found in the cache, and a list
+        of the milestones that still need to be tokenized."""
+        self._hashes[xmlfile] = file_hash(xmlfile)
+        cached = dict()
+        missing = []
+        for milestone in mslist:
+            entry = self.store.get_json(self._key(xmlfile, milestone, False))
+            if entry is None:
+                missing.append(milestone)
+                continue
+            witness = entry.get('witness')
+            layerwit = None
+            if witness is not None and witness.get('tokens'):
+                layerentry = self.store.get_json(self._key(xmlfile, milestone, True))
+                if layerentry is None:
+                    missing.append(milestone)
+                    continue
+                layerwit = layerentry.get('witness')
+            # A witness of None means the milestone is not in the file
+            if witness is not None:
+                cached[milestone] = (witness, layerwit)
+        return (cached, missing)
+
+    def update(self, xmlfile, mslist, tokenized):
+        """Stores the result of tokenize_file() for the given milestones.
+        Failed tokenizations are not stored, so that they are tried (and
+        reported) again next time."""
+        if tokenized is None:
+            return
+        for milestone in mslist:
+            if milestone not in tokenized:
+                self.store.put_json(self._key(xmlfile, milestone, False), {'witness': None})
+                continue
+            (witness, layerwit) = tokenized.get(milestone)
+            if witness is None:
+                continue
+            self.store.put_json(self._key(xmlfile, milestone, False), {'witness': witness})
+            if layerwit is not None:
+                self.store.put_json(self._key(xmlfile, milestone, True), {'witness': layerwit})
+
+    def report(self):
+        return self.store.report('token cache')
+
+    def _key(self, xmlfile, milestone, first_layer):
+        return make_key(self._hashes.get(xmlfile), milestone, first_layer, self.fingerprint)
+
+
+def hooks_fingerprint(configmod):
+    """Returns a string that changes whenever the tokenizer, its settings, or
+    the normalise and punctuation hooks of the config module change. As the
+    normalise hook may use anything else in the module, the whole module
+    counts."""
+    try:
+        version = importlib.metadata.version('tpen2tei')
+    except importlib.metadata.PackageNotFoundError:
+        version = None
+    parts = [version, BLOCK_XPATH, ID_XPATH, punctuation(configmod)]
+    if normalise(configmod) is not None:
+        try:
+            parts.append(inspect.getsource(configmod))
+        except (OSError, TypeError):
+            # No source, e.g. only a .pyc; the file is just as good
+            parts.append(file_hash(configmod.__file__))
+    return make_key(*parts)
+
+
+# The config module as loaded in a tokenize_all() worker process
+_worker_configmod = None
+
+
+def _init_worker(config):
+    global _worker_configmod
+    _worker_configmod = load_config(config)
+
+
+def _tokenize_file_worker(xmlfile, mslist):
+    return instrument.measure_call(tokenize_file, xmlfile, mslist, _worker_configmod)
+
+
+def tokenize_file(xmlfile, mslist, configmod):
+    """Parses a witness file once and tokenizes each of the given milestones
+    that it contains. Returns a dictionary of milestone -> (witness, layer
+    witness), or None if the file could not be parsed."""
+    xmldoc = parse_witness(xmlfile)
+    if xmldoc is None:
+        return None
+    tokenized = dict()
+    present = file_milestones(xmldoc)
+    for milestone in mslist:
+        if milestone in present:
+            tokenized[milestone] = tokenize_milestone(
+                xmlfile, milestone, configmod, xmldoc)
+    return tokenized
+
+
+def tokenize_all(indir, mslist, config, jobs=None, cache=None, recorder=None, mscatalog=None,
+                 configmod=None):
+    """Tokenizes all the given milestones in all witness files in indir,
+    parsing each file only once. If jobs is given, the files are tokenized
+    on a pool of that many worker processes, one file per task. If cache is
+    a TokenCache, milestones found there are not tokenized again. If
+    mscatalog is a catalog.Catalog of indir, a file is only read for the
+    milestones it contains. The tokenization of each file is measured in
+    recorder, if one is given. If configmod is given, it is the module
+    loaded from config, which is then not loaded again but in the worker
+    processes.
+
+    Returns a dictionary of file name -> dictionary of milestone -> (witness,
+    layer witness). Files that failed are reported and left out."""
+    recorder = recorder or instrument.Recorder()
+    if configmod is None:
+        configmod = load_config(config)
+    skipwit = unfinished(configmod)
+
+    # Work out which milestones of which files still need tokenizing
+    tokenized = dict()
+    pending = dict()
+    for infile in get_filelist(indir, configmod):
+        if get_witness_name(infile) in skipwit:
+            continue
+        xmlfile = indir + '/' + infile
+        wanted = mslist
+        if mscatalog is not None:
+            wanted = [m for m in mslist if mscatalog.contains(infile, m)]
+        if not wanted:
+            tokenized[infile] = dict()
+        elif cache is None:
+            tokenized[infile] = dict()
+            pending[infile] = wanted
+        else:
+            (tokenized[infile], missing) = cache.lookup(xmlfile, wanted)
+            if missing:
+                pending[infile] = missing
+
+    def gather(infile, result):
+        if cache is not None:
+            cache.update(indir + '/' + infile, pending.get(infile), result)
+        if result is not None:
+            tokenized.get(infile).update(result)
+
+    if not jobs:
+        for infile, missing in pending.items():
+            with recorder.measure('file', infile):
+                result = tokenize_file(indir + '/' + infile, missing, configmod)
+            gather(infile, result)
+        return tokenized
+
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=jobs,
+            initializer=_init_worker,
+            initargs=(config,)) as executor:
+        futures = dict()
+        for infile, missing in pending.items():
+            futures[infile] = executor.submit(
+                _tokenize_file_worker, indir + '/' + infile, missing)
+
+        # Gather the results in file order, so that the outcome does not
+        # depend on which worker finished first
+        for infile, future in futures.items():
+            try:
+                (result, measurement) = future.result()
+                recorder.add('file', infile, measurement)
+                gather(infile, result)
+            except Exception:
+                print('Caught Python exception trying to tokenise %s; see log' % (
+                    indir + '/' + infile), file=sys.stderr)
+                logging.info(traceback.format_exc())
+    return tokenized
+
+
+def file_milestones(xmldoc):
+    """Returns the set of milestone names in a parsed witness file"""
+    return set(xmldoc.xpath('//t:milestone/@n', namespaces=TEI_NS))
+
+
+def parse_witness(xmlfile):
+    """ Return the parsed tree of a TEI XML file, or None"""
+    try:
+        with open(xmlfile, encoding='utf-8') as fh:
+            return etree.parse(fh)
+    except FileNotFoundError:
+        print('file not found: %s' % xmlfile, file=sys.stderr)
+    except:
+        print('Caught Python exception trying to parse %s; see log' % xmlfile, file=sys.stderr)
+        logging.info(traceback.format_exc())
+
+
+def extract_witness(xmlfile, milestone, normalisation, punctuation=None, first_layer=False,
+                    xmldoc=None):
+    """ Return a JSON-tokenized witness milestone. If xmldoc is given, it
+    is used instead of parsing xmlfile again."""
 
     tokenizer = Tokenizer(
         milestone=milestone,
         normalisation=normalisation,
         punctuation=punctuation,
         first_layer=first_layer,
-        block_xpath='//t:text/t:body/t:p | //t:text/t:body/t:ab',
-        id_xpath='//t:msDesc/@xml:id')
+        block_xpath=BLOCK_XPATH,
+        id_xpath=ID_XPATH)
 
     try:
+        if xmldoc is not None:
+            return tokenizer.from_etree(xmldoc)
         with open(xmlfile, encoding='utf-8') as fh:
             return tokenizer.from_fh(fh)
     except FileNotFoundError:
         print('file not found: %s' % xmlfile, file=sys.stderr)
     except:
         print('Caught Python exception trying to tokenise %s; see log' % xmlfile, file=sys.stderr)
-        logging.info(traceback.print_exc())
+        logging.info(traceback.format_exc())
 
 
 if __name__ == '__main__':
@@ -195,6 +449,36 @@ if __name__ == '__main__':
         action="append",
         help="milestone(s) to process, if not default"
     )
+    parser.add_argument(
+        "-s",
+        "--single-pass",
+        action="store_true",
+        help="parse each witness file only once for all milestones"
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        help="tokenize the witness files on this many worker processes; implies --single-pass"
+    )
+    parser.add_argument(
+        "--cache",
+        help="directory in which to cache tokenizer output between runs; implies --single-pass"
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=512,
+        help="size limit of the tokenizer cache in MB (default 512)"
+    )
+    parser.add_argument(
+        "--catalog",
+        help="file in which to keep the index of the milestones in the witness files "
+             "between runs (see catalog.py); only the files that contain a milestone "
+             "are then read for it"
+    )
+    artifacts.add_arguments(parser)
+    instrument.add_arguments(parser)
 
     logging.basicConfig(
         format='%(asctime)s %(message)s',
@@ -204,30 +488,43 @@ if __name__ == '__main__':
 
     args = parser.parse_args()
 
-    configmod = None
-    if args.config is not None:
-        configpath = os.path.expanduser(args.config)
-        sys.path.append(os.path.dirname(configpath))
-        configmod = importlib.import_module(os.path.basename(configpath))
-
-    mslist = args.milestone
-    if mslist is None:
-        mslist = milestones(configmod)
-
-    # Make sure the output directory exists
-    if not os.path.exists(args.outdir):
-        os.makedirs(args.outdir)
-
-    for milestone in mslist:
-        c = teixml2collatex(milestone, args.indir, args.verbose, configmod)
-        if c.get('witnesses'):
-            outfile = '%s/milestone-%s.json' % (args.outdir, milestone)
-
-            with open(outfile, 'w', encoding='utf-8') as fh:
-                json.dump(
-                    c,
-                    fh,
-                    ensure_ascii=False,
-                    indent=4,
-                    check_circular=True,
-                )
+    with instrument.run('teixml2collatex', args) as recorder:
+        configmod = load_config(args.config)
+
+        mslist = args.milestone
+        if mslist is None:
+            mslist = milestones(configmod)
+
+        # Index the milestones if we are to keep the index, or to find them
+        mscatalog = None
+        if args.catalog is not None or not mslist:
+            mscatalog = catalog.Catalog(args.catalog)
+            parsed = mscatalog.refresh(args.indir, get_filelist(args.indir, configmod))
+            mscatalog.save()
+            logging.info('indexed %d of %d witness files' % (parsed, len(mscatalog.files)))
+        if not mslist:
+            mslist = mscatalog.milestones()
+            print('milestones found in the witnesses: %s' % ' '.join(mslist))
+
+        # Make sure the output directory exists
+        if not os.path.exists(args.outdir):
+            os.makedirs(args.outdir)
+
+        # Tokenize all the witness files up front if we were asked to
+        cache = None
+        if args.cache is not None:
+            cache = TokenCache(args.cache, configmod, args.cache_size * 1024 * 1024)
+        tokenized = None
+        if args.single_pass or args.jobs or cache is not None:
+            tokenized = tokenize_all(args.indir, mslist, args.config, args.jobs, cache, recorder, mscatalog,
+                                     configmod)
+        if cache is not None:
+            print(cache.report())
+            logging.info(cache.report())
+
+        for milestone in mslist:
+            with recorder.measure('milestone', milestone):
+                c = teixml2collatex(milestone, args.indir, args.verbose, configmod, tokenized, mscatalog)
+                if c.get('witnesses'):
+                    outfile = '%s/milestone-%s.json' % (args.outdir, milestone)
+                    artifacts.write_json(outfile, c, args.format)
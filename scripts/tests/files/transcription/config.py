@@ -0,0 +1,9 @@
+"""Configuration of a synthetic corpus"""
+
+
+def milestones():
+    return ['1', '2', '3']
+
+
+def punctuation():
+    return [".", ",", ":"]
@@ -0,0 +1,139 @@
+import importlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import json2xml
+import pipeline
+import teixml2collatex
+
+FILES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'files')
+
+CONFIG = '''
+SPELLINGS = {'vnd': 'und'}
+
+
+def spelling(word):
+    return SPELLINGS.get(word, word)
+
+
+def normalise(token):
+    token['n'] = spelling(token['t'])
+    return token
+'''
+
+
+class TestTokenCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.config = os.path.join(self.tmpdir, 'config', 'tokenconfig')
+        os.makedirs(os.path.dirname(self.config))
+        self.write_config(CONFIG)
+        self.xmlfile = os.path.join(self.tmpdir, 'A.xml')
+        with open(self.xmlfile, 'w') as fh:
+            fh.write('<TEI/>')
+
+    def tearDown(self):
+        sys.modules.pop('tokenconfig', None)
+        while os.path.dirname(self.config) in sys.path:
+            sys.path.remove(os.path.dirname(self.config))
+        shutil.rmtree(self.tmpdir)
+
+    def write_config(self, source):
+        with open(self.config + '.py', 'w') as fh:
+            fh.write(source)
+
+    def cache(self):
+        configmod = teixml2collatex.load_config(self.config)
+        importlib.reload(configmod)
+        return teixml2collatex.TokenCache(os.path.join(self.tmpdir, 'cache'), configmod)
+
+    def store(self):
+        witness = {'id': 'A', 'tokens': [{'t': 'vnd', 'n': 'und'}]}
+        cache = self.cache()
+        (_, missing) = cache.lookup(self.xmlfile, ['1'])
+        cache.update(self.xmlfile, missing, {'1': (witness, witness)})
+
+    def test_hit(self):
+        self.store()
+        (cached, missing) = self.cache().lookup(self.xmlfile, ['1'])
+        self.assertEqual(list(cached), ['1'])
+        self.assertEqual(missing, [])
+
+    def test_helper_changed(self):
+        self.store()
+        # normalise() itself is unchanged, what it calls is not
+        self.write_config(CONFIG.replace("{'vnd': 'und'}", "{'vnd': 'und', 'vmb': 'umb'}"))
+        (cached, missing) = self.cache().lookup(self.xmlfile, ['1'])
+        self.assertEqual(cached, dict())
+        self.assertEqual(missing, ['1'])
+
+    def test_load_config_once_on_path(self):
+        teixml2collatex.load_config(self.config)
+        teixml2collatex.load_config(self.config)
+        self.assertEqual(sys.path.count(os.path.dirname(self.config)), 1)
+
+
+class TestModes(unittest.TestCase):
+    """Runs the script on the TEI-XML of the fixture corpus in each of its
+    modes, which must all write the same milestone files"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+        indir = os.path.join(cls.tmpdir, 'transcription')
+        shutil.copytree(os.path.join(FILES, 'transcription'), indir)
+        merged = os.path.join(cls.tmpdir, 'merged')
+        os.makedirs(merged)
+        for ms in pipeline.merge_json.manuscripts(indir):
+            pipeline.merge_json.merge(indir, ms['files'], '%s/%s-merged.json' % (merged, ms['name']))
+        shutil.copy(os.path.join(indir, 'members.json'), merged)
+        os.makedirs(os.path.join(cls.tmpdir, 'tei-xml'))
+        sys.path.append(indir)
+        try:
+            json2xml.json2xml(merged, os.path.join(cls.tmpdir, 'tei-xml'), configmod='config',
+                              **json2xml.load_hooks('config'))
+        finally:
+            sys.modules.pop('config', None)
+            sys.path.remove(indir)
+        cls.default = cls.tokenize('default')
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpdir)
+
+    @classmethod
+    def tokenize(cls, name, *options):
+        """Runs the script with the given options into a directory of its own,
+        returns milestone file -> content"""
+        subprocess.run(
+            [sys.executable, os.path.abspath(teixml2collatex.__file__), 'tei-xml', name,
+             '-c', 'transcription/config'] + list(options),
+            cwd=cls.tmpdir, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        result = dict()
+        for filename in sorted(os.listdir(os.path.join(cls.tmpdir, name))):
+            with open(os.path.join(cls.tmpdir, name, filename), encoding='utf-8') as fh:
+                result[filename] = fh.read()
+        return result
+
+    def test_default(self):
+        self.assertEqual(sorted(self.default), ['milestone-1.json', 'milestone-2.json', 'milestone-3.json'])
+        witnesses = json.loads(self.default['milestone-1.json'])['witnesses']
+        self.assertEqual(sorted(w['id'] for w in witnesses), ['W001', 'W001 (a.c.)', 'W002', 'W002 (a.c.)'])
+        self.assertTrue(all(w['tokens'] for w in witnesses))
+
+    def test_single_pass(self):
+        self.assertEqual(self.tokenize('single-pass', '--single-pass'), self.default)
+
+    def test_jobs(self):
+        result = self.tokenize('jobs', '--jobs', '2')
+        for (name, content) in self.default.items():
+            # The witnesses come in the same order
+            self.assertEqual([w['id'] for w in json.loads(result[name])['witnesses']],
+                             [w['id'] for w in json.loads(content)['witnesses']])
+        self.assertEqual(result, self.default)
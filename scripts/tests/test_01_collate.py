@@ -0,0 +1,246 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import artifacts
+import collate
+from filecache import FileCache
+
+# Stands in for java, see the file
+FAKE_BIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'files', 'bin')
+
+
+def milestone(*sigla):
+    return {'witnesses': [{'id': s, 'tokens': [{'t': 'word'}]} for s in sigla]}
+
+
+class CollateTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.indir = os.path.join(self.tmpdir, 'tokens')
+        self.outdir = os.path.join(self.tmpdir, 'collations')
+        os.makedirs(self.indir)
+        os.makedirs(self.outdir)
+        self.jar = os.path.join(self.tmpdir, 'collatex.jar')
+        with open(self.jar, 'w') as fh:
+            fh.write('1.7.1')
+        self.log = os.path.join(self.tmpdir, 'java.log')
+        env = mock.patch.dict(os.environ, {
+            'PATH': FAKE_BIN + os.pathsep + os.environ['PATH'],
+            'FAKE_JAVA_LOG': self.log,
+            'FAKE_JAVA_CHILD': os.path.join(self.tmpdir, 'child.pid'),
+        })
+        env.start()
+        self.addCleanup(env.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write_milestone(self, name, data, fmt='plain'):
+        return artifacts.write_json(os.path.join(self.indir, 'milestone-%s.json' % name), data, fmt)
+
+    def runs(self):
+        """The number of times java was run"""
+        if not os.path.exists(self.log):
+            return 0
+        with open(self.log) as fh:
+            return len(fh.read().split())
+
+
+class TestCache(CollateTestCase):
+
+    def collate(self, infile, version):
+        cache = FileCache(os.path.join(self.tmpdir, 'cache'))
+        outfile = collate.output_file(self.outdir, os.path.basename(infile))
+        return collate.collate(infile, outfile, jar=self.jar, cache=cache, version=version)
+
+    def test_unchanged(self):
+        infile = self.write_milestone('1', milestone('A', 'B'))
+        version = collate.collatex_version(self.jar)
+        self.assertEqual(self.collate(infile, version), 'collated')
+        self.assertEqual(self.collate(infile, version), 'cached')
+        self.assertEqual(self.runs(), 1)
+        with open(os.path.join(self.outdir, 'milestone-1.json')) as fh:
+            self.assertEqual(json.load(fh)['witnesses'], ['A', 'B'])
+
+    def test_formatting_changed(self):
+        infile = self.write_milestone('1', milestone('A', 'B'))
+        version = collate.collatex_version(self.jar)
+        self.assertEqual(self.collate(infile, version), 'collated')
+        # The same tokens, written differently
+        infile = self.write_milestone('1', milestone('A', 'B'), 'gzip')
+        self.assertEqual(self.collate(infile, version), 'cached')
+        self.assertEqual(self.runs(), 1)
+
+    def test_tokens_changed(self):
+        infile = self.write_milestone('1', milestone('A', 'B'))
+        version = collate.collatex_version(self.jar)
+        self.assertEqual(self.collate(infile, version), 'collated')
+        infile = self.write_milestone('1', milestone('A', 'C'))
+        self.assertEqual(self.collate(infile, version), 'collated')
+        self.assertEqual(self.runs(), 2)
+
+    def test_version_changed(self):
+        infile = self.write_milestone('1', milestone('A', 'B'))
+        self.assertEqual(self.collate(infile, collate.collatex_version(self.jar)), 'collated')
+        with open(self.jar, 'w') as fh:
+            fh.write('1.8.0')
+        self.assertEqual(self.collate(infile, collate.collatex_version(self.jar)), 'collated')
+        self.assertEqual(self.runs(), 2)
+
+
+def alive(pid, wait=5):
+    """Whether the process pid is still running after up to wait seconds;
+    a zombie is not"""
+    deadline = time.monotonic() + wait
+    while True:
+        try:
+            with open('/proc/%d/stat' % pid) as fh:
+                if fh.read().rsplit(')', 1)[1].split()[0] == 'Z':
+                    return False
+        except FileNotFoundError:
+            return False
+        if time.monotonic() > deadline:
+            return True
+        time.sleep(0.1)
+
+
+class TestRun(CollateTestCase):
+
+    def args(self, **kwa):
+        args = dict(indir=self.indir, outdir=self.outdir, jobs=2, timeout=1, batch=False,
+                    jar=self.jar, cache=None, cache_size=1024, format='plain')
+        args.update(kwa)
+        return argparse.Namespace(**args)
+
+    def main(self, args):
+        (out, err) = (io.StringIO(), io.StringIO())
+        with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+            status = collate.main(args)
+        return (status, out.getvalue(), err.getvalue())
+
+    def test_timeout(self):
+        infile = self.write_milestone('1', milestone('sleep'))
+        outfile = os.path.join(self.outdir, 'milestone-1.json')
+        self.assertEqual(collate.run_collatex(self.jar, infile, outfile, timeout=1), 'timeout')
+        self.assertFalse(os.path.exists(outfile))
+        # The whole process group is gone, not only java
+        with open(os.path.join(self.tmpdir, 'child.pid')) as fh:
+            self.assertFalse(alive(int(fh.read())))
+
+    def test_failed(self):
+        infile = self.write_milestone('1', milestone('fail'))
+        outfile = os.path.join(self.outdir, 'milestone-1.json')
+        self.assertEqual(collate.run_collatex(self.jar, infile, outfile, timeout=1), 'failed')
+        self.assertFalse(os.path.exists(outfile))
+
+    def test_exit_status_timeout(self):
+        self.write_milestone('1', milestone('A', 'B'))
+        self.write_milestone('2', milestone('sleep', 'B'))
+        (status, out, err) = self.main(self.args())
+
+        # A milestone that timed out is left out, but is not a failure
+        self.assertEqual(status, 0)
+        self.assertEqual(sorted(re.search(r': (\S+ \w+) in [\d.]+s$', line).group(1)
+                                for line in out.splitlines()),
+                         ['milestone-1.json collated', 'milestone-2.json timeout'])
+        self.assertEqual(err, 'timed out: milestone-2.json\n')
+        self.assertEqual(sorted(os.listdir(self.outdir)), ['milestone-1.json'])
+
+    def test_gzip(self):
+        self.write_milestone('1', milestone('A', 'B'), 'gzip')
+        self.write_milestone('2', milestone('A', 'C'), 'compact')
+        (status, out, err) = self.main(self.args(format='gzip'))
+        self.assertEqual(status, 0)
+        self.assertEqual(sorted(os.listdir(self.outdir)), ['milestone-1.json.gz', 'milestone-2.json.gz'])
+        for (name, witnesses) in (('1', ['A', 'B']), ('2', ['A', 'C'])):
+            path = os.path.join(self.outdir, 'milestone-%s.json.gz' % name)
+            with open(path, 'rb') as fh:
+                self.assertEqual(fh.read(2), artifacts.GZIP_MAGIC)
+            self.assertEqual(artifacts.load_json(path)['witnesses'], witnesses)
+
+    def test_exit_status_failed(self):
+        self.write_milestone('1', milestone('fail', 'B'))
+        self.write_milestone('2', milestone('sleep', 'B'))
+        self.write_milestone('3', milestone('A', 'B'))
+        (status, out, err) = self.main(self.args())
+
+        self.assertEqual(status, 1)
+        self.assertEqual(err, 'timed out: milestone-2.json\nfailed: milestone-1.json\n')
+        self.assertEqual(sorted(os.listdir(self.outdir)), ['milestone-3.json'])
+
+
+class TestBatch(CollateTestCase):
+
+    def setUp(self):
+        super().setUp()
+        # Slow enough to catch anyone who talks to a server that isn't up yet
+        os.environ['FAKE_JAVA_STARTUP'] = '1'
+        self.server = collate.CollationServer(self.jar, 4)
+        self.server.start()
+        self.addCleanup(self.server.stop)
+
+    def starts(self):
+        with open(self.log) as fh:
+            return fh.read().split().count('http')
+
+    def collate_all(self, timeouts, delays=dict()):
+        """Collates milestone -> timeout at the same time, or so many seconds
+        later as given in delays. Returns milestone -> outcome."""
+        outcomes = dict()
+
+        def run(name, timeout):
+            time.sleep(delays.get(name, 0))
+            outcomes[name] = self.server.collate(
+                os.path.join(self.indir, 'milestone-%s.json' % name),
+                os.path.join(self.outdir, 'milestone-%s.json' % name),
+                timeout)
+
+        threads = [threading.Thread(target=run, args=item) for item in timeouts.items()]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return outcomes
+
+    def test_collate(self):
+        self.write_milestone('1', milestone('A', 'B'))
+        self.write_milestone('2', milestone('fail', 'B'))
+        self.assertEqual(self.collate_all({'1': 10, '2': 10}), {'1': 'collated', '2': 'failed'})
+        with open(os.path.join(self.outdir, 'milestone-1.json')) as fh:
+            self.assertEqual(json.load(fh)['witnesses'], ['A', 'B'])
+        # A CollateX error is the milestone's, the server stays up
+        self.assertEqual(self.starts(), 1)
+
+    def test_sibling_timeout(self):
+        # The second and third are in progress when the server is restarted
+        # because of the first, and are collated on the new one. The fourth
+        # comes along while the new one is starting, and waits for it.
+        self.write_milestone('1', milestone('hang', 'B'))
+        self.write_milestone('2', milestone('hang-once', 'B'))
+        self.write_milestone('3', milestone('hang-once', 'C'))
+        self.write_milestone('4', milestone('A', 'B'))
+        self.assertEqual(self.collate_all({'1': 1, '2': 10, '3': 10, '4': 10}, delays={'4': 1.5}),
+                         {'1': 'timeout', '2': 'collated', '3': 'collated', '4': 'collated'})
+        self.assertEqual(self.starts(), 2)
+
+    def test_main(self):
+        self.write_milestone('1', milestone('A', 'B'))
+        self.write_milestone('2', milestone('A', 'C'), 'gzip')
+        args = argparse.Namespace(indir=self.indir, outdir=self.outdir, jobs=2, timeout=10, batch=True,
+                                  jar=self.jar, cache=None, cache_size=1024, format='compact')
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertEqual(collate.main(args), 0)
+        self.assertEqual(sorted(os.listdir(self.outdir)), ['milestone-1.json', 'milestone-2.json'])
+        self.assertEqual(artifacts.load_json(os.path.join(self.outdir, 'milestone-2.json'))['witnesses'],
+                         ['A', 'C'])
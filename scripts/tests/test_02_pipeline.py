@@ -0,0 +1,134 @@
+import argparse
+import contextlib
+import io
+import os
+import re
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+import pipeline
+
+FILES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'files')
+# Stands in for java, see the file
+FAKE_BIN = os.path.join(FILES, 'bin')
+
+
+class PipelineTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        # Two manuscripts of two T-PEN projects each, with milestones 1 to 3,
+        # as benchmarks/corpus.py makes them
+        self.indir = os.path.join(self.tmpdir, 'transcription')
+        shutil.copytree(os.path.join(FILES, 'transcription'), self.indir)
+        self.jar = os.path.join(self.tmpdir, 'collatex.jar')
+        with open(self.jar, 'w') as fh:
+            fh.write('1.7.1')
+        env = mock.patch.dict(os.environ, {'PATH': FAKE_BIN + os.pathsep + os.environ['PATH']})
+        env.start()
+        self.addCleanup(env.stop)
+
+    def tearDown(self):
+        sys.modules.pop('config', None)
+        while self.indir in sys.path:
+            sys.path.remove(self.indir)
+        shutil.rmtree(self.tmpdir)
+
+    def context(self, **kwa):
+        args = dict(indir=self.indir, tei_dir=None, workdir=os.path.join(self.tmpdir, 'work'),
+                    schema=None, jobs=None, jar=self.jar, timeout=10, format='plain',
+                    cache=None, cache_size=1024, config=os.path.join(self.indir, 'config'),
+                    milestone=None)
+        args.update(kwa)
+        return pipeline.Context(argparse.Namespace(**args))
+
+    def run_pipeline(self, ctx=None):
+        """Runs the pipeline, returns the names of the failed tasks and
+        stage -> number of tasks built"""
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out), contextlib.redirect_stderr(io.StringIO()):
+            failed = pipeline.run_pipeline(ctx or self.context())
+        built = dict((m.group(1), int(m.group(2))) for m in re.finditer(
+            r'^(\w+): \d+ tasks, (\d+) built', out.getvalue(), re.MULTILINE))
+        return (failed, built)
+
+    def edit(self, name, old, new):
+        path = os.path.join(self.indir, name)
+        with open(path, encoding='utf-8') as fh:
+            content = fh.read()
+        self.assertIn(old, content)
+        with open(path, 'w', encoding='utf-8') as fh:
+            fh.write(content.replace(old, new))
+
+
+class TestState(PipelineTestCase):
+
+    def test_fresh(self):
+        infile = os.path.join(self.tmpdir, 'in')
+        outfile = os.path.join(self.tmpdir, 'out')
+        for path in (infile, outfile):
+            with open(path, 'w') as fh:
+                fh.write('a')
+        state = pipeline.State(os.path.join(self.tmpdir, 'state.json'))
+        task = pipeline.Task('t', [infile], [outfile], params=['1.0'])
+        self.assertFalse(state.fresh('s', task))
+        state.record('s', task)
+        self.assertTrue(state.fresh('s', task))
+
+        # Kept between runs
+        state.save()
+        state = pipeline.State(os.path.join(self.tmpdir, 'state.json'))
+        self.assertTrue(state.fresh('s', task))
+
+        # Other settings
+        self.assertFalse(state.fresh('s', pipeline.Task('t', [infile], [outfile], params=['1.1'])))
+
+        # A changed input, or a changed or missing output
+        for path in (infile, outfile):
+            with open(path, 'w') as fh:
+                fh.write('b')
+            self.assertFalse(state.fresh('s', task))
+            state.record('s', task)
+        os.unlink(outfile)
+        self.assertFalse(state.fresh('s', task))
+
+
+class TestPipeline(PipelineTestCase):
+
+    def test_incremental(self):
+        self.assertEqual(self.run_pipeline(),
+                         ([], dict(merge=2, tei=2, validate=0, tokenize=3, collate=3)))
+        self.assertEqual(self.run_pipeline(),
+                         ([], dict(merge=0, tei=0, validate=0, tokenize=0, collate=0)))
+
+        # A word of milestone 3 in the second project of the second
+        # manuscript: the first manuscript is left alone, and of the
+        # milestones of the second only the one that changed is collated
+        self.edit('Ms002 2.json', 'basayansu', 'basayan')
+        self.assertEqual(self.run_pipeline(),
+                         ([], dict(merge=1, tei=1, validate=0, tokenize=3, collate=1)))
+        self.assertEqual(self.run_pipeline(),
+                         ([], dict(merge=0, tei=0, validate=0, tokenize=0, collate=0)))
+
+    def test_collatex_settings_changed(self):
+        self.run_pipeline()
+        self.assertEqual(self.run_pipeline(self.context(format='compact')),
+                         ([], dict(merge=0, tei=0, validate=0, tokenize=3, collate=3)))
+
+    def test_jar_missing(self):
+        os.unlink(self.jar)
+        (failed, built) = self.run_pipeline()
+        self.assertEqual(sorted(failed), ['collate:milestone-%d.json' % n for n in (1, 2, 3)])
+        self.assertEqual(built['tokenize'], 3)
+
+    def test_java_missing(self):
+        with mock.patch('collate.subprocess.Popen', side_effect=FileNotFoundError('java')):
+            (failed, built) = self.run_pipeline(self.context(jobs=2))
+        self.assertEqual(sorted(failed), ['collate:milestone-%d.json' % n for n in (1, 2, 3)])
+
+        # Collated next time
+        self.assertEqual(self.run_pipeline(),
+                         ([], dict(merge=0, tei=0, validate=0, tokenize=0, collate=3)))
@@ -0,0 +1,322 @@
+import argparse
+import contextlib
+import http.server
+import io
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import artifacts
+import stemmarest
+
+# Stands in for java, see the file
+FAKE_BIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'files', 'bin')
+
+
+class FakeStemmarest(http.server.ThreadingHTTPServer):
+    """Stands in for a Stemmarest server, with the traditions and their
+    sections in memory. Requests that match one of the faults get its
+    answer instead, once each."""
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), FakeStemmarestHandler)
+        # tradition ID -> list of (section ID, name)
+        self.traditions = dict()
+        # (method, path, section name or None) of every request
+        self.requests = []
+        # section name -> body of its upload
+        self.uploaded = dict()
+        # (method, path pattern, status, headers, body), plus the name of
+        # the section, if only its upload is to fail
+        self.faults = []
+        self.counter = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.server_address[1]
+
+    def sections(self, tradid):
+        return [name for (_, name) in self.traditions.get(tradid)]
+
+    def fault(self, method, path, name):
+        for f in self.faults:
+            if f[0] == method and re.search(f[1], path) and f[5:] in ((), (name,)):
+                self.faults.remove(f)
+                return f
+        return None
+
+    def next_id(self):
+        self.counter += 1
+        return str(self.counter)
+
+
+class FakeStemmarestHandler(http.server.BaseHTTPRequestHandler):
+
+    def answer(self, status, data=None, headers=dict(), body=None):
+        if body is None:
+            body = json.dumps(data).encode('utf-8') if data is not None else b''
+        self.send_response(status)
+        for (k, v) in headers.items():
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_request(self, method):
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        name = re.search(rb'name="name"\r\n\r\n([^\r]*)\r\n', body)
+        name = name and name.group(1).decode('utf-8')
+        server = self.server
+        with server.lock:
+            server.requests.append((method, self.path, name))
+            fault = server.fault(method, self.path, name)
+            if fault is not None:
+                (status, headers, text) = fault[2:5]
+                return self.answer(status, headers=headers, body=text.encode('utf-8'))
+
+            m = re.match(r'^/tradition/([^/]+)(?:/section(?:/([^/]+))?)?$', self.path)
+            if method == 'PUT' and self.path.startswith('/user/'):
+                return self.answer(200, {})
+            if method == 'POST' and self.path == '/tradition':
+                tradid = 't' + server.next_id()
+                server.traditions[tradid] = []
+                return self.answer(201, {'tradId': tradid})
+            if m is None or m.group(1) not in server.traditions:
+                return self.answer(404, {})
+            sections = server.traditions[m.group(1)]
+            if method == 'GET':
+                return self.answer(200, {'id': m.group(1)})
+            if method == 'POST':
+                section = 's' + server.next_id()
+                sections.append((section, name))
+                server.uploaded[name] = body
+                return self.answer(201, {'parentId': section})
+            if method == 'DELETE':
+                sections[:] = [s for s in sections if s[0] != m.group(2)]
+                return self.answer(200, {})
+            return self.answer(405, {})
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_PUT(self):
+        self.handle_request('PUT')
+
+    def do_DELETE(self):
+        self.handle_request('DELETE')
+
+    def log_message(self, *args):
+        pass
+
+
+def milestone(*sigla):
+    return {'witnesses': [{'id': s, 'tokens': [{'t': 'word'}]} for s in sigla]}
+
+
+class StemmarestTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.indir = os.path.join(self.tmpdir, 'tokens')
+        os.makedirs(self.indir)
+        self.jar = os.path.join(self.tmpdir, 'collatex.jar')
+        with open(self.jar, 'w') as fh:
+            fh.write('1.7.1')
+        env = mock.patch.dict(os.environ, {
+            'PATH': FAKE_BIN + os.pathsep + os.environ['PATH'],
+            'SW_PASS': 'secret',
+        })
+        env.start()
+        self.addCleanup(env.stop)
+
+        self.server = FakeStemmarest()
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        # Don't wait between attempts, but see how long we would have
+        self.sleep = mock.Mock()
+        clock = mock.patch('stemmarest.time', mock.Mock(wraps=time, sleep=self.sleep))
+        clock.start()
+        self.addCleanup(clock.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write_milestone(self, name, data, fmt='plain'):
+        artifacts.write_json(os.path.join(self.indir, 'milestone-%s.json' % name), data, fmt)
+
+    def args(self, **kwa):
+        args = dict(indir=self.indir, outdir=os.path.join(self.tmpdir, 'collations'),
+                    api=self.server.url, user='user@example.org', name='Test', language='Armenian',
+                    jobs=3, timeout=10, batch=False, jar=self.jar, cache=None, checkpoint=None,
+                    backoff=1, cache_size=1024, format='plain')
+        args.update(kwa)
+        return argparse.Namespace(**args)
+
+    def main(self, args=None):
+        (out, err) = (io.StringIO(), io.StringIO())
+        with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+            status = stemmarest.main(args or self.args())
+        return (status, err.getvalue())
+
+    def uploads(self):
+        """The sections uploaded, in the order they were"""
+        return [name for (method, path, name) in self.server.requests
+                if method == 'POST' and path.endswith('/section')]
+
+
+class TestUpload(StemmarestTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.write_milestone('1', milestone('A', 'B'))
+        self.write_milestone('2', milestone('A', 'C'))
+        self.write_milestone('3', milestone('B', 'C'))
+
+    def test_upload(self):
+        self.assertEqual(self.main(), (0, ''))
+        # Collated three at a time, uploaded in order
+        self.assertEqual(list(self.server.traditions), ['t1'])
+        self.assertEqual(self.server.sections('t1'), ['milestone-1', 'milestone-2', 'milestone-3'])
+        self.sleep.assert_not_called()
+
+    def test_gzip(self):
+        # Tokens and collations gzipped, but the sections go up as JSON
+        artifacts.remove(os.path.join(self.indir, 'milestone-2.json'))
+        self.write_milestone('2', milestone('A', 'C'), 'gzip')
+        self.assertEqual(self.main(self.args(format='gzip')), (0, ''))
+        self.assertEqual(self.server.sections('t1'), ['milestone-1', 'milestone-2', 'milestone-3'])
+        self.assertEqual(sorted(os.listdir(os.path.join(self.tmpdir, 'collations'))),
+                         ['milestone-1.json.gz', 'milestone-2.json.gz', 'milestone-3.json.gz'])
+        body = self.server.uploaded['milestone-2']
+        self.assertIn(b'filename="milestone-2.json"', body)
+        self.assertIn(b'\r\n\r\n{"witnesses":["A","C"],"table":[]}\r\n', body)
+
+    def test_gateway_errors(self):
+        self.server.faults = [
+            ('POST', '/section$', 502, {}, ''),
+            # A proxy that answers with an error page
+            ('POST', '/section$', 200, {}, '<h1>502 Bad Gateway</h1>'),
+            ('POST', '/section$', 503, {'Retry-After': '7'}, ''),
+        ]
+        self.assertEqual(self.main(), (0, ''))
+        self.assertEqual(self.server.sections('t1'), ['milestone-1', 'milestone-2', 'milestone-3'])
+        self.assertEqual(self.uploads(), ['milestone-1'] * 4 + ['milestone-2', 'milestone-3'])
+
+        # Backing off, but waiting as long as the server asked to
+        delays = [c.args[0] for c in self.sleep.call_args_list]
+        self.assertEqual(len(delays), 3)
+        self.assertTrue(0.5 <= delays[0] <= 1)
+        self.assertTrue(1 <= delays[1] <= 2)
+        self.assertEqual(delays[2], 7)
+
+    def test_too_many_gateway_errors(self):
+        self.server.faults = [('POST', '/section$', 504, {}, '')] * stemmarest.ATTEMPTS
+        (status, err) = self.main()
+        self.assertEqual(status, 1)
+        self.assertIn('giving up: too many gateway errors', err)
+        self.assertEqual(self.server.sections('t1'), [])
+
+    def test_rejected(self):
+        self.server.faults = [('POST', '/section$', 400, {}, 'bad collation')]
+        (status, err) = self.main()
+        # Not repeated, and the next milestones still go up
+        self.assertEqual(status, 1)
+        self.assertEqual(err, 'failed: milestone-1.json\n')
+        self.assertEqual(self.server.sections('t1'), ['milestone-2', 'milestone-3'])
+        self.assertEqual(self.uploads(), ['milestone-1', 'milestone-2', 'milestone-3'])
+
+
+
+class TestCheckpoint(StemmarestTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.write_milestone('1', milestone('A', 'B'))
+        self.write_milestone('2', milestone('A', 'C'))
+        self.write_milestone('3', milestone('B', 'C'))
+        self.checkpoint = os.path.join(self.tmpdir, 'checkpoint.json')
+        self.resume = self.args(checkpoint=self.checkpoint)
+
+    def interrupt(self):
+        """Runs an upload that gives up at the last section"""
+        self.server.faults = [('POST', '/section$', 503, {}, '', 'milestone-3')] * stemmarest.ATTEMPTS
+        (status, err) = self.main(self.resume)
+        self.assertEqual(status, 1)
+        self.assertIn('the next run will resume from %s' % self.checkpoint, err)
+        self.assertEqual(self.server.sections('t1'), ['milestone-1', 'milestone-2'])
+        self.server.requests = []
+
+    def sections(self):
+        """Returns the IDs of the sections of the tradition"""
+        return [section for (section, _) in self.server.traditions.get('t1')]
+
+    def test_resume(self):
+        self.interrupt()
+        uploaded = self.sections()
+        self.assertEqual(self.main(self.resume), (0, ''))
+
+        # Into the same tradition, only the missing section
+        self.assertEqual(list(self.server.traditions), ['t1'])
+        self.assertEqual(self.uploads(), ['milestone-3'])
+        self.assertEqual(self.server.sections('t1'), ['milestone-1', 'milestone-2', 'milestone-3'])
+        self.assertEqual(self.sections()[:2], uploaded)
+        # Done, so the next run starts a new tradition
+        self.assertFalse(os.path.exists(self.checkpoint))
+
+    def test_changed(self):
+        self.interrupt()
+        uploaded = self.sections()
+        self.write_milestone('1', milestone('A', 'B', 'C'))
+        self.assertEqual(self.main(self.resume), (0, ''))
+
+        # Sections can only be appended, so those after the changed one go
+        # first, last first, and are uploaded again
+        self.assertEqual([(method, path) for (method, path, _) in self.server.requests
+                          if method == 'DELETE'],
+                         [('DELETE', '/tradition/t1/section/%s' % s) for s in reversed(uploaded)])
+        self.assertEqual(self.uploads(), ['milestone-1', 'milestone-2', 'milestone-3'])
+        self.assertEqual(self.server.sections('t1'), ['milestone-1', 'milestone-2', 'milestone-3'])
+        self.assertFalse(os.path.exists(self.checkpoint))
+
+    def test_milestone_gone(self):
+        self.interrupt()
+        os.unlink(os.path.join(self.indir, 'milestone-2.json'))
+        self.assertEqual(self.main(self.resume), (0, ''))
+        self.assertEqual(self.uploads(), ['milestone-3'])
+        self.assertEqual(self.server.sections('t1'), ['milestone-1', 'milestone-3'])
+
+    def test_tradition_gone(self):
+        self.interrupt()
+        del self.server.traditions['t1']
+        self.assertEqual(self.main(self.resume), (0, ''))
+
+        # Started over in a new tradition
+        (tradid,) = self.server.traditions
+        self.assertNotEqual(tradid, 't1')
+        self.assertEqual(self.uploads(), ['milestone-1', 'milestone-2', 'milestone-3'])
+        self.assertEqual(self.server.sections(tradid), ['milestone-1', 'milestone-2', 'milestone-3'])
+        self.assertFalse(os.path.exists(self.checkpoint))
+
+    def test_other_tradition(self):
+        self.interrupt()
+        self.assertEqual(self.main(self.args(checkpoint=self.checkpoint, name='Other')), (0, ''))
+
+        # The unfinished upload of another tradition is left as it is
+        self.assertEqual(self.uploads(), ['milestone-1', 'milestone-2', 'milestone-3'])
+        self.assertEqual(self.server.sections('t1'), ['milestone-1', 'milestone-2'])
+        self.assertEqual(len(self.server.traditions), 2)
+        self.assertFalse(os.path.exists(self.checkpoint))
@@ -0,0 +1,137 @@
+import argparse
+import contextlib
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import validate
+
+SCHEMA = '''<element name="doc" xmlns="http://relaxng.org/ns/structure/1.0">
+  <oneOrMore>
+    <element name="p"><text/></element>
+  </oneOrMore>
+</element>
+'''
+
+FILES = {
+    'good.xml': '<doc><p>a</p></doc>\n',
+    'invalid.xml': '<doc>\n<p>a</p>\n<q/>\n</doc>\n',
+    'broken.xml': '<doc>\n\t<p>a\n</doc>\n',
+}
+
+# What the loop of xmllint --noout --relaxng that validate.py replaces
+# printed for the files above, and a missing one
+XMLLINT = '''=== {dir}/good.xml ===
+{dir}/good.xml validates
+=== {dir}/invalid.xml ===
+{dir}/invalid.xml:3: element q: Relax-NG validity error : Did not expect element q there
+{dir}/invalid.xml fails to validate
+=== {dir}/broken.xml ===
+{dir}/broken.xml:3: parser error : Opening and ending tag mismatch: p line 2 and doc
+</doc>
+      ^
+=== {dir}/missing.xml ===
+warning: failed to load external entity "{dir}/missing.xml"
+'''
+
+
+class ValidateTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.schema = self.write('schema.rng', SCHEMA)
+        self.files = [self.write(name, content) for (name, content) in FILES.items()]
+        self.files.append(os.path.join(self.tmpdir, 'missing.xml'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, name, content):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'w', encoding='utf-8') as fh:
+            fh.write(content)
+        return path
+
+    def main(self, files, **kwa):
+        args = dict(schema=self.schema, files=files, jobs=1, cache=None, cache_size=64)
+        args.update(kwa)
+        (out, err) = (io.StringIO(), io.StringIO())
+        with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+            status = validate.main(argparse.Namespace(**args))
+        return (status, out.getvalue(), err.getvalue())
+
+
+class TestValidate(ValidateTestCase):
+
+    def test_report(self):
+        for jobs in (1, 2):
+            (status, out, err) = self.main(self.files, jobs=jobs)
+            self.assertEqual(out, XMLLINT.format(dir=self.tmpdir) + 'Some files failed to validate\n')
+            # 3 for the invalid file, 4 for each one that cannot be read
+            self.assertEqual(status, 3 + 4 + 4)
+
+    def test_valid(self):
+        good = self.files[0]
+        self.assertEqual(self.main([good]), (0, '=== %s ===\n%s validates\n' % (good, good), ''))
+
+    def test_schema_error(self):
+        self.write('schema.rng', '<element')
+        (status, out, err) = self.main(self.files)
+        self.assertEqual(status, validate.SCHEMA_ERROR)
+        self.assertEqual(out, '')
+        self.assertEqual(err, 'Relax-NG schema %s failed to compile\n' % self.schema)
+
+    def test_status_capped(self):
+        # 86 invalid files make 258, which a shell would have seen as 2
+        files = [self.write('invalid-%d.xml' % n, FILES['invalid.xml']) for n in range(86)]
+        self.assertEqual(self.main(files)[0], 255)
+
+
+class TestCache(ValidateTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.cache = os.path.join(self.tmpdir, 'cache')
+
+    def main_cached(self, files):
+        """Runs validate.py with the cache, returns its status, its report
+        without the line about the cache, and the files it validated"""
+        validated = []
+
+        def validate_file(schema, path):
+            validated.append(path)
+            return real(schema, path)
+
+        real = validate.validate_file
+        with mock.patch('validate.validate_file', validate_file):
+            (status, out, err) = self.main(files, cache=self.cache)
+        report = [line for line in out.splitlines() if not line.startswith('validation cache')]
+        return (status, report, validated)
+
+    def test_cached(self):
+        (status, report, validated) = self.main_cached(self.files)
+        self.assertEqual(status, 11)
+        self.assertEqual(validated, self.files)
+
+        # Failures are reported just the same; a missing file has nothing
+        # to be cached by
+        self.assertEqual(self.main_cached(self.files), (status, report, self.files[-1:]))
+
+    def test_file_changed(self):
+        self.main_cached(self.files[:2])
+        invalid = self.write('invalid.xml', FILES['good.xml'])
+        (status, report, validated) = self.main_cached(self.files[:2])
+        self.assertEqual(status, 0)
+        self.assertEqual(validated, [invalid])
+        self.assertIn('%s validates' % invalid, report)
+
+    def test_schema_changed(self):
+        self.main_cached(self.files[:2])
+        self.write('schema.rng', SCHEMA.replace('<element name="p">', '<element name="q">'))
+        (status, report, validated) = self.main_cached(self.files[:2])
+        # Neither validates now
+        self.assertEqual(status, 6)
+        self.assertEqual(validated, self.files[:2])
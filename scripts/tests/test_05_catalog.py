@@ -0,0 +1,100 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import catalog
+
+TEI = '''<TEI xmlns="http://www.tei-c.org/ns/1.0">
+<teiHeader><fileDesc><sourceDesc><msDesc xml:id="{sigil}"/></sourceDesc></fileDesc></teiHeader>
+<text><body>
+{body}
+</body></text>
+</TEI>
+'''
+
+
+class TestMergeOrders(unittest.TestCase):
+
+    def test_agree(self):
+        # Each witness lacks some milestones, but they all agree
+        self.assertEqual(catalog.merge_orders([['1', '3', '5'], ['2', '3', '4', '5'], ['1', '2']]),
+                         ['1', '2', '3', '4', '5'])
+
+    def test_ties(self):
+        # Nothing says whether 2 or 4 comes first, so the first seen does
+        self.assertEqual(catalog.merge_orders([['1', '4'], ['1', '2'], ['2', '3'], ['4', '3']]),
+                         ['1', '4', '2', '3'])
+
+    def test_disagree(self):
+        self.assertEqual(catalog.merge_orders([['1', '2', '3'], ['1', '3', '2']]), ['1', '2', '3'])
+        self.assertEqual(catalog.merge_orders([]), [])
+
+
+class TestCatalog(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.indir = os.path.join(self.tmpdir, 'tei-xml')
+        os.makedirs(self.indir)
+        self.write('A.xml', 'A', '<p><milestone n="1"/>one two <del>three</del> <milestone n="2"/>four</p>')
+        self.write('B.xml', 'B', '<p>\n<milestone n="2"/>five six seven\n<milestone n="3"/>eight</p>')
+        self.path = os.path.join(self.tmpdir, 'catalog.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, name, sigil, body):
+        with open(os.path.join(self.indir, name), 'w', encoding='utf-8') as fh:
+            fh.write(TEI.format(sigil=sigil, body=body))
+
+    def refresh(self):
+        """Refreshes the saved catalog, returns it and the files it parsed"""
+        parsed = []
+
+        def index_file(path):
+            parsed.append(os.path.basename(path))
+            return real(path)
+
+        real = catalog.index_file
+        mscatalog = catalog.Catalog(self.path)
+        with mock.patch('catalog.index_file', index_file):
+            mscatalog.refresh(self.indir)
+        mscatalog.save()
+        return (mscatalog, parsed)
+
+    def test_index(self):
+        (mscatalog, parsed) = self.refresh()
+        self.assertEqual(parsed, ['A.xml', 'B.xml'])
+        self.assertEqual(mscatalog.milestones(), ['1', '2', '3'])
+        self.assertEqual(mscatalog.files_with('2'), ['A.xml', 'B.xml'])
+        self.assertEqual(mscatalog.files_with('3'), ['B.xml'])
+        # Deleted text is not counted
+        self.assertEqual(mscatalog.summary(), [('1', 1, 2), ('2', 2, 4), ('3', 1, 1)])
+        self.assertEqual(mscatalog.files['B.xml']['sigil'], 'B')
+        self.assertEqual([(m['n'], m['line'], m['start']) for m in mscatalog.files['B.xml']['milestones']],
+                         [('2', 5, 0), ('3', 6, 3)])
+
+    def test_refresh(self):
+        self.refresh()
+        # Nothing changed, so nothing is hashed or parsed again
+        with mock.patch('catalog.file_hash') as file_hash:
+            (mscatalog, parsed) = self.refresh()
+        file_hash.assert_not_called()
+        self.assertEqual(parsed, [])
+        self.assertEqual(mscatalog.milestones(), ['1', '2', '3'])
+
+        # Touched, but the same content: hashed, not parsed
+        os.utime(os.path.join(self.indir, 'A.xml'), ns=(0, 0))
+        (mscatalog, parsed) = self.refresh()
+        self.assertEqual(parsed, [])
+
+        # Changed, added and removed files
+        self.write('A.xml', 'A', '<p><milestone n="1"/>one <milestone n="4"/>two</p>')
+        self.write('C.xml', 'C', '<p><milestone n="0"/>zero <milestone n="1"/>one</p>')
+        os.unlink(os.path.join(self.indir, 'B.xml'))
+        (mscatalog, parsed) = self.refresh()
+        self.assertEqual(parsed, ['A.xml', 'C.xml'])
+        self.assertEqual(sorted(mscatalog.files), ['A.xml', 'C.xml'])
+        self.assertEqual(mscatalog.milestones(), ['0', '1', '4'])
@@ -0,0 +1,114 @@
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+import json2xml
+
+FILES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'files')
+
+
+def shout(line):
+    return line.upper()
+
+
+class Json2XmlTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        # Two manuscripts of two T-PEN projects each, as benchmarks/corpus.py makes them
+        self.indir = os.path.join(self.tmpdir, 'transcription')
+        shutil.copytree(os.path.join(FILES, 'transcription'), self.indir)
+        sys.path.append(self.indir)
+        logging.disable(logging.CRITICAL)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+        sys.modules.pop('config', None)
+        while self.indir in sys.path:
+            sys.path.remove(self.indir)
+        shutil.rmtree(self.tmpdir)
+
+    def outdir(self, name):
+        path = os.path.join(self.tmpdir, name)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def read_all(self, outdir):
+        """Returns TEI-XML file -> content of the files in outdir"""
+        result = dict()
+        for name in sorted(os.listdir(outdir)):
+            if name.endswith('.tei.xml'):
+                with open(os.path.join(outdir, name), encoding='utf-8') as fh:
+                    result[name] = fh.read()
+        return result
+
+
+class TestJobs(Json2XmlTestCase):
+
+    def test_same_output(self):
+        serial = self.outdir('serial')
+        pool = self.outdir('pool')
+        json2xml.json2xml(self.indir, serial, text_filter=shout)
+        json2xml.json2xml(self.indir, pool, text_filter=shout, jobs=2)
+
+        result = self.read_all(serial)
+        self.assertEqual(sorted(result), ['Ms001 1.json.tei.xml', 'Ms001 2.json.tei.xml',
+                                          'Ms002 1.json.tei.xml', 'Ms002 2.json.tei.xml'])
+        self.assertEqual(self.read_all(pool), result)
+
+        # The hooks were used by the workers, too
+        plain = self.outdir('plain')
+        json2xml.json2xml(self.indir, plain)
+        for name, content in self.read_all(plain).items():
+            self.assertNotEqual(content, result[name])
+
+
+class TestManifest(Json2XmlTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.teidir = self.outdir('tei-xml')
+        self.assertEqual(len(self.convert()), 4)
+
+    def convert(self, **kwa):
+        """Runs json2xml on the corpus, returns the files it converted"""
+        with mock.patch('json2xml.convert', wraps=json2xml.convert) as convert:
+            json2xml.json2xml(self.indir, self.teidir, configmod='config',
+                              **json2xml.load_hooks('config'), **kwa)
+        return sorted(c.args[2] for c in convert.call_args_list)
+
+    def append(self, name, text):
+        with open(os.path.join(self.indir, name), 'a', encoding='utf-8') as fh:
+            fh.write(text)
+
+    def test_unchanged(self):
+        self.assertEqual(self.convert(), [])
+        self.assertIn('Ms001 1.json.tei.xml', json2xml.load_manifest(self.teidir))
+
+    def test_input_changed(self):
+        self.append('Ms002 2.json', '\n')
+        self.assertEqual(self.convert(), ['Ms002 2.json'])
+        self.assertEqual(self.convert(), [])
+
+    def test_members_changed(self):
+        self.append('members.json', '\n')
+        self.assertEqual(len(self.convert()), 4)
+        self.assertEqual(self.convert(), [])
+
+    def test_config_changed(self):
+        self.append('config.py', '\n# changed\n')
+        self.assertEqual(len(self.convert()), 4)
+        self.assertEqual(self.convert(), [])
+
+    def test_output_deleted(self):
+        os.unlink(os.path.join(self.teidir, 'Ms001 2.json.tei.xml'))
+        self.assertEqual(self.convert(), ['Ms001 2.json'])
+        self.assertTrue(os.path.exists(os.path.join(self.teidir, 'Ms001 2.json.tei.xml')))
+
+    def test_force(self):
+        self.assertEqual(len(self.convert(force=True)), 4)
+        self.assertEqual(self.convert(), [])
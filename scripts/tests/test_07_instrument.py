@@ -0,0 +1,103 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import instrument
+
+
+def work(seconds):
+    time.sleep(seconds)
+    return seconds
+
+
+class TestRecorder(unittest.TestCase):
+
+    def test_measure(self):
+        recorder = instrument.Recorder('test')
+        with recorder.measure('file', 'a'):
+            time.sleep(0.05)
+        with self.assertRaises(ValueError):
+            with recorder.measure('file', 'b'):
+                raise ValueError('b')
+
+        # Measured even when the work failed
+        self.assertEqual(sorted(recorder.items['file']), ['a', 'b'])
+        measurement = recorder.items['file']['a']
+        self.assertGreaterEqual(measurement['wall'], 0.05)
+        # Sleeping takes no CPU time
+        self.assertLess(measurement['cpu'], measurement['wall'])
+        self.assertGreater(measurement['maxrss_kb'], 0)
+
+    def test_add(self):
+        recorder = instrument.Recorder('test')
+        (result, measurement) = instrument.measure_call(work, 0.01)
+        self.assertEqual(result, 0.01)
+        recorder.add('file', 'a', measurement)
+        recorder.add('file', 'b', dict(measurement, wall=5.0, cpu=1.0))
+        recorder.add('milestone', '1', measurement)
+
+        totals = recorder.report()['totals']
+        self.assertEqual(sorted(totals), ['file', 'milestone'])
+        self.assertEqual(totals['file']['count'], 2)
+        self.assertEqual(totals['file']['slowest'], 'b')
+        self.assertEqual(totals['file']['slowest_wall'], 5.0)
+        self.assertEqual(totals['file']['wall'], round(5.0 + measurement['wall'], 6))
+        self.assertIn('2 files, slowest b in 5.0s', recorder.summary())
+        self.assertIn('1 milestones', recorder.summary())
+
+    def test_threads(self):
+        recorder = instrument.Recorder('test')
+
+        def measure(n):
+            with recorder.measure('project', str(n)):
+                time.sleep(0.01)
+
+        threads = [threading.Thread(target=measure, args=(n,)) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(recorder.items['project']), [str(n) for n in range(8)])
+
+
+class TestRun(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(self.tmpdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def run_script(self, *argv):
+        """Runs a measured item in instrument.run() with the given options,
+        returns what it printed to stderr"""
+        parser = argparse.ArgumentParser()
+        instrument.add_arguments(parser)
+        err = io.StringIO()
+        with contextlib.redirect_stderr(err):
+            with instrument.run('test', parser.parse_args(argv)) as recorder:
+                with recorder.measure('file', 'a'):
+                    pass
+        return err.getvalue()
+
+    def test_no_report(self):
+        self.assertIn('test: ', self.run_script())
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+    def test_report(self):
+        self.run_script('--report', 'run.json', '--profile', 'run.prof')
+        self.assertEqual(sorted(os.listdir(self.tmpdir)), ['run.json', 'run.prof'])
+        with open('run.json', encoding='utf-8') as fh:
+            report = json.load(fh)
+        self.assertEqual(report['script'], 'test')
+        self.assertEqual(list(report['items']['file']), ['a'])
+        self.assertEqual(report['totals']['file']['count'], 1)
@@ -0,0 +1,69 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import pipeline
+
+FILES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'files')
+
+merge_json = pipeline.merge_json
+
+
+def old_merge(indir, files, outfile):
+    """The merge as merge-json.py did it before it wrote the parts one at a
+    time: all of them in memory, then a single json.dump"""
+    parts = []
+    for part in files:
+        with open('%s/%s' % (indir, part)) as fh:
+            parts.append(json.load(fh))
+    out = dict(
+        metadata=parts[0].get('metadata'),
+        sequences=[dict(canvases=[c for p in parts for c in p.get('sequences')[0].get('canvases')])],
+    )
+    with open(outfile, 'w') as fh:
+        json.dump(out, fh, sort_keys=True, indent=4)
+
+
+class TestMerge(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.indir = os.path.join(self.tmpdir, 'transcription')
+        shutil.copytree(os.path.join(FILES, 'transcription'), self.indir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def assertSameAsOld(self, files):
+        new = os.path.join(self.tmpdir, 'new.json')
+        old = os.path.join(self.tmpdir, 'old.json')
+        merge_json.merge(self.indir, files, new)
+        old_merge(self.indir, files, old)
+        with open(new, 'rb') as fh_new, open(old, 'rb') as fh_old:
+            self.assertEqual(fh_new.read(), fh_old.read())
+
+    def test_manuscripts(self):
+        manuscripts = merge_json.manuscripts(self.indir)
+        self.assertEqual(manuscripts, [
+            dict(name='Ms001', files=['Ms001 1.json', 'Ms001 2.json']),
+            dict(name='Ms002', files=['Ms002 1.json', 'Ms002 2.json']),
+        ])
+        for ms in manuscripts:
+            self.assertSameAsOld(ms['files'])
+
+    def test_single_part(self):
+        self.assertSameAsOld(['Ms002 2.json'])
+
+    def test_no_canvases(self):
+        with open(os.path.join(self.indir, 'Ms001 1.json'), encoding='utf-8') as fh:
+            data = json.load(fh)
+        data['metadata'].append(dict(label='Titel', value='Köln\n"Wien"'))
+        data['sequences'][0]['canvases'] = []
+        with open(os.path.join(self.indir, 'Ms003 1.json'), 'w', encoding='utf-8') as fh:
+            json.dump(data, fh)
+
+        self.assertSameAsOld(['Ms003 1.json'])
+        self.assertSameAsOld(['Ms003 1.json', 'Ms001 2.json'])
+        self.assertSameAsOld(['Ms001 2.json', 'Ms003 1.json'])
@@ -0,0 +1,54 @@
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import artifacts
+
+DATA = {'witnesses': [{'id': 'Ms001', 'tokens': [{'t': 'Köln', 'n': 'köln'}, {'t': '"', 'lit': '\n'}]}]}
+
+
+class TestArtifacts(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'milestone-1.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_round_trip(self):
+        for fmt in artifacts.FORMATS:
+            outfile = artifacts.write_json(self.path, DATA, fmt)
+            self.assertEqual(outfile, artifacts.artifact_path(self.path, fmt))
+            # Only ever one copy of the artifact
+            self.assertEqual(os.listdir(self.tmpdir), [os.path.basename(outfile)])
+            self.assertEqual(artifacts.load_json(outfile), DATA)
+            self.assertEqual(json.loads(artifacts.read_bytes(outfile).decode('utf-8')), DATA)
+            self.assertEqual(artifacts.base_name(outfile), self.path)
+
+    def test_formats(self):
+        with open(artifacts.write_json(self.path, DATA, 'plain'), 'rb') as fh:
+            self.assertEqual(fh.read(), json.dumps(DATA, ensure_ascii=False, indent=4).encode('utf-8'))
+        with open(artifacts.write_json(self.path, DATA, 'compact'), 'rb') as fh:
+            compact = fh.read()
+        self.assertNotIn(b' ', compact.replace(b'K\xc3\xb6ln', b''))
+        with open(artifacts.write_json(self.path, DATA, 'gzip'), 'rb') as fh:
+            body = fh.read()
+        self.assertEqual(gzip.decompress(body), compact)
+        # The same content gives the same file
+        self.assertEqual(artifacts.encode(DATA, 'gzip'), body)
+
+    def test_any_name(self):
+        # A gzipped file without the suffix, as another program may leave it
+        with open(self.path, 'wb') as fh:
+            fh.write(artifacts.encode(DATA, 'gzip'))
+        self.assertEqual(artifacts.load_json(self.path), DATA)
+
+    def test_recode(self):
+        plain = artifacts.encode(DATA, 'plain')
+        self.assertIs(artifacts.recode(plain, 'plain'), plain)
+        for fmt in ('compact', 'gzip'):
+            self.assertEqual(artifacts.recode(plain, fmt), artifacts.encode(DATA, fmt))
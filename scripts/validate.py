@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+
+"""
+Validate XML files against a RelaxNG schema, like
+
+    for f in *.xml; do xmllint --noout --relaxng schema.rng "$f"; done
+
+but compiling the schema only once, rather than once per file, and
+validating the files on a pool of worker processes. The report for each
+file and the exit status follow those of xmllint: 3 for each file that
+does not validate and 4 for each file that cannot be parsed, summed over
+all files.
+
+With --cache, the outcome for each file is kept between runs, so that only
+new and changed files are validated again. Cached failures are reported
+again just as if the file had been validated.
+"""
+
+import argparse
+import concurrent.futures
+import logging
+import os
+import sys
+
+from lxml import etree
+
+from filecache import FileCache, file_hash, make_key
+
+# Bytes of a line that xmllint shows around a parser error
+CONTEXT = 80
+
+# xmllint exit statuses
+VALID_ERROR = 3
+READ_ERROR = 4
+SCHEMA_ERROR = 5
+
+_worker_schema = None
+_worker_schema_path = None
+
+
+def load_schema(path):
+    """Returns the compiled RelaxNG schema at path. Raises
+    etree.RelaxNGParseError, etree.XMLSyntaxError or OSError if it cannot
+    be read."""
+    return etree.RelaxNG(etree.parse(path))
+
+
+def validate_file(schema, path):
+    """Validates a file against a compiled schema. Returns its exit status
+    and the lines of its report."""
+    # A parser of its own keeps the errors of this file only
+    parser = etree.XMLParser()
+    try:
+        doc = etree.parse(path, parser)
+    except etree.XMLSyntaxError as e:
+        report = []
+        for err in parser.error_log:
+            report.append('%s:%d: parser error : %s' % (err.filename, err.line, err.message))
+            report.extend(error_context(path, err.line, err.column))
+        return (READ_ERROR, report or [str(e)])
+    except OSError:
+        return (READ_ERROR, ['warning: failed to load external entity "%s"' % path])
+
+    if schema.validate(doc):
+        return (0, ['%s validates' % path])
+    report = ['%s:%d: %sRelax-NG validity error : %s' % (
+        err.filename, err.line, element_prefix(doc, err.path), err.message)
+        for err in schema.error_log]
+    report.append('%s fails to validate' % path)
+    return (VALID_ERROR, report)
+
+
+def error_context(path, line, column):
+    """Returns the two lines that xmllint shows under a parser error: the
+    text around it, and a caret under where it is"""
+    try:
+        with open(path, 'rb') as fh:
+            text = fh.read().splitlines()[line - 1]
+    except (OSError, IndexError):
+        return []
+    if column < 1:
+        return []
+    # libxml2 counts the column in characters, but shows bytes
+    pos = len(text.decode('utf-8', 'replace')[:column - 1].encode('utf-8'))
+    # Up to CONTEXT bytes before the error, from the start of a character,
+    # and as many after it as fit
+    start = max(0, min(pos, len(text) - 1) - CONTEXT)
+    while start < pos and text[start] & 0xC0 == 0x80:
+        start += 1
+    end = start
+    for ch in text[start:].decode('utf-8', 'replace'):
+        width = len(ch.encode('utf-8'))
+        if end - start + width > CONTEXT:
+            break
+        end += width
+    content = text[start:end]
+    caret = bytes(c if c == 0x09 else 0x20 for c in content[:min(pos - start, CONTEXT - 1)])
+    return [content.decode('utf-8', 'replace'), caret.decode('ascii') + '^']
+
+
+def element_prefix(doc, path):
+    """Returns the 'element NAME: ' part of xmllint's message for an error
+    at the given XPath, or nothing if it does not lead to an element"""
+    try:
+        found = doc.xpath(path) if path else []
+    except etree.XPathError:
+        found = []
+    if not found or not isinstance(found[0], etree._Element):
+        return ''
+    return 'element %s: ' % etree.QName(found[0]).localname
+
+
+class ValidationCache(object):
+    """An on-disk cache of validation outcomes, keyed by the path and content
+    hash of the file, the content hash of the schema, and the libxml2
+    version. Failures are stored as well as successes."""
+
+    def __init__(self, cachedir, schema_path, max_size=None):
+        self.store = FileCache(cachedir, max_size)
+        self.schema_hash = file_hash(schema_path)
+        self._hashes = dict()
+
+    def get(self, path):
+        """Returns the (status, report) stored for the file, or None"""
+        try:
+            self._hashes[path] = file_hash(path)
+        except OSError:
+            return None
+        entry = self.store.get_json(self._key(path))
+        if entry is None:
+            return None
+        return (entry.get('status'), entry.get('report'))
+
+    def put(self, path, status, report):
+        # Files that could not be read have nothing to key them by
+        if path not in self._hashes:
+            return
+        self.store.put_json(self._key(path), dict(status=status, report=report))
+
+    def report(self):
+        return self.store.report('validation cache')
+
+    def _key(self, path):
+        return make_key(path, self._hashes.get(path), self.schema_hash, etree.LIBXML_VERSION)
+
+
+def validate_files(schema_path, files, jobs=None, cache=None):
+    """Validates the files against the schema at schema_path, on a pool of
+    jobs worker processes. Files whose outcome is in the cache are not
+    validated again. Returns a list of (file, status, report) in the order
+    of files. Raises an error as load_schema() does if the schema cannot be
+    compiled."""
+    global _worker_schema, _worker_schema_path
+    results = dict()
+    if cache is not None:
+        for f in files:
+            cached = cache.get(f)
+            if cached is not None:
+                results[f] = cached
+    todo = [f for f in files if f not in results]
+    if not todo:
+        return [(f,) + results[f] for f in files]
+
+    # Compile the schema here first, so that a broken schema is reported
+    # once, and forked workers inherit it ready to use
+    _worker_schema = load_schema(schema_path)
+    _worker_schema_path = schema_path
+
+    if (jobs is not None and jobs <= 1) or len(todo) <= 1:
+        validated = [validate_file(_worker_schema, f) for f in todo]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=jobs,
+                initializer=_init_worker,
+                initargs=(schema_path,)) as executor:
+            validated = list(executor.map(_validate_worker, todo))
+
+    for (f, (status, report)) in zip(todo, validated):
+        results[f] = (status, report)
+        if cache is not None:
+            cache.put(f, status, report)
+    return [(f,) + results[f] for f in files]
+
+
+def _init_worker(schema_path):
+    global _worker_schema, _worker_schema_path
+    if _worker_schema is None or _worker_schema_path != schema_path:
+        _worker_schema = load_schema(schema_path)
+        _worker_schema_path = schema_path
+
+
+def _validate_worker(path):
+    return validate_file(_worker_schema, path)
+
+
+def main(args):
+    try:
+        cache = None
+        if args.cache is not None:
+            cache = ValidationCache(args.cache, args.schema, args.cache_size * 1024 * 1024)
+        results = validate_files(args.schema, args.files, args.jobs, cache)
+    except (etree.RelaxNGParseError, etree.XMLSyntaxError, OSError) as e:
+        logging.error('cannot compile %s: %s' % (args.schema, e))
+        print('Relax-NG schema %s failed to compile' % args.schema, file=sys.stderr)
+        return SCHEMA_ERROR
+
+    status = 0
+    for (path, returncode, report) in results:
+        print('=== %s ===' % path)
+        for line in report:
+            print(line)
+        status += returncode
+    if cache is not None:
+        print(cache.report())
+        logging.info(cache.report())
+    if status:
+        print('Some files failed to validate')
+    # Unlike a shell, don't let the sum wrap around to 0
+    return min(status, 255)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "schema",
+        help="RelaxNG schema to validate against",
+    )
+    parser.add_argument(
+        "files",
+        nargs="+",
+        help="XML files to validate",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        help="number of files to validate at once (default: one per CPU)",
+    )
+    parser.add_argument(
+        "--cache",
+        help="directory in which to keep validation results between runs",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=64,
+        help="size limit of the validation cache in MB (default 64)",
+    )
+
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format='%(asctime)s %(message)s',
+        filename='%s.log' % os.path.basename(sys.argv[0]),
+        level=logging.WARNING,
+    )
+    sys.exit(main(args))
@@ -1,15 +1,31 @@
 #!/usr/bin/env python3
 
+import argparse
+import contextlib
 import yaml
 import os
 import re
 import sys
 import logging
 import json
+import hashlib
+import tempfile
+import time
 
 from tpen import TPen
+from retry import CircuitOpenError
 from command import run
 
+# the instrumentation module of the pipeline scripts, if they are on the PYTHONPATH
+# as in the container; without it the backup runs uninstrumented
+try:
+    import instrument
+except ImportError:
+    instrument = None
+
+# content hashes of the project files, kept in transcription/
+MANIFEST = 'manifest.json'
+
 
 def get_config():
     ourpath = os.path.abspath(os.path.dirname(__file__))
@@ -17,7 +33,7 @@ def get_config():
         return yaml.load(ymlfile, Loader=yaml.FullLoader)
 
 
-def setup (config):
+def setup (config, recorder = None):
     # Set up the logging here
     logargs = {
         'format': '%(asctime)s %(message)s',
@@ -30,39 +46,245 @@ def setup (config):
     logging.basicConfig (**logargs)
 
     # Initialize the TPen object
-    tpen = TPen (cfg = config)
+    tpen = TPen (cfg = config, recorder = recorder)
     return tpen
 
+def sha256 (content):
+    return hashlib.sha256 (content.encode ('utf-8')).hexdigest()
+
+
+def write_atomic (filename, content):
+    """ write content to filename via a temporary file, so that the file is never
+        left half-written
+    """
+
+    fd, tmpname = tempfile.mkstemp (dir = os.path.dirname (os.path.abspath (filename)))
+    try:
+        with os.fdopen (fd, 'w', encoding = 'utf-8') as fh:
+            fh.write (content)
+        os.chmod (tmpname, 0o644)
+        os.replace (tmpname, filename)
+    except BaseException:
+        os.unlink (tmpname)
+        raise
+
+
+def write_if_changed (filename, content, known_hash = None):
+    """ write content to filename unless the file already has it
+        known_hash is the hash the file had when last written, if we know it
+        returns the hash of content and whether the file was written
+    """
+
+    new_hash = sha256 (content)
+    if not os.path.exists (filename):
+        old_hash = None
+    elif known_hash is not None:
+        old_hash = known_hash
+    else:
+        with open (filename, encoding = 'utf-8') as fh:
+            old_hash = sha256 (fh.read())
+
+    if old_hash == new_hash:
+        return new_hash, False
+
+    write_atomic (filename, content)
+    return new_hash, True
+
+
+def project_creators (project):
+    """ the IDs (as strings) of all users who created annotations in a project
+    """
+
+    try:
+        data = json.loads (project.get ('data'))
+    except ValueError as e:
+        logging.error ('project <%s> is not valid JSON: %s' % (project.get ('tpen_id'), e))
+        return set()
+
+    creators = set()
+    for sequence in data.get ('sequences') or []:
+        for canvas in sequence.get ('canvases') or []:
+            for annotations in canvas.get ('otherContent') or []:
+                for resource in annotations.get ('resources') or []:
+                    creator = resource.get ('_tpen_creator')
+                    if creator is not None:
+                        creators.add (str (creator))
+
+    return creators
+
+
+class MemberCache (object):
+    """ MemberCache keeps what T-PEN told us about its users, and when, in a JSON file
+        that outlives members.json
+    """
+
+    def __init__ (self, **kwa):
+        """ the following keys are possible
+
+            filename ... where to keep the cache; without one, nothing is kept between runs
+            max_age .... look a user up again after this many seconds (default: never)
+        """
+
+        self.filename = kwa.get ('filename')
+        self.max_age = kwa.get ('max_age')
+        self.entries = dict()
+
+        if self.filename and os.path.exists (self.filename):
+            with open (self.filename, encoding = 'utf-8') as fh:
+                self.entries = json.load (fh)
+
+    def seed (self, members):
+        """ take over users we only know from members.json, as if we had just looked them up
+        """
+
+        now = time.time()
+        for (uid, info) in members.items():
+            self.entries.setdefault (uid, dict (info = info, fetched = now))
+
+    def stale (self, uids):
+        """ the sorted list of those uids that need to be looked up
+        """
+
+        now = time.time()
+        return sorted (
+            uid for uid in uids
+            if uid not in self.entries
+            or (self.max_age and now - self.entries[uid].get ('fetched') > self.max_age)
+        )
+
+    def update (self, found):
+        """ record the users found by TPen.users()
+            users that couldn't be looked up keep what we knew about them
+        """
+
+        now = time.time()
+        for (uid, info) in found.items():
+            if info is not None:
+                self.entries[uid] = dict (info = info, fetched = now)
+
+    def get (self, uid):
+        return self.entries.get (uid, {}).get ('info')
+
+    def save (self):
+        if self.filename:
+            write_atomic (self.filename, json.dumps (self.entries, ensure_ascii=False, indent=2, sort_keys=True))
+
+
+def plan_cleanup (**kwa):
+    """ sort the files in transcription/ by what is to become of them, given the
+        projects on T-PEN and the keep- and blacklists
+        returns a dict with the sorted lists of files to keep, and of obsolete and
+        blacklisted files to delete
+    """
+
+    files = set (kwa.get ('files'))
+    config = kwa.get ('config')
+
+    keeplist = set (config.get ('keeplist') or [])
+    on_tpen = set ('%s.json' % p.get ('label') for p in kwa.get ('projects'))
+    blacklist = set ('%s.json' % b for b in config.get ('blacklist') or [])
+
+    # our own bookkeeping is neither kept nor deleted
+    candidates = files - keeplist - set (['members.json', MANIFEST])
+
+    return dict (
+        keep        = sorted (files & keeplist),
+        obsolete    = sorted (candidates - on_tpen),
+        blacklisted = sorted (candidates & on_tpen & blacklist),
+    )
+
+
+def cleanup_report (plan):
+    """ the lines to log (or print, in a dry run) about a cleanup plan
+    """
+
+    return (
+        ['keeping file <%s>' % f for f in plan.get ('keep')] +
+        ['file <%s> is obsolete and will be deleted' % f for f in plan.get ('obsolete')] +
+        ['file <%s> blacklisted and will be deleted' % f for f in plan.get ('blacklisted')]
+    )
+
+
+def remove_files (files):
+    """ git rm those of the given files that git knows of, in a single go, and
+        simply delete the others
+        directories are left alone
+        returns the list of files removed
+    """
+
+    dirs = [f for f in files if os.path.isdir (f)]
+    for d in dirs:
+        logging.warning ('<%s> is a directory, not removing it' % d)
+    files = [f for f in files if f not in dirs]
+    if not files:
+        return []
+
+    # project labels may contain glob characters
+    git = ['/usr/bin/git', '--literal-pathspecs']
+    res = run (git + ['ls-files', '-z', '--'] + files, capture = True)
+    tracked = set()
+    if res.get ('returncode') == 0:
+        tracked = set (res.get ('stdout').split ('\0')) & set (files)
+
+    removed = []
+    if tracked:
+        if run (git + ['rm', '--quiet', '--'] + sorted (tracked)).get ('returncode') == 0:
+            removed += sorted (tracked)
+        else:
+            # one at a time, so that only the culprit stays
+            for f in sorted (tracked):
+                if run (git + ['rm', '--quiet', '--', f]).get ('returncode') == 0:
+                    removed.append (f)
+                else:
+                    logging.error ('could not git rm <%s>, leaving it' % f)
+
+    for f in files:
+        if f not in tracked and os.path.exists (f):
+            logging.error ('file <%s> is not in git, deleting it anyway' % f)
+            os.remove (f)
+            removed.append (f)
+    return sorted (removed)
+
+
 def backup (**kwa):
+    """ back up all projects into basedir/transcription/
+        the users who created annotations are looked up in member_cache (a MemberCache)
+        and written to members.json
+        returns a dict with the sorted lists of changed and removed project labels
+    """
+
     tpen = kwa.get ('tpen')
     config = kwa.get ('config')
     basedir = kwa.get ('basedir')
 
+    member_cache = kwa.get ('member_cache') or MemberCache()
+
     os.chdir (basedir + '/transcription/')
     project_members = dict()
-    new_members = set()
+    creators = set()
+
+    manifest = dict()
+    if os.path.exists (MANIFEST):
+        with open (MANIFEST, encoding = 'utf-8') as fh:
+            manifest = json.load (fh)
+    changed = []
 
     # delete obsolete files
     #
-    for f in os.listdir():
-        if f in config.get ('keeplist'):
-            logging.error ('keeping file <%s>' % f)
-
-        # scan existing project members
-        elif f == 'members.json':
-            with open(f, encoding='utf-8') as fh:
-                project_members = json.load(fh)
-
-        # delete what is not on T-PEN anymore
-        elif f not in ['%s.json' % p.get ('label') for p in tpen.projects_list()]:
-            logging.error ('file <%s> is obsolete and will be deleted' % f)
-            run (['/usr/bin/git', 'rm', f])
+    if os.path.exists ('members.json'):
+        with open ('members.json', encoding='utf-8') as fh:
+            project_members = json.load (fh)
 
-        # delete what is blacklisted
-        elif f in ['%s.json' % b for b in config.get ('blacklist')]:
-            logging.error ('file <%s> blacklisted and will be deleted' % f)
-            run (['/usr/bin/git', 'rm', f])
+    plan = plan_cleanup (
+        files = os.listdir(),
+        projects = tpen.projects_list(),
+        config = config,
+    )
+    for line in cleanup_report (plan):
+        logging.error (line)
 
+    obsolete = plan.get ('obsolete') + plan.get ('blacklisted')
+    removed = [re.sub (r'\.json$', '', f) for f in remove_files (obsolete)]
 
     for project in tpen.projects():
 
@@ -76,30 +298,56 @@ def backup (**kwa):
 
         elif project.get ('data'):
             content = project.get('data')
-            with open ('./%s.json' % (project.get ('label')), 'w') as fh:
-                # Scan the data for new user IDs
-                for m in re.finditer(r'\"_tpen_creator\"\s+:\s+(\d+)', content):
-                    if m.group(1) not in project_members:
-                        new_members.add(m.group(1))
-                fh.write (content)
+            label = project.get ('label')
+
+            creators |= project_creators (project)
+
+            # only touch the file if its content changed
+            content_hash, written = write_if_changed (
+                './%s.json' % label,
+                content,
+                manifest.get (label, {}).get ('sha256'),
+            )
+            manifest[label] = dict (
+                tpen_id = project.get ('tpen_id'),
+                sha256 = content_hash,
+            )
+            if written:
+                logging.info ('project <%s> changed' % label)
+                changed.append (label)
 
         # option write-garbage
         else:
             logging.info ('no data for project <%s>' % project.get ('tpen_id'))
 
-    # look up and add any new users we found
-    found_new_member = False
-    for uid in new_members:
-        newuser = tpen.user(uid = uid)
-        logging.debug('retrieved new user %s' % newuser)
-        if newuser is not None:
-            found_new_member = True
-            project_members[uid] = newuser
+    # look up the users we don't know yet, or not for long enough
+    member_cache.seed (project_members)
+    stale = member_cache.stale (creators)
+    if stale:
+        logging.info ('looking up %s users' % len (stale))
+        found = tpen.users (uids = stale)
+        for (uid, info) in sorted (found.items()):
+            logging.debug ('retrieved user %s: %s' % (uid, info))
+        member_cache.update (found)
+        member_cache.save()
+
+    for uid in creators:
+        info = member_cache.get (uid)
+        if info is not None:
+            project_members[uid] = info
 
     # write the userlist to a file
-    if found_new_member:
-        with open ('./members.json', 'w', encoding='utf-8') as fh:
-            json.dump(project_members, fh, ensure_ascii=False, indent=2)
+    project_members and write_if_changed ('./members.json', json.dumps (project_members, ensure_ascii=False, indent=2))
+
+    # forget what was removed, and record the hashes of what is there
+    for label in removed:
+        manifest.pop (label, None)
+    write_if_changed (MANIFEST, json.dumps (manifest, ensure_ascii=False, indent=2, sort_keys=True))
+
+    return dict (
+        changed = sorted (changed),
+        removed = sorted (removed),
+    )
 
 
 
@@ -120,8 +368,133 @@ def log_global_errors (**kwa):
     ]
 
 
+def write_metrics (**kwa):
+    """ log the request metrics of the T-PEN client, and write them as a Prometheus
+        textfile and as a JSON summary if these files are given
+    """
+
+    tpen = kwa.get ('tpen')
+    success = kwa.get ('success')
+    textfile = kwa.get ('textfile')
+    json_file = kwa.get ('json_file')
+
+    summary = tpen.metrics.summary()
+    for (kind, m) in sorted (summary.items()):
+        logging.info (
+            '[request report] %s: %s attempts in %ss (p95 %ss, max %ss), %s bytes, %s retries after %ss of backoff' % (
+                kind, m.get ('attempts'), m.get ('seconds'), m.get ('p95'), m.get ('max'),
+                m.get ('received_bytes'), m.get ('retries'), m.get ('backoff_seconds'),
+        ))
+
+    # node_exporter may read the textfile at any time, hence the atomic write
+    if textfile:
+        write_atomic (textfile, tpen.metrics.prometheus (errors = tpen.global_errors(), success = success))
+    if json_file:
+        write_atomic (json_file, json.dumps (dict (
+            started  = tpen.metrics.started,
+            duration = round (time.time() - tpen.metrics.started, 3),
+            success  = success,
+            requests = summary,
+            errors   = tpen.global_errors(),
+        ), ensure_ascii=False, indent=2, sort_keys=True))
+
+
+def instrumented (args):
+    """ the instrument.run() context of the backup, yielding its recorder,
+        or None without the instrumentation module
+    """
+
+    if instrument is None:
+        return contextlib.nullcontext()
+    return instrument.run ('backup', args)
+
+
+def write_changes (**kwa):
+    """ write the lists of changed and removed projects as JSON, for later stages
+    """
+
+    changes = kwa.get ('changes')
+    filename = kwa.get ('filename')
+
+    logging.info ('%s projects changed, %s removed' % (
+        len (changes.get ('changed')),
+        len (changes.get ('removed')),
+    ))
+    if filename:
+        write_atomic (filename, json.dumps (changes, ensure_ascii=False, indent=2))
+
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser (description = 'back up all T-PEN projects')
+    parser.add_argument (
+        'basedir',
+        help = 'repository to back up into, projects go to its transcription/ directory',
+    )
+    parser.add_argument (
+        '-n',
+        '--dry-run',
+        action = 'store_true',
+        help = 'only print which files would be deleted',
+    )
+    if instrument is not None:
+        instrument.add_arguments (parser)
+    args = parser.parse_args()
+
     config = get_config()
-    tpen = setup (config)
-    backup (tpen = tpen, config = config, basedir = sys.argv[1])
+
+    if args.dry_run:
+        tpen = setup (config)
+        plan = plan_cleanup (
+            files = os.listdir (os.path.join (args.basedir, 'transcription')),
+            projects = tpen.projects_list(),
+            config = config,
+        )
+        tpen.close()
+        for line in cleanup_report (plan):
+            print (line)
+        print ('%s projects on T-PEN, %s files to keep, %s to delete' % (
+            len (tpen.projects_list()),
+            len (plan.get ('keep')),
+            len (plan.get ('obsolete')) + len (plan.get ('blacklisted')),
+        ))
+        sys.exit (0)
+
+    # relative to where we were started, not to transcription/
+    changes_file = config.get ('changes_file')
+    if changes_file:
+        changes_file = os.path.abspath (changes_file)
+    metrics_textfile = config.get ('metrics_textfile') and os.path.abspath (config.get ('metrics_textfile'))
+    metrics_json = config.get ('metrics_json') and os.path.abspath (config.get ('metrics_json'))
+
+    member_cache = MemberCache (
+        filename = config.get ('member_cache') and os.path.abspath (os.path.expanduser (config.get ('member_cache'))),
+        max_age = config.get ('member_refresh') and config.get ('member_refresh') * 24 * 60 * 60,
+    )
+
+    with instrumented (args) as recorder:
+        # the recorder measures every project download and user lookup
+        tpen = setup (config, recorder)
+        changes = None
+        try:
+            changes = backup (
+                tpen = tpen,
+                config = config,
+                basedir = args.basedir,
+                member_cache = member_cache,
+            )
+        except CircuitOpenError as e:
+            # t-pen seems to be down, leave the rest of the backup for the next run
+            logging.error ('giving up: %s' % e)
+            log_global_errors (ge = tpen.global_errors())
+            sys.exit (1)
+        finally:
+            # also when the backup failed, that is when the metrics matter most
+            write_metrics (
+                tpen = tpen,
+                success = changes is not None,
+                textfile = metrics_textfile,
+                json_file = metrics_json,
+            )
+    tpen.close()
+    write_changes (changes = changes, filename = changes_file)
     log_global_errors (ge = tpen.global_errors())
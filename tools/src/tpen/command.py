@@ -2,8 +2,9 @@ import logging
 import subprocess
 
 
-def run (cmd):
+def run (cmd, capture = False):
     """ run command cmd and log in case of error
+        with capture, its standard output is returned as text
     """
 
     logging.basicConfig (
@@ -13,6 +14,8 @@ def run (cmd):
 
     cp = subprocess.run (  # ISA CompletedProcess
         cmd,
+        stdout = capture and subprocess.PIPE or None,
+        universal_newlines = capture,
     # disabled for the moment because these options
     # cause trouble inside of a container
     #    stdout  = subprocess.PIPE,
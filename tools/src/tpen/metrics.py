@@ -0,0 +1,189 @@
+import math
+import threading
+import time
+
+# upper bounds of the latency histogram buckets, in seconds
+BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+class RequestMetrics (object):
+    """ RequestMetrics records every attempt at a request to T-PEN by kind of request
+        (login, index, project, user): how long it took, how it ended and how many
+        bytes went back and forth, and for every retry the time spent waiting before it
+
+        the metrics can be rendered in the Prometheus text format, for the textfile
+        collector of node_exporter, or summed up in a dict for JSON
+    """
+
+    def __init__ (self, **kwa):
+        """ the following keys are possible
+
+            buckets ... upper bounds of the latency histogram buckets in seconds (default BUCKETS)
+        """
+
+        self.buckets = tuple (sorted (kwa.get ('buckets') or BUCKETS))
+        self.started = time.time()
+        self._kinds = dict()
+        self._lock = threading.Lock()
+
+    def _kind (self, kind):
+        # callers hold the lock
+        if kind not in self._kinds:
+            self._kinds[kind] = dict (
+                durations = [],
+                outcomes = dict(),
+                received = 0,
+                sent = 0,
+                retries = 0,
+                backoff = 0.0,
+            )
+        return self._kinds[kind]
+
+    def observe (self, kind, **kwa):
+        """ record one attempt at a request of the given kind
+
+            seconds .... how long the attempt took
+            outcome .... the HTTP status code, or 'exception' if there was no response
+            received ... bytes of the response body
+            sent ....... bytes of the request body
+        """
+
+        with self._lock:
+            k = self._kind (kind)
+            k['durations'].append (kwa.get ('seconds') or 0.0)
+            outcome = str (kwa.get ('outcome'))
+            k['outcomes'][outcome] = k['outcomes'].get (outcome, 0) + 1
+            k['received'] += kwa.get ('received') or 0
+            k['sent'] += kwa.get ('sent') or 0
+
+    def retried (self, kind, delay):
+        """ record a retry of a request of the given kind, after waiting delay seconds
+        """
+
+        with self._lock:
+            k = self._kind (kind)
+            k['retries'] += 1
+            k['backoff'] += delay
+
+    def summary (self):
+        """ a dict of kind -> totals and latency percentiles of its attempts
+        """
+
+        with self._lock:
+            kinds = dict ((kind, dict (k, durations = sorted (k['durations']))) for (kind, k) in self._kinds.items())
+
+        summary = dict()
+        for (kind, k) in sorted (kinds.items()):
+            durations = k['durations']
+            summary[kind] = dict (
+                attempts        = len (durations),
+                outcomes        = k['outcomes'],
+                seconds         = round (sum (durations), 3),
+                p50             = round (percentile (durations, 50), 3),
+                p95             = round (percentile (durations, 95), 3),
+                max             = round (durations and durations[-1] or 0.0, 3),
+                received_bytes  = k['received'],
+                sent_bytes      = k['sent'],
+                retries         = k['retries'],
+                backoff_seconds = round (k['backoff'], 3),
+            )
+        return summary
+
+    def prometheus (self, **kwa):
+        """ the metrics in the Prometheus text exposition format
+
+            errors .... dict of error -> count to add as tpen_errors_total (see TPen.global_errors)
+            success ... whether the run succeeded, added as tpen_backup_success if given
+        """
+
+        errors = kwa.get ('errors') or dict()
+        success = kwa.get ('success')
+
+        with self._lock:
+            kinds = dict ((kind, dict (k, durations = list (k['durations']))) for (kind, k) in self._kinds.items())
+
+        lines = []
+
+        def metric (name, kind, help_text, samples):
+            lines.append ('# HELP %s %s' % (name, help_text))
+            lines.append ('# TYPE %s %s' % (name, kind))
+            for (suffix, labels, value) in samples:
+                lines.append ('%s%s%s %s' % (name, suffix, format_labels (labels), format_value (value)))
+
+        histogram = []
+        for (kind, k) in sorted (kinds.items()):
+            durations = k['durations']
+            for le in self.buckets:
+                histogram.append (('_bucket', [('kind', kind), ('le', format_value (float (le)))],
+                                   sum (1 for d in durations if d <= le)))
+            histogram.append (('_bucket', [('kind', kind), ('le', '+Inf')], len (durations)))
+            histogram.append (('_sum', [('kind', kind)], sum (durations)))
+            histogram.append (('_count', [('kind', kind)], len (durations)))
+        metric ('tpen_request_duration_seconds', 'histogram',
+                'Time taken by each attempt at a request to T-PEN.', histogram)
+
+        metric ('tpen_requests_total', 'counter',
+                'Attempts at requests to T-PEN by HTTP status code, or exception if there was no response.',
+                [('', [('kind', kind), ('outcome', outcome)], count)
+                 for (kind, k) in sorted (kinds.items())
+                 for (outcome, count) in sorted (k['outcomes'].items())])
+
+        metric ('tpen_response_bytes_total', 'counter',
+                'Bytes of response bodies received from T-PEN.',
+                [('', [('kind', kind)], k['received']) for (kind, k) in sorted (kinds.items())])
+
+        metric ('tpen_request_bytes_total', 'counter',
+                'Bytes of request bodies sent to T-PEN.',
+                [('', [('kind', kind)], k['sent']) for (kind, k) in sorted (kinds.items())])
+
+        metric ('tpen_retries_total', 'counter',
+                'Requests to T-PEN tried again.',
+                [('', [('kind', kind)], k['retries']) for (kind, k) in sorted (kinds.items())])
+
+        metric ('tpen_backoff_seconds_total', 'counter',
+                'Time spent waiting before retrying requests to T-PEN.',
+                [('', [('kind', kind)], k['backoff']) for (kind, k) in sorted (kinds.items())])
+
+        metric ('tpen_errors_total', 'counter',
+                'Errors found in responses from T-PEN.',
+                [('', [('error', error)], count) for (error, count) in sorted (errors.items())])
+
+        metric ('tpen_backup_start_time_seconds', 'gauge',
+                'When the backup started, in seconds since the epoch.',
+                [('', [], self.started)])
+
+        metric ('tpen_backup_duration_seconds', 'gauge',
+                'How long the backup took.',
+                [('', [], time.time() - self.started)])
+
+        if success is not None:
+            metric ('tpen_backup_success', 'gauge',
+                    'Whether the backup ran to the end.',
+                    [('', [], success and 1 or 0)])
+
+        return '\n'.join (lines) + '\n'
+
+
+def percentile (values, p):
+    """ the p-th percentile of the sorted list values (nearest rank), 0 if it is empty
+    """
+
+    if not values:
+        return 0.0
+    rank = math.ceil (p / 100.0 * len (values))
+    return values[min (max (rank, 1), len (values)) - 1]
+
+
+def format_labels (labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join (
+        '%s="%s"' % (name, str (value).replace ('\\', '\\\\').replace ('"', '\\"').replace ('\n', '\\n'))
+        for (name, value) in labels
+    )
+
+
+def format_value (value):
+    if isinstance (value, int):
+        return str (value)
+    return repr (float (value))
@@ -0,0 +1,142 @@
+import logging
+import random
+import threading
+import time
+
+
+class CircuitOpenError (UserWarning):
+    """ raised when too many attempts in a row have failed and we stop trying
+    """
+
+
+class RetryPolicy (object):
+    """ RetryPolicy retries an operation with exponential backoff and jitter,
+        within a total time budget per operation, and shares a circuit breaker
+        between all operations that stops everything once too many attempts
+        in a row have failed
+    """
+
+    def __init__ (self, **kwa):
+        """ the following keys are possible
+
+            max_attempts ...... try an operation at most this often
+            backoff ........... seconds to wait before the first retry, doubled for every further retry
+            backoff_max ....... never wait longer than this between two attempts
+            budget ............ give up on an operation after this many seconds (None: no limit)
+            circuit_breaker ... give up altogether after this many failed attempts in a row (None: never)
+        """
+
+        self.max_attempts = kwa.get ('max_attempts') or 1
+        self.backoff = kwa.get ('backoff', 2)
+        self.backoff_max = kwa.get ('backoff_max', 60)
+        self.budget = kwa.get ('budget')
+        self.circuit_breaker = kwa.get ('circuit_breaker')
+
+        self.slept = 0
+        self._failures = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config (cls, cfg):
+        """ set up a policy from the keys in backup.yml
+        """
+
+        return cls (
+            max_attempts    = cfg.get ('max_errors'),
+            backoff         = cfg.get ('backoff', 2),
+            backoff_max     = cfg.get ('backoff_max', 60),
+            budget          = cfg.get ('request_budget'),
+            circuit_breaker = cfg.get ('circuit_breaker'),
+        )
+
+    def call (self, attempt, **kwa):
+        """ call attempt until it returns a good result, and return that
+
+            attempt ........... function that is passed the seconds left in the budget (or None)
+            check ............. function that returns None for a good result, or else the name of the error
+            retry_on .......... exception classes that are worth another attempt
+            breaker_errors .... errors from check that count towards the circuit breaker
+            description ....... what we are doing, for the log
+            on_retry .......... function that is passed the seconds waited before each further attempt
+
+            if no attempt returned a good result, the last result is returned;
+            if the last attempt raised, its exception is raised
+        """
+
+        check = kwa.get ('check') or (lambda res: None)
+        retry_on = kwa.get ('retry_on') or ()
+        breaker_errors = kwa.get ('breaker_errors') or ()
+        description = kwa.get ('description') or 'operation'
+        on_retry = kwa.get ('on_retry') or (lambda delay: None)
+
+        start = time.monotonic()
+        res = None
+
+        for n in range (1, self.max_attempts + 1):
+            self._check_circuit()
+
+            remaining = None
+            if self.budget is not None:
+                remaining = self.budget - (time.monotonic() - start)
+
+            try:
+                res = attempt (remaining)
+
+            except retry_on as e:
+                logging.error ('%s failed: %s (attempt %s of %s)' % (description, e, n, self.max_attempts))
+                self._failure()
+                if not self._wait (n, start, on_retry):
+                    raise
+
+            else:
+                error = check (res)
+                if error is None:
+                    self._success()
+                    return res
+
+                logging.error ('%s failed: %s (attempt %s of %s)' % (description, error, n, self.max_attempts))
+                if error in breaker_errors:
+                    self._failure()
+                else:
+                    self._success()
+                if not self._wait (n, start, on_retry):
+                    return res
+
+        return res
+
+    def _wait (self, n, start, on_retry):
+        """ sleep before attempt n + 1; returns False if there should be no such attempt
+        """
+
+        if n >= self.max_attempts:
+            return False
+
+        delay = min (self.backoff * 2 ** (n - 1), self.backoff_max)
+        # "equal jitter": wait at least half the delay
+        delay = delay / 2 + random.uniform (0, delay / 2)
+
+        if self.budget is not None and time.monotonic() - start + delay > self.budget:
+            logging.error ('giving up, time budget of %s seconds used up' % self.budget)
+            return False
+
+        logging.info ('sleeping %.1f seconds' % delay)
+        time.sleep (delay)
+        with self._lock:
+            self.slept += delay
+        on_retry (delay)
+        return True
+
+    def _check_circuit (self):
+        with self._lock:
+            if self.circuit_breaker and self._failures >= self.circuit_breaker:
+                raise CircuitOpenError (
+                    '%s attempts in a row failed, the server seems to be down' % self._failures
+                )
+
+    def _failure (self):
+        with self._lock:
+            self._failures += 1
+
+    def _success (self):
+        with self._lock:
+            self._failures = 0
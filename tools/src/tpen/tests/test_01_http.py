@@ -1,21 +1,43 @@
+import contextlib
 import requests
 import requests_mock
+import threading
 import unittest
 import yaml
 import re
 
 from tpen import TPen
+from retry import CircuitOpenError
 
 CONFIG_FILE = './backup.yml'
 INDEX_FILE = './tests/files/index.htm'
 PROJECT_FILE = './tests/files/project-35.ld+json'
 
+
+class FakeRecorder (object):
+    """ stands in for instrument.Recorder of the pipeline scripts, remembering what was measured
+    """
+
+    def __init__ (self):
+        self.items = []
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def measure (self, kind, item):
+        yield
+        with self.lock:
+            self.items.append ((kind, item))
+
+
 class TestHTTP (unittest.TestCase):
 
     def setUp (self):
         with open (CONFIG_FILE, 'r') as ymlfile:
             self.cfg = yaml.load (ymlfile, Loader=yaml.FullLoader)
 
+        # don't wait between retries
+        self.cfg['backoff'] = 0
+
     def test_login_ok (self):
         login_success = 'document.location = "index.jsp";'
 
@@ -23,6 +45,25 @@ class TestHTTP (unittest.TestCase):
             m.post (self.cfg.get ('uri_login'), text = login_success)
             tpen = TPen (cfg = self.cfg)
 
+    def test_login_redirect (self):
+        login_success = 'document.location = "index.jsp";'
+        login_redirected = self.cfg.get ('uri_login') + '?redirected=1'
+
+        with requests_mock.Mocker() as m:
+            m.post (
+                self.cfg.get ('uri_login'),
+                status_code = 302,
+                headers = dict (Location = login_redirected),
+            )
+            m.post (login_redirected, text = login_success)
+            tpen = TPen (cfg = self.cfg)
+
+            # the login is POSTed once to each location, never GET
+            self.assertEqual (
+                [(r.method, r.url) for r in m.request_history],
+                [('POST', self.cfg.get ('uri_login')), ('POST', login_redirected)],
+            )
+
     def test_login_nok (self):
         login_success = 'document.location = "doh!";'
 
@@ -57,3 +98,138 @@ class TestHTTP (unittest.TestCase):
 
             self.assertEqual (len (tpen.projects_as_list()), 13)
             self.assertEqual (sum (1 for two in tpen.projects()), 13)
+
+    def test_projects_concurrent (self):
+        login_success = 'document.location = "index.jsp";'
+        self.cfg['concurrency'] = 4
+
+        with requests_mock.Mocker() as m:
+            m.post (self.cfg.get ('uri_login'), text = login_success)
+            tpen = TPen (cfg = self.cfg)
+
+            with open (INDEX_FILE, 'r') as fh:
+                m.get (
+                    self.cfg.get ('uri_index'),
+                    text = fh.read(),
+                )
+
+            match = re.compile (r'^%s(\d+)$' % self.cfg.get ('uri_project'))
+
+            # every other project comes back with the wrong content type
+            def project_text (request, context):
+                tpen_id = match.match (request.url).group (1)
+                if int (tpen_id) % 2:
+                    context.headers['Content-Type'] = 'text/plain; charset=utf-8'
+                else:
+                    context.headers['Content-Type'] = 'application/ld+json;charset=UTF-8'
+                return tpen_id
+
+            m.get (match, text = project_text)
+
+            projects = tpen.projects_as_list()
+            self.assertEqual (
+                [p.get ('tpen_id') for p in projects],
+                [p.get ('tpen_id') for p in tpen.projects_list()],
+            )
+
+            odd = [p.get ('tpen_id') for p in projects if int (p.get ('tpen_id')) % 2]
+            for p in projects:
+                if p.get ('tpen_id') in odd:
+                    self.assertIsNone (p.get ('data'))
+                else:
+                    self.assertEqual (p.get ('data'), p.get ('tpen_id'))
+
+            errors = tpen.global_errors()
+            self.assertEqual (errors.get ('bad_file'), len (odd))
+            self.assertEqual (
+                errors.get ('unexpected_content_type'),
+                len (odd) * self.cfg.get ('max_errors'),
+            )
+
+    def test_retry_non_ok (self):
+        login_success = 'document.location = "index.jsp";'
+
+        with requests_mock.Mocker() as m:
+            m.post (self.cfg.get ('uri_login'), text = login_success)
+            tpen = TPen (cfg = self.cfg)
+
+            # T-PEN fails once, then answers
+            m.get (self.cfg.get ('uri_user') + '18', [
+                dict (status_code = 503, text = 'try again'),
+                dict (json = dict (uid = 18)),
+            ])
+
+            self.assertEqual (tpen.user (uid = 18), dict (uid = 18))
+            self.assertEqual (tpen.global_errors().get ('non_ok_response'), 1)
+
+            # T-PEN never answers properly
+            m.get (self.cfg.get ('uri_user') + '19', status_code = 500, text = 'no')
+            self.assertIsNone (tpen.user (uid = 19))
+            self.assertEqual (
+                tpen.global_errors().get ('non_ok_response'),
+                1 + self.cfg.get ('max_errors'),
+            )
+
+    def test_users_concurrent (self):
+        login_success = 'document.location = "index.jsp";'
+        self.cfg['concurrency'] = 4
+
+        with requests_mock.Mocker() as m:
+            m.post (self.cfg.get ('uri_login'), text = login_success)
+            tpen = TPen (cfg = self.cfg)
+
+            for uid in range (10):
+                m.get (self.cfg.get ('uri_user') + str (uid), json = dict (uid = uid))
+            m.get (self.cfg.get ('uri_user') + '404', status_code = 404)
+
+            uids = [str (uid) for uid in range (10)] + ['404']
+            users = tpen.users (uids = uids)
+            self.assertEqual (sorted (users), sorted (uids))
+            self.assertIsNone (users.get ('404'))
+            self.assertEqual (users.get ('7'), dict (uid = 7))
+
+    def test_circuit_breaker (self):
+        login_success = 'document.location = "index.jsp";'
+        self.cfg['circuit_breaker'] = self.cfg.get ('max_errors') + 1
+
+        with requests_mock.Mocker() as m:
+            m.post (self.cfg.get ('uri_login'), text = login_success)
+            tpen = TPen (cfg = self.cfg)
+
+            m.get (self.cfg.get ('uri_user') + '18', exc = requests.exceptions.ConnectTimeout)
+
+            # the first lookup gives up after max_errors tries ...
+            self.assertRaises (requests.exceptions.ConnectTimeout, tpen.user, uid = 18)
+
+            # ... the second one after just one more, and every later one right away
+            self.assertRaises (CircuitOpenError, tpen.user, uid = 18)
+            self.assertRaises (CircuitOpenError, tpen.user, uid = 18)
+            self.assertEqual (m.call_count, 1 + self.cfg.get ('max_errors') + 1)
+
+    def test_recorder (self):
+        login_success = 'document.location = "index.jsp";'
+        self.cfg['concurrency'] = 4
+        recorder = FakeRecorder()
+
+        with requests_mock.Mocker() as m:
+            m.post (self.cfg.get ('uri_login'), text = login_success)
+            tpen = TPen (cfg = self.cfg, recorder = recorder)
+
+            with open (INDEX_FILE, 'r') as fh:
+                m.get (self.cfg.get ('uri_index'), text = fh.read())
+            m.get (
+                re.compile (r'^%s\d+$' % self.cfg.get ('uri_project')),
+                text = '{}',
+                headers = { 'Content-Type': 'application/ld+json;charset=UTF-8' },
+            )
+            for uid in range (3):
+                m.get (self.cfg.get ('uri_user') + str (uid), json = dict (uid = uid))
+
+            labels = [p.get ('label') for p in tpen.projects_as_list()]
+            tpen.users (uids = range (3))
+
+        # every project and user is measured once, also when fetched in threads
+        self.assertEqual (
+            sorted (recorder.items),
+            sorted ([('project', l) for l in labels] + [('user', str (uid)) for uid in range (3)]),
+        )
@@ -0,0 +1,213 @@
+import json
+import os
+import subprocess
+import tempfile
+import unittest
+
+from backup import backup, plan_cleanup, MemberCache, MANIFEST
+
+
+def annotated (*creators):
+    """ project data with an annotation by each of the given users
+    """
+
+    return json.dumps (dict (sequences = [ dict (canvases = [ dict (otherContent = [ dict (
+        resources = [ dict (_tpen_creator = c) for c in creators ],
+    )])])]))
+
+
+class FakeTPen (object):
+    """ stands in for tpen.TPen, serving projects from a dict of label -> data
+    """
+
+    def __init__ (self, data):
+        self.data = data
+        self.looked_up = []
+
+    def projects_list (self):
+        return [ dict (label = label, tpen_id = str (i))
+            for (i, label) in enumerate (sorted (self.data))
+        ]
+
+    def projects (self):
+        for project in self.projects_list():
+            project.update (data = self.data.get (project.get ('label')))
+            yield project
+
+    def user (self, **kwa):
+        self.looked_up.append (kwa.get ('uid'))
+        return dict (name = 'user %s' % kwa.get ('uid'))
+
+    def users (self, **kwa):
+        return dict ((uid, self.user (uid = uid)) for uid in kwa.get ('uids'))
+
+
+class TestBackup (unittest.TestCase):
+
+    def setUp (self):
+        self.addCleanup (os.chdir, os.getcwd())
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup (tmpdir.cleanup)
+        self.basedir = tmpdir.name
+        os.mkdir (os.path.join (self.basedir, 'transcription'))
+        self.config = dict (keeplist = [], blacklist = [])
+
+    def run_backup (self, data, **kwa):
+        return backup (tpen = FakeTPen (data), config = self.config, basedir = self.basedir, **kwa)
+
+    def read (self, filename):
+        with open (os.path.join (self.basedir, 'transcription', filename), encoding = 'utf-8') as fh:
+            return fh.read()
+
+    def test_write_if_changed (self):
+        data = {
+            'MS A': annotated (18),
+            'MS B': '{ "label" : "Köln" }',
+        }
+
+        changes = self.run_backup (data)
+        self.assertEqual (changes, dict (changed = ['MS A', 'MS B'], removed = []))
+        self.assertEqual (self.read ('MS B.json'), data.get ('MS B'))
+        self.assertIn ('18', json.loads (self.read ('members.json')))
+
+        manifest = json.loads (self.read (MANIFEST))
+        self.assertEqual (sorted (manifest), ['MS A', 'MS B'])
+        mtime = os.stat (os.path.join (self.basedir, 'transcription', 'MS A.json')).st_mtime_ns
+
+        # nothing changed, nothing is written
+        changes = self.run_backup (data)
+        self.assertEqual (changes, dict (changed = [], removed = []))
+        self.assertEqual (
+            os.stat (os.path.join (self.basedir, 'transcription', 'MS A.json')).st_mtime_ns,
+            mtime,
+        )
+
+        data['MS B'] = '{ "label" : "Wien" }'
+        changes = self.run_backup (data)
+        self.assertEqual (changes, dict (changed = ['MS B'], removed = []))
+        self.assertEqual (self.read ('MS B.json'), data.get ('MS B'))
+        self.assertNotEqual (json.loads (self.read (MANIFEST)), manifest)
+
+    def test_plan_cleanup (self):
+        self.config.update (keeplist = ['tei-xml'], blacklist = ['MS C'])
+        plan = plan_cleanup (
+            files = ['MS A.json', 'MS C.json', 'MS Z.json', 'tei-xml', 'members.json', MANIFEST],
+            projects = FakeTPen (dict.fromkeys (['MS A', 'MS B', 'MS C'])).projects_list(),
+            config = self.config,
+        )
+        self.assertEqual (plan, dict (
+            keep        = ['tei-xml'],
+            obsolete    = ['MS Z.json'],
+            blacklisted = ['MS C.json'],
+        ))
+
+    def test_remove_obsolete (self):
+        self.config.update (blacklist = ['MS C'])
+        transcription = os.path.join (self.basedir, 'transcription')
+        for label in ['MS [1]', 'MS C', 'MS Z']:
+            with open (os.path.join (transcription, '%s.json' % label), 'w') as fh:
+                fh.write ('{}')
+
+        subprocess.run (['git', 'init', '-q', self.basedir], check = True)
+        subprocess.run (['git', '-C', self.basedir, 'add', 'transcription'], check = True)
+        subprocess.run (
+            ['git', '-C', self.basedir, '-c', 'user.name=test', '-c', 'user.email=test@example.org',
+             'commit', '-q', '-m', 'test'],
+            check = True,
+        )
+
+        # not in git at all
+        with open (os.path.join (transcription, 'MS Y.json'), 'w') as fh:
+            fh.write ('{}')
+
+        changes = self.run_backup ({ 'MS A': '{}', 'MS C': '{}' })
+        self.assertEqual (changes.get ('removed'), ['MS C', 'MS Y', 'MS Z', 'MS [1]'])
+        self.assertEqual (
+            sorted (os.listdir (transcription)),
+            ['MS A.json', MANIFEST],
+        )
+
+        # the deletions are staged
+        staged = subprocess.run (
+            ['git', '-C', self.basedir, 'diff', '--cached', '--name-status'],
+            check = True, stdout = subprocess.PIPE, universal_newlines = True,
+        ).stdout.splitlines()
+        self.assertEqual (staged, [
+            'D\ttranscription/MS C.json',
+            'D\ttranscription/MS Z.json',
+            'D\ttranscription/MS [1].json',
+        ])
+
+    def test_remove_tracked_directory (self):
+        transcription = os.path.join (self.basedir, 'transcription')
+        os.mkdir (os.path.join (transcription, 'tei-xml'))
+        for name in ['tei-xml/MS A.xml', 'MS *.json', 'MS Z.json', 'MS [Z].json']:
+            with open (os.path.join (transcription, name), 'w') as fh:
+                fh.write ('{}')
+
+        subprocess.run (['git', 'init', '-q', self.basedir], check = True)
+        subprocess.run (['git', '-C', self.basedir, 'add', 'transcription'], check = True)
+        subprocess.run (
+            ['git', '-C', self.basedir, '-c', 'user.name=test', '-c', 'user.email=test@example.org',
+             'commit', '-q', '-m', 'test'],
+            check = True,
+        )
+
+        # not in git, and matched by 'MS [Z].json' as a glob
+        with open (os.path.join (transcription, 'MS Y.json'), 'w') as fh:
+            fh.write ('{}')
+
+        # the directory is left alone, everything else goes as usual
+        changes = self.run_backup ({ 'MS A': '{}', 'MS Z': '{}' })
+        self.assertEqual (changes.get ('removed'), ['MS *', 'MS Y', 'MS [Z]'])
+        self.assertEqual (
+            sorted (os.listdir (transcription)),
+            ['MS A.json', 'MS Z.json', MANIFEST, 'tei-xml'],
+        )
+        self.assertEqual (os.listdir (os.path.join (transcription, 'tei-xml')), ['MS A.xml'])
+
+        staged = subprocess.run (
+            ['git', '-C', self.basedir, 'diff', '--cached', '--name-status'],
+            check = True, stdout = subprocess.PIPE, universal_newlines = True,
+        ).stdout.splitlines()
+        self.assertEqual (staged, [
+            'D\ttranscription/MS *.json',
+            'D\ttranscription/MS [Z].json',
+        ])
+
+    def test_member_cache (self):
+        cachefile = os.path.join (self.basedir, 'members-cache.json')
+        data = {
+            'MS A': annotated (18, 19),
+            'MS B': annotated (19, 20),
+        }
+
+        tpen = FakeTPen (data)
+        backup (tpen = tpen, config = self.config, basedir = self.basedir,
+            member_cache = MemberCache (filename = cachefile))
+        self.assertEqual (sorted (tpen.looked_up), ['18', '19', '20'])
+        self.assertEqual (sorted (json.loads (self.read ('members.json'))), ['18', '19', '20'])
+
+        # without members.json the cache still knows everybody
+        os.remove (os.path.join (self.basedir, 'transcription', 'members.json'))
+        tpen = FakeTPen (data)
+        backup (tpen = tpen, config = self.config, basedir = self.basedir,
+            member_cache = MemberCache (filename = cachefile))
+        self.assertEqual (tpen.looked_up, [])
+        self.assertEqual (
+            json.loads (self.read ('members.json')).get ('20'),
+            dict (name = 'user 20'),
+        )
+
+        # everybody is looked up again once the entries are too old
+        with open (cachefile, encoding = 'utf-8') as fh:
+            entries = json.load (fh)
+        for entry in entries.values():
+            entry['fetched'] -= 100
+        with open (cachefile, 'w', encoding = 'utf-8') as fh:
+            json.dump (entries, fh)
+
+        tpen = FakeTPen (data)
+        backup (tpen = tpen, config = self.config, basedir = self.basedir,
+            member_cache = MemberCache (filename = cachefile, max_age = 50))
+        self.assertEqual (sorted (tpen.looked_up), ['18', '19', '20'])
@@ -0,0 +1,67 @@
+import unittest
+from unittest import mock
+
+from retry import RetryPolicy
+
+
+class TestRetryPolicy (unittest.TestCase):
+
+    def test_backoff (self):
+        policy = RetryPolicy (max_attempts = 5, backoff = 2, backoff_max = 5)
+        attempts = []
+
+        with mock.patch ('retry.time.sleep') as sleep:
+            res = policy.call (
+                lambda remaining: attempts.append (remaining) or len (attempts),
+                check = lambda res: res < 5 and 'too_early' or None,
+            )
+
+        self.assertEqual (res, 5)
+        self.assertEqual (attempts, [None] * 5)
+
+        # 2, 4, 5 (capped), 5 seconds, each with up to half of it taken off
+        delays = [c.args[0] for c in sleep.call_args_list]
+        for (delay, full) in zip (delays, [2, 4, 5, 5]):
+            self.assertTrue (full / 2 <= delay <= full)
+        self.assertAlmostEqual (policy.slept, sum (delays))
+
+    def test_on_retry (self):
+        policy = RetryPolicy (max_attempts = 3, backoff = 0)
+        retries = []
+
+        def attempt (remaining):
+            raise ValueError ('nope')
+
+        self.assertRaises (ValueError, policy.call, attempt, retry_on = ValueError, on_retry = retries.append)
+
+        # called before the second and the third attempt, not after the last one
+        self.assertEqual (retries, [0, 0])
+
+    def test_budget (self):
+        policy = RetryPolicy (max_attempts = 10, backoff = 2, budget = 5)
+        attempts = []
+        clock = [0]
+
+        def attempt (remaining):
+            attempts.append (remaining)
+            raise ValueError ('nope')
+
+        def sleep (seconds):
+            clock[0] += seconds
+
+        # no jitter: wait exactly half of 2, 4, 8 seconds
+        with mock.patch ('retry.time.sleep', sleep), \
+             mock.patch ('retry.time.monotonic', lambda: clock[0]), \
+             mock.patch ('retry.random.uniform', return_value = 0):
+            self.assertRaises (ValueError, policy.call, attempt, retry_on = ValueError)
+
+        # after 1 + 2 seconds, waiting another 4 would exceed the budget
+        self.assertEqual (attempts, [5, 4, 2])
+
+    def test_no_retry (self):
+        policy = RetryPolicy (max_attempts = 10)
+
+        def attempt (remaining):
+            raise KeyError ('not worth another try')
+
+        self.assertRaises (KeyError, policy.call, attempt, retry_on = ValueError)
@@ -0,0 +1,97 @@
+import requests
+import requests_mock
+import unittest
+import yaml
+
+from metrics import RequestMetrics, percentile
+from tpen import TPen
+
+CONFIG_FILE = './backup.yml'
+
+
+class TestMetrics (unittest.TestCase):
+
+    def test_summary (self):
+        metrics = RequestMetrics()
+        for seconds in [0.5, 0.1, 0.3, 2.0]:
+            metrics.observe ('project', seconds = seconds, outcome = 200, received = 100, sent = 0)
+        metrics.observe ('project', seconds = 10.0, outcome = 'exception')
+        metrics.retried ('project', 1.5)
+
+        summary = metrics.summary().get ('project')
+        self.assertEqual (summary.get ('attempts'), 5)
+        self.assertEqual (summary.get ('outcomes'), {'200': 4, 'exception': 1})
+        self.assertEqual (summary.get ('p50'), 0.5)
+        self.assertEqual (summary.get ('max'), 10.0)
+        self.assertEqual (summary.get ('received_bytes'), 400)
+        self.assertEqual (summary.get ('retries'), 1)
+        self.assertEqual (summary.get ('backoff_seconds'), 1.5)
+
+    def test_percentile (self):
+        self.assertEqual (percentile ([], 95), 0.0)
+        self.assertEqual (percentile ([1], 95), 1)
+        self.assertEqual (percentile (list (range (1, 101)), 95), 95)
+        self.assertEqual (percentile (list (range (1, 101)), 100), 100)
+
+    def test_prometheus (self):
+        metrics = RequestMetrics (buckets = [1, 0.5])
+        metrics.observe ('user', seconds = 0.2, outcome = 200, received = 10)
+        metrics.observe ('user', seconds = 0.7, outcome = 503, received = 5)
+        metrics.retried ('user', 2.0)
+
+        text = metrics.prometheus (errors = dict (non_ok_response = 1), success = False)
+        lines = text.splitlines()
+
+        # the buckets are cumulative
+        self.assertIn ('tpen_request_duration_seconds_bucket{kind="user",le="0.5"} 1', lines)
+        self.assertIn ('tpen_request_duration_seconds_bucket{kind="user",le="1.0"} 2', lines)
+        self.assertIn ('tpen_request_duration_seconds_bucket{kind="user",le="+Inf"} 2', lines)
+        self.assertIn ('tpen_request_duration_seconds_count{kind="user"} 2', lines)
+        self.assertIn ('tpen_requests_total{kind="user",outcome="503"} 1', lines)
+        self.assertIn ('tpen_response_bytes_total{kind="user"} 15', lines)
+        self.assertIn ('tpen_retries_total{kind="user"} 1', lines)
+        self.assertIn ('tpen_backoff_seconds_total{kind="user"} 2.0', lines)
+        self.assertIn ('tpen_errors_total{error="non_ok_response"} 1', lines)
+        self.assertIn ('tpen_backup_success 0', lines)
+
+        # every metric is declared once, before its samples
+        types = [l.split()[2] for l in lines if l.startswith ('# TYPE')]
+        self.assertEqual (len (types), len (set (types)))
+        for l in lines:
+            if not l.startswith ('#'):
+                self.assertTrue (any (l.startswith (t) for t in types), l)
+
+    def test_client (self):
+        with open (CONFIG_FILE, 'r') as ymlfile:
+            cfg = yaml.load (ymlfile, Loader=yaml.FullLoader)
+        cfg['backoff'] = 0
+        cfg['username'] = 'tla'
+        cfg['password'] = 'secret'
+
+        with requests_mock.Mocker() as m:
+            m.post (cfg.get ('uri_login'), text = 'document.location = "index.jsp";')
+            tpen = TPen (cfg = cfg)
+
+            # T-PEN fails once, then answers
+            m.get (cfg.get ('uri_user') + '18', [
+                dict (status_code = 503, text = 'try again'),
+                dict (json = dict (uid = 18)),
+            ])
+            tpen.user (uid = 18)
+
+            m.get (cfg.get ('uri_user') + '19', exc = requests.exceptions.ConnectTimeout)
+            self.assertRaises (requests.exceptions.ConnectTimeout, tpen.user, uid = 19)
+
+        summary = tpen.metrics.summary()
+        self.assertEqual (sorted (summary), ['login', 'user'])
+        self.assertEqual (summary.get ('login').get ('attempts'), 1)
+        self.assertTrue (summary.get ('login').get ('sent_bytes') > 0)
+
+        user = summary.get ('user')
+        self.assertEqual (user.get ('outcomes'), {
+            '200': 1,
+            '503': 1,
+            'exception': cfg.get ('max_errors'),
+        })
+        self.assertEqual (user.get ('retries'), 1 + cfg.get ('max_errors') - 1)
+        self.assertEqual (user.get ('received_bytes'), len ('try again') + len ('{"uid": 18}'))
@@ -1,14 +1,24 @@
 import requests
+from requests.adapters import HTTPAdapter
 import re
 import hashlib
 import logging
 from bs4 import BeautifulSoup
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
 import pprint
-import sys
+import threading
 import time
+from urllib.parse import urljoin
+
+from metrics import RequestMetrics
+from retry import RetryPolicy
 
 pp = pprint.PrettyPrinter (indent = 4)
 
+LD_JSON = 'application/ld+json;charset=UTF-8'
+
 
 class TPen (object):
     """ TPen acts as an abstraction layer from t-pen.org
@@ -22,17 +32,40 @@ class TPen (object):
             debug ........ additional debug logging
             logfile ...... logfile location
             timeout ...... timeout when accessing t-pen
-            max_errors ... give up after this many errors (used for this and that)
+            max_errors ... try a request at most this many times
+            backoff ...... seconds to wait before the first retry, doubled for each further one (default 2)
+            backoff_max .. never wait longer than this between two tries (default 60)
+            request_budget .. give up on a request after this many seconds (default: no limit)
+            circuit_breaker . give up altogether after this many failed tries in a row (default: never)
+            concurrency .. fetch this many projects at the same time (default 1)
+
+            besides cfg, a recorder (an instrument.Recorder of the pipeline scripts) may be
+            given, which then measures every project download and user lookup
 
             init will try to login into t-pen or fail miserably
         """
 
         cfg = kwa.get ('cfg')
+        self.recorder = kwa.get ('recorder')
 
         self.timeout = cfg.get ('timeout')
         self.max_errors = cfg.get ('max_errors')
+        self.retry = RetryPolicy.from_config (cfg)
+        self.concurrency = cfg.get ('concurrency') or 1
         self.timeout_errors = 0
-        self.cookies = None
+
+        # one keep-alive session for all requests; it also keeps the login cookies
+        # the connection pool must be big enough for concurrent project fetches
+        #
+        self.session = requests.Session()
+        adapter = HTTPAdapter (pool_connections = 2, pool_maxsize = max (self.concurrency, 2))
+        self.session.mount ('http://', adapter)
+        self.session.mount ('https://', adapter)
+        self.session.headers.update ({
+            'Accept-Encoding': 'gzip, deflate',
+            'Connection': 'keep-alive',
+        })
+        self.cookies = self.session.cookies
 
         self.uri_index = cfg.get ('uri_index')
         self.uri_login = cfg.get ('uri_login')
@@ -51,10 +84,18 @@ class TPen (object):
             login_text              = 0,
             # impossible_chars        = 0,
         )
+        self._global_errors_lock = threading.Lock()
+
+        # latency, bytes and retries of the requests by kind (login, index, project, user)
+        self.metrics = RequestMetrics()
 
         #
         logging.info ("[tpen.TPen] initialised")
         logging.info ("[tpen.TPen] max_errors set to %s" % cfg.get('max_errors'))
+        logging.info ("[tpen.TPen] backoff set to %s, at most %s" % (self.retry.backoff, self.retry.backoff_max))
+        logging.info ("[tpen.TPen] request_budget set to %s" % self.retry.budget)
+        logging.info ("[tpen.TPen] circuit_breaker set to %s" % self.retry.circuit_breaker)
+        logging.info ("[tpen.TPen] concurrency set to %s" % self.concurrency)
         logging.info ("[tpen.TPen] log_level set to %s" % cfg.get('loglevel'))
         logging.info ("[tpen.TPen] debug-mode is %s" % (self.debug and 'on' or 'off'))
 
@@ -63,56 +104,66 @@ class TPen (object):
         md5_login_failed = 'b9abb18f4c42fd8321f97d38790d224d'
         login_success = 'document.location = "index.jsp";'
 
-        d = hashlib.md5 ()
-        logged_in = False
-        errors = 0
-        while not logged_in and errors < self.max_errors:
-
-            res = self._request (
-                verb = 'post',
-                uri = self.uri_login,
-                data = dict (
-                    uname    = cfg.get ('username'),
-                    password = cfg.get ('password'),
-            ))
-            d.update (res.text.encode())
-
+        def login_check (res):
             # "well" known md5 of response returned by t-pen in case of error
-            if (md5_login_failed == d.hexdigest()):
-                self._global_errors['login_md5'] += 1
-                errors += 1
-                logging.error ('authentication failed (md5) (try %s)' % errors)
-                logging.info ('bad res.cookies: %s ' % pp.pformat (res.cookies))
+            if md5_login_failed == hashlib.md5 (res.text.encode()).hexdigest():
+                return 'login_md5'
 
             # "well" known response returned by t-pen in case of success
-            elif login_success not in res.text:
-                self._global_errors['login_text'] += 1
-                errors += 1
-                logging.error ('authentication failed (text) (try %s)' % errors)
-                logging.info ('bad res.cookies: %s ' % pp.pformat (res.cookies))
+            if login_success not in res.text:
+                return 'login_text'
 
-            # assuming we're logged in
-            else:
-                logged_in = True
-                logging.info ('good res.cookies: %s ' % pp.pformat (res.cookies))
+            return None
 
-        if logged_in:
-            logging.info ('got %s errors logging in' % errors)
-        else:
+        res = self._request (
+            verb = 'post',
+            kind = 'login',
+            uri = self.uri_login,
+            data = dict (
+                uname    = cfg.get ('username'),
+                password = cfg.get ('password'),
+            ),
+            check = login_check,
+        )
+
+        if login_check (res):
+            logging.info ('bad res.cookies: %s ' % pp.pformat (res.cookies))
             raise UserWarning ('authentication failed')
 
-        self.cookies = res.cookies
+        # assuming we're logged in
+        logging.info ('good res.cookies: %s ' % pp.pformat (res.cookies))
+
+    def close (self):
+        """ close the connections to t-pen
+        """
+
+        self.session.close()
 
     def global_errors (self):
         return self._global_errors
 
+    def _measure (self, kind, item):
+        """ measure the work in the with block as an item of the recorder, if there is one
+        """
+
+        if self.recorder is None:
+            return contextlib.nullcontext()
+        return self.recorder.measure (kind, item)
+
+    def _count_error (self, error):
+        """ count an error of the given kind; projects may be fetched concurrently
+        """
+
+        with self._global_errors_lock:
+            self._global_errors[error] += 1
+
     def projects_list (self):
         """ get a list of all projects of logged in account
             the list consists of dicts with the two keys label and tpen_id
         """
 
         if not self._projects_list:
-            soup = BeautifulSoup (self._request (uri = self.uri_index).text, 'html.parser')
+            soup = BeautifulSoup (self._request (uri = self.uri_index, kind = 'index').text, 'html.parser')
             table = soup.find (id = 'projectList')
 
             # link target may not change
@@ -139,32 +190,32 @@ class TPen (object):
         """
 
         project = kwa.get ('project')
-        file_ok = False
-        errors  = 0
-
-        while errors < self.max_errors and not file_ok:
-            res = self._request (self.uri_project + str (project.get ('tpen_id')))
-
-            # T-PEN sets the Content-Type header to either
-            # "application/ld+json;charset=UTF-8" or "text/plain; charset=utf-8"
-            # in the first case the content is encoded properly, not in the second
-            #
-            if res.headers.get ('Content-Type') != 'application/ld+json;charset=UTF-8':
-                errors += 1
-                self._global_errors['unexpected_content_type'] += 1
 
+        # T-PEN sets the Content-Type header to either
+        # "application/ld+json;charset=UTF-8" or "text/plain; charset=utf-8"
+        # in the first case the content is encoded properly, not in the second
+        #
+        def content_type_check (res):
+            if res.headers.get ('Content-Type') != LD_JSON:
                 logging.info (
-                    '[%s, "%s"] got unexpected content-type "%s", expected: "%s" (try %s)' % (
+                    '[%s, "%s"] got unexpected content-type "%s", expected: "%s"' % (
                         project.get ('tpen_id'),
                         project.get ('label'),
                         res.headers.get ('Content-Type'),
-                        'application/ld+json;charset=UTF-8',
-                        errors,
+                        LD_JSON,
                 ))
                 log_res (res)
+                return 'unexpected_content_type'
 
-            else:
-                file_ok = True
+            return None
+
+        with self._measure ('project', project.get ('label')):
+            res = self._request (
+                self.uri_project + str (project.get ('tpen_id')),
+                kind = 'project',
+                check = content_type_check,
+            )
+        file_ok = res.ok and res.headers.get ('Content-Type') == LD_JSON
 
         if file_ok:
             logging.debug ('[%s, "%s"] file looks good',
@@ -173,7 +224,7 @@ class TPen (object):
             )
             project.update (data = res.text)
         else:
-            self._global_errors['bad_file'] += 1
+            self._count_error ('bad_file')
             logging.error ('[%s, %s] skipping file',
                 project.get ('tpen_id'),
                 project.get ('label'),
@@ -188,172 +239,198 @@ class TPen (object):
 
     def projects (self, **kwa):
         """ get all projects of logged in account
+            with concurrency > 1 the projects are fetched by a pool of that many threads,
+            but they are still yielded in the order of projects_list()
         """
 
-        for project in self.projects_list():
-            # time.sleep (random.randint(12, 48))
-            yield self.project (project = project)
+        if self.concurrency <= 1:
+            for project in self.projects_list():
+                # time.sleep (random.randint(12, 48))
+                yield self.project (project = project)
+            return
+
+        with ThreadPoolExecutor (max_workers = self.concurrency) as executor:
+            # keep only a few fetches ahead of the consumer
+            pending = deque()
+            for project in self.projects_list():
+                pending.append (executor.submit (self.project, project = project))
+                if len (pending) > self.concurrency:
+                    yield pending.popleft().result()
+
+            while pending:
+                yield pending.popleft().result()
 
     def projects_as_list (self, **kwa):
         """ get all projects of logged in account
         """
 
         # time.sleep (random.randint(12, 48))
-        return [ self.project (project = project)
-            for project in self.projects_list()
-        ]
+        return list (self.projects())
         
         
+    def users (self, **kwa):
+        """ look up several users by ID, concurrently like projects()
+            returns a dict of ID -> info hash (None if the lookup failed)
+        """
+
+        uids = list (kwa.get ('uids'))
+
+        if self.concurrency <= 1:
+            return dict ((uid, self.user (uid = uid)) for uid in uids)
+
+        with ThreadPoolExecutor (max_workers = self.concurrency) as executor:
+            return dict (zip (uids, executor.map (lambda uid: self.user (uid = uid), uids)))
+
+
     def user (self, **kwa):
         """look up a user by ID and return its info hash"""
-        
-        info_ok = False
-        errors  = 0
-        while errors < self.max_errors and not info_ok:
-            res = self._request (self.uri_user + str (kwa.get ('uid')))
-            if res.status_code != 200:
-                errors += 1
-            else:
-                info_ok = True
-                
-        if info_ok:
+
+        with self._measure ('user', str (kwa.get ('uid'))):
+            res = self._request (self.uri_user + str (kwa.get ('uid')), kind = 'user')
+        if res.status_code == 200:
             return res.json()
         else:
             return None
-    
+
 
     def _request (self, uri, **kwa):
         """ issues a request to the given uri and return the response as is
             defaults to GET
-        """
 
-        res = None
-        ex = None
-        ok = False
-        errors = 0
-        sleep_for = 2
+            the request is repeated according to the retry policy on exceptions, on non-ok
+            responses and whenever the optional check function returns the kind of error
+            (see global_errors) found in a response instead of None
+            returns the last response, even if it didn't pass
 
-        while not ok and errors < self.max_errors:
-            try:
-                res = self._do_request (
-                    uri  = uri or kwa.get ('uri'),
-                    verb = kwa.get ('verb') or 'get',
-                    data = kwa.get ('data'),
-		)
-
-            except requests.exceptions.Timeout as e:
-                logging.error ('cought requests.exceptions.Timeout (try %s) for URI: <%s>' % (errors, uri))
-                errors += 1
-                ex = e
-                logging.info ('sleeping %s seconds' % sleep_for)
-                time.sleep (sleep_for)
-
-            else:
-                ok = True
-                logging.debug ('request went ok')
+            every attempt, and the wait before every retry, is recorded in the metrics
+            under the given kind of request
+        """
 
-        if ex:
-            logging.exception (
-                'cought requests.exceptions.Timeout %s times, giving up' %
-                self.max_errors
-            )
-            raise ex
+        uri   = uri or kwa.get ('uri')
+        verb  = kwa.get ('verb') or 'get'
+        data  = kwa.get ('data')
+        kind  = kwa.get ('kind') or 'other'
+        check = kwa.get ('check') or (lambda res: None)
 
-        elif not ok:
-            logging.error ('something went terribly wrong')
-            raise UserWarning ('something went terribly wrong')
+        def attempt (remaining):
+            timeout = self.timeout
+            if remaining is not None:
+                # don't wait for t-pen beyond the time budget of the request
+                timeout = max (min (timeout or remaining, remaining), 1)
 
+            start = time.perf_counter()
+            try:
+                res = self._do_request (uri, verb = verb, data = data, timeout = timeout)
+            except requests.exceptions.RequestException:
+                self.metrics.observe (kind, seconds = time.perf_counter() - start, outcome = 'exception')
+                raise
+
+            self.metrics.observe (
+                kind,
+                seconds  = time.perf_counter() - start,
+                outcome  = res.status_code,
+                received = len (res.content),
+                sent     = body_size (res.request),
+            )
+            return res
 
-        return res
+        def response_check (res):
+            if not res.ok:
+                logging.error ('%(verb)s to %(uri)s returned status code %(code)s' % dict (
+                    verb = verb.upper(),
+                    uri  = uri,
+                    code = res.status_code,
+                ))
+                log_res (res)
+                error = 'non_ok_response'
+            else:
+                error = check (res)
+
+            error and self._count_error (error)
+            return error
+
+        return self.retry.call (
+            attempt,
+            check          = response_check,
+            retry_on       = requests.exceptions.RequestException,
+            breaker_errors = ('non_ok_response',),
+            description    = '%s %s' % (verb.upper(), uri),
+            on_retry       = lambda delay: self.metrics.retried (kind, delay),
+        )
 
 
     def _do_request (self, uri, **kwa):
-        uri  = uri or kwa.get ('uri')
-        verb = kwa.get ('verb') or 'get'
-        data = kwa.get ('data')
-        res  = None
-
-        tries = 0
-        request_ok = False
-        while not request_ok and tries < self.max_errors:
-            logging.debug ("%(verb)s %(uri)s; (attempt %(attempt)s of %(max_errors)s)" % dict (
-                verb = verb.upper(),
-                uri = uri,
-                attempt = tries + 1,
-                max_errors = self.max_errors,
-            ))
-
-            try:
-                if verb == 'post':
-                    res = requests.post (
-                        uri,
-                        data = data,
-                        cookies = self.cookies,
-                        timeout = self.timeout,
-                    )
-
-                    # requests (like browsers) will only GET after a redirect
-                    # POST requests must therefore be repeated, otherwise t-pen login won't work
-                    # note: serving subsequent requests, t-pen.org may redirect multiple times (301s and 302s)
-                    #
-                    if res.history:
-                        res = requests.post (
-                            res.url,
-                            data = data,
-                            cookies = self.cookies,
-                            timeout = self.timeout,
-                        )
-                    res.raise_for_status()
-                elif verb == 'get':
-                    # XXX it is no genius idea to keep this in a rather generic _request()
-                    headers = dict (Accept = 'application/ld+json;charset=UTF-8')
-
-                    res = requests.get (
-                        uri,
-                        headers = headers,
-                        cookies = self.cookies,
-                        timeout = self.timeout,
-                    )
-                    res.raise_for_status()
-                else:
-                    raise UserWarning ('invalid verb')
-
-            except requests.exceptions.RequestException as e:
-                logging.error ("RequestException: %s" % e)
-                res and log_res (res)
-            except:
-                logging.error ("Exception: %s" % sys.exc_info()[0])
-                res and log_res (res)
-            else:
-                request_ok = True
+        """ a single attempt at a request, see _request()
+        """
 
-            finally:
-                tries += 1
+        uri     = uri or kwa.get ('uri')
+        verb    = kwa.get ('verb') or 'get'
+        data    = kwa.get ('data')
+        timeout = kwa.get ('timeout') or self.timeout
+
+        logging.debug ("%(verb)s %(uri)s" % dict (
+            verb = verb.upper(),
+            uri = uri,
+        ))
+
+        if verb == 'post':
+            # requests (like browsers) will only GET after a redirect
+            # POST requests must therefore be repeated, otherwise t-pen login won't work
+            # so we follow redirects ourselves and POST to each new location
+            # note: serving subsequent requests, t-pen.org may redirect multiple times (301s and 302s)
+            #
+            res = self.session.post (
+                uri,
+                data = data,
+                timeout = timeout,
+                allow_redirects = False,
+            )
+            redirects = 0
+            while res.is_redirect and redirects < self.session.max_redirects:
+                redirects += 1
+                res = self.session.post (
+                    urljoin (res.url, res.headers.get ('location')),
+                    data = data,
+                    timeout = timeout,
+                    allow_redirects = False,
+                )
+        elif verb == 'get':
+            # XXX it is no genius idea to keep this in a rather generic _request()
+            headers = dict (Accept = LD_JSON)
+
+            res = self.session.get (
+                uri,
+                headers = headers,
+                timeout = timeout,
+            )
+        else:
+            raise UserWarning ('invalid verb')
 
         # status-code seems always 200, body sometimes empty
         #
-        if not res.ok:
-            logging.error ('%(verb)s to %(uri) returned status code %(code)s' % dict (
-                verb = verb.upper(),
-                uri  = uri,
-                code = res.status_code,
-            ))
-            self._global_errors['non_ok_response'] += 1
-            log_res (res)
-
         if not res.text:
             logging.error (
-                '%(verb)s %(uri) returned empty body (status code: %(code)s' % dict (
+                '%(verb)s %(uri)s returned empty body (status code: %(code)s)' % dict (
                     verb = verb.upper(),
                     uri  = uri,
                     code = res.status_code,
             ))
-            self._global_errors['empty_response'] += 1
+            self._count_error ('empty_response')
             log_res (res)
 
         return res
 
 
+def body_size (request):
+    """ the size of the body of a prepared request in bytes
+    """
+
+    body = request is not None and request.body or b''
+    if isinstance (body, str):
+        body = body.encode ('utf-8')
+    return len (body)
+
+
 def log_res (res):
     """ basically log the whole response
     """